@@ -1,7 +1,167 @@
+import errno
+import hashlib
 import socket
 import os
 import time
-from rich.progress import Progress, BarColumn, TimeElapsedColumn, TransferSpeedColumn, Console
+import datetime
+import uuid
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from protocol import (
+    CHUNK_SIZE,
+    DOWNLOAD_REPLY,
+    MAX_CHUNKS,
+    OP_CHUNKS,
+    OP_CLOSE,
+    OP_DONE,
+    OP_DOWNLOAD,
+    OP_ECHO,
+    OP_ERROR,
+    OP_HAVE,
+    OP_HELLO,
+    OP_MANIFEST,
+    OP_OK,
+    OP_STAT,
+    OP_TIME,
+    OP_UPLOAD,
+    STAT_REPLY,
+    TIME_REPLY,
+    TRANSFER,
+    Frame,
+    ProtocolError,
+    encode_frame,
+    pack_chunked_upload,
+    pack_have,
+    pack_transfer,
+    pack_upload,
+    recv_frame,
+    send_frame,
+    unpack_indexes,
+    unpack_manifest,
+)
+from digest_index import SAVE_INTERVAL, DigestIndex
+from progress import ProgressRenderer
+from terminal import Terminal
+
+CLIENT_TOKEN_FILE = ".client_token"
+DIGEST_INDEX_FILE = ".digest_index.json"
+SENDFILE_SLICE = 8 * 1024 * 1024  # bytes per sendfile call, so progress keeps moving
+MIN_RECV_CHUNK = 256 * 1024
+MAX_RECV_CHUNK = 4 * 1024 * 1024
+CONNECT_TIMEOUT = 10.0
+KEEPALIVE_IDLE = 10  # seconds of silence before the first keepalive probe
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+USER_TIMEOUT_MS = 30000  # data unacknowledged for this long kills the connection
+RECONNECT_ATTEMPTS = 6
+RECONNECT_DELAY = 1.0  # first backoff, doubled after every failed attempt
+RECONNECT_MAX_DELAY = 30.0
+# Errors of the path rather than of the peer; the next attempt may get through.
+LINK_ERRNOS = {errno.ENETDOWN, errno.ENETUNREACH, errno.EHOSTDOWN, errno.EHOSTUNREACH}
+
+
+
+def load_client_token(path: str = CLIENT_TOKEN_FILE) -> str:
+    """
+    Returns the persistent token identifying this client to the server.
+
+    The server keys interrupted transfers by this token rather than by IP,
+    so resume works across reconnects, NAT and address changes.
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            token = f.read().strip()
+        if token:
+            return token
+
+    token = uuid.uuid4().hex
+    with open(path, "w") as f:
+        f.write(token)
+    return token
+
+
+def recv_chunk_size(sock: socket.socket) -> int:
+    """
+    Size of the download buffer for ``sock``.
+
+    Follows the kernel receive buffer, so a single ``recv_into`` can drain
+    everything that arrived since the last one, within sane bounds.
+    """
+    size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    return max(MIN_RECV_CHUNK, min(MAX_RECV_CHUNK, size))
+
+
+class TransferError(Exception):
+    """The server refused or aborted a transfer."""
+
+
+class TransferStats(NamedTuple):
+    """Outcome of one finished upload or download."""
+
+    size: int  # size of the whole file in bytes
+    start: int  # offset the transfer resumed from
+    seconds: float
+    deduplicated: bool = False  # the server already had the content
+
+    @property
+    def transferred(self) -> int:
+        return self.size - self.start
+
+    @property
+    def bitrate(self) -> float:
+        """MB/s over the bytes actually sent."""
+        return self.transferred / self.seconds / 1024 / 1024 if self.seconds else 0.0
+
+
+def chunk_digests(path: str) -> List[bytes]:
+    """SHA-256 of every CHUNK_SIZE chunk of a file, for a CHUNKS upload."""
+    digests = []
+    with open(path, "rb") as f:
+        while data := f.read(CHUNK_SIZE):
+            digests.append(hashlib.sha256(data).digest())
+    return digests
+
+
+def configure_socket(sock: socket.socket) -> None:
+    """
+    Makes a dead connection fail within about half a minute.
+
+    Keepalive probes find a peer that vanished while the connection was
+    idle, TCP_USER_TIMEOUT one that vanished with data in flight; without
+    them a blocked recv can wait for hours.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):  # Linux only
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, USER_TIMEOUT_MS)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+
+
+def connection_lost(error: BaseException) -> bool:
+    """True for errors after which a new connection may succeed."""
+    if isinstance(error, (ConnectionError, TimeoutError, ProtocolError)):
+        return True
+    return isinstance(error, OSError) and error.errno in LINK_ERRNOS
+
+
+def backoff_delays(attempts: int = RECONNECT_ATTEMPTS) -> Iterator[float]:
+    """Seconds to wait before each reconnect attempt: 1, 2, 4, ... capped."""
+    delay = RECONNECT_DELAY
+    for _ in range(attempts):
+        yield delay
+        delay = min(RECONNECT_MAX_DELAY, delay * 2)
+
+
+COMMAND_OPCODES = {
+    "ECHO": OP_ECHO,
+    "TIME": OP_TIME,
+    "STAT": OP_STAT,
+    "CLOSE": OP_CLOSE,
+    "EXIT": OP_CLOSE,
+    "QUIT": OP_CLOSE,
+}
 
 
 class TCPClient:
@@ -14,8 +174,10 @@ class TCPClient:
         The IP address of the server.
     server_port : int
         The port number of the server.
-    console : Console
-        Rich console for logging and progress display.
+    console : Terminal
+        Console for logging and progress display; loads rich only when interactive.
+    progress : ProgressRenderer
+        Draws transfer progress off the transfer loop.
     """
 
     def __init__(self, server_host: str, server_port: int) -> None:
@@ -31,7 +193,110 @@ class TCPClient:
         """
         self.server_host = server_host
         self.server_port = server_port
-        self.console = Console()
+        self.console = Terminal()
+        self.progress = ProgressRenderer(self.console, wait_on_finish=True)
+        self.last_request_id = 0
+        self.token = load_client_token()
+        self.digest_index = DigestIndex(DIGEST_INDEX_FILE)
+        self.chunked: Optional[bool] = None  # whether the server has a chunk store; None until asked
+
+    def next_request_id(self) -> int:
+        self.last_request_id = (self.last_request_id + 1) & 0xFFFFFFFF
+        return self.last_request_id
+
+    def build_request(self, command: str) -> Optional[Tuple[int, bytes]]:
+        """
+        Translates a text command into a request opcode and payload.
+
+        Parameters
+        ----------
+        command : str
+            Command typed by the user, e.g. "ECHO hello" or "TIME".
+
+        Returns
+        -------
+        Optional[Tuple[int, bytes]]
+            The opcode and payload, or None if the command is unknown.
+        """
+        name, _, argument = command.strip().partition(" ")
+        opcode = COMMAND_OPCODES.get(name.upper())
+        if opcode is None:
+            return None
+        return opcode, argument.encode()
+
+    def format_response(self, opcode: int, response: Frame) -> str:
+        """
+        Renders a response frame for the console.
+
+        Parameters
+        ----------
+        opcode : int
+            The opcode of the request the response belongs to.
+        response : Frame
+            The response frame.
+        """
+        if response.opcode == OP_ERROR:
+            return f"[red]{response.payload.decode()}"
+        if opcode == OP_TIME:
+            (timestamp,) = TIME_REPLY.unpack(response.payload)
+            return f"TIME: {datetime.datetime.fromtimestamp(timestamp)}"
+        if opcode == OP_STAT:
+            size, mtime = STAT_REPLY.unpack(response.payload)
+            return f"STAT: {size} bytes, modified {datetime.datetime.fromtimestamp(mtime)}"
+        if opcode == OP_ECHO:
+            return f"ECHO: {response.payload.decode()}"
+        return response.payload.decode()
+
+    def connect(self) -> socket.socket:
+        """
+        Opens a connection to the server and introduces the client.
+
+        Returns
+        -------
+        socket.socket
+            The connected socket, with keepalive and TCP_USER_TIMEOUT set.
+        """
+        sock = socket.create_connection((self.server_host, self.server_port), CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        configure_socket(sock)
+        try:
+            self.hello(sock)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def reconnect(self) -> socket.socket:
+        """
+        Connects again after a lost connection, backing off exponentially.
+
+        Raises
+        ------
+        OSError
+            The error of the last attempt if none succeeded.
+        """
+        error: Optional[BaseException] = None
+        for attempt, delay in enumerate(backoff_delays()):
+            reason = "Connection lost" if attempt == 0 else f"Reconnect failed ({error})"
+            self.console.log(f"[yellow]{reason}, retrying in {delay:.0f}s")
+            time.sleep(delay)
+            try:
+                return self.connect()
+            except (OSError, ProtocolError) as e:
+                error = e
+        raise error
+
+    def hello(self, sock: socket.socket) -> None:
+        """
+        Introduces the client to the server with its persistent token.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The connected socket object.
+        """
+        send_frame(sock, self.next_request_id(), OP_HELLO, self.token.encode())
+        recv_frame(sock)
 
     def send_command(self, sock: socket.socket, command: str) -> None:
         """
@@ -44,9 +309,173 @@ class TCPClient:
         command : str
             The command to send.
         """
-        sock.sendall(command.encode())
-        response = sock.recv(1024).decode()
-        self.console.log(response)
+        self.pipeline(sock, [command])
+
+    def pipeline(self, sock: socket.socket, commands: List[str]) -> None:
+        """
+        Sends several small commands back to back and logs the responses.
+
+        All requests are written in one go and the responses are matched to
+        them by request id, so N commands cost one round trip instead of N.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The connected socket object.
+        commands : list
+            Commands such as ECHO, TIME or STAT.
+        """
+        pending: Dict[int, int] = {}
+        batch = bytearray()
+        for command in commands:
+            request = self.build_request(command)
+            if request is None:
+                self.console.log(f"[red]Unknown command: {command}")
+                continue
+            request_id = self.next_request_id()
+            pending[request_id] = request[0]
+            batch += encode_frame(request_id, *request)
+
+        sock.sendall(batch)
+        while pending:
+            response = recv_frame(sock)
+            opcode = pending.pop(response.request_id, None)
+            if opcode is None:
+                self.console.log(f"[red]Unexpected response #{response.request_id}")
+                continue
+            self.console.log(self.format_response(opcode, response))
+
+    def stat(self, sock: socket.socket, filename: str) -> Optional[Tuple[int, float]]:
+        """
+        Asks the server for the size and mtime of a file.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The connected socket object.
+        filename : str
+            The name of the file on the server.
+
+        Returns
+        -------
+        Optional[Tuple[int, float]]
+            Size in bytes and modification time, or None if the server has
+            no such file.
+        """
+        send_frame(sock, self.next_request_id(), OP_STAT, filename.encode())
+        response = recv_frame(sock)
+        if response.opcode != OP_OK:
+            return None
+        return STAT_REPLY.unpack(response.payload)
+
+    def manifest(self, sock: socket.socket, directory: str = "") -> Optional[Dict[str, Tuple[int, int, bytes]]]:
+        """
+        Asks the server for size, mtime and digest of every file under a directory.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The connected socket object.
+        directory : str, optional
+            The directory on the server, by default its root.
+
+        Returns
+        -------
+        Optional[Dict[str, Tuple[int, int, bytes]]]
+            Size, mtime in ns and SHA-256 digest by path relative to
+            ``directory``, or None if the server cannot list it.
+        """
+        send_frame(sock, self.next_request_id(), OP_MANIFEST, directory.encode())
+        files = {}
+        while True:
+            response = recv_frame(sock)
+            if response.opcode == OP_DONE:
+                return files
+            if response.opcode != OP_OK:
+                return None
+            for name, size, mtime_ns, digest in unpack_manifest(response.payload):
+                files[name] = (size, mtime_ns, digest)
+
+    def have(self, sock: socket.socket, digest: bytes, remote_name: str) -> bool:
+        """
+        Asks the server to store content it already has under ``remote_name``.
+
+        Returns
+        -------
+        bool
+            True if it did, so there is nothing left to upload.
+        """
+        send_frame(sock, self.next_request_id(), OP_HAVE, pack_have(digest, remote_name))
+        return recv_frame(sock).opcode == OP_OK
+
+    def upload(
+        self, sock: socket.socket, filename: str, remote_name: Optional[str] = None, dedupe: bool = True
+    ) -> TransferStats:
+        """
+        Uploads a file to the server without logging anything.
+
+        The server is first asked whether it already has the content (see
+        ``have``); the digest comes from the local digest cache, so an
+        unchanged file is not read for it again. A server with a chunk store
+        then gets only the chunks it lacks (see ``upload_chunks``).
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The connected socket object.
+        filename : str
+            The path of the local file.
+        remote_name : str, optional
+            The name to store it under on the server, by default filename
+        dedupe : bool, optional
+            Skip content the server already has, by default True
+
+        Raises
+        ------
+        TransferError
+            If the server refused or aborted the upload.
+        OSError
+            If the file cannot be read or the connection fails.
+        """
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(f"File not found: {filename}")
+
+        st = os.stat(filename)
+        file_size = st.st_size
+        remote_name = remote_name or filename
+        start_time = time.time()
+        if dedupe:
+            digest = self.digest_index.digest(filename, st)
+            self.digest_index.save(SAVE_INTERVAL)
+            if self.have(sock, digest, remote_name):
+                return TransferStats(file_size, file_size, time.time() - start_time, deduplicated=True)
+            if self.chunked is not False and file_size <= MAX_CHUNKS * CHUNK_SIZE:
+                stats = self.upload_chunks(sock, filename, st, remote_name, start_time)
+                if stats is not None:
+                    return stats
+
+        send_frame(sock, self.next_request_id(), OP_UPLOAD, pack_upload(file_size, st.st_mtime_ns, remote_name))
+        ack = recv_frame(sock)
+        if ack.opcode != OP_OK:
+            raise TransferError(ack.payload.decode())
+
+        (offset,) = TRANSFER.unpack(ack.payload)
+        with open(filename, "rb") as f, self.progress.track(
+                f"Uploading {filename}", file_size, offset
+        ) as counter:
+            # The kernel copies straight from the page cache to the socket.
+            position = offset
+            while position < file_size:
+                sent = sock.sendfile(f, position, min(SENDFILE_SLICE, file_size - position))
+                if not sent:
+                    raise ValueError(f"File {filename} shrank during upload")
+                position += sent
+                counter.done = position
+
+        done = recv_frame(sock)
+        if done.opcode != OP_DONE:
+            raise TransferError(done.payload.decode())
+        return TransferStats(file_size, offset, time.time() - start_time)
 
     def upload_file(self, sock: socket.socket, filename: str) -> None:
         """
@@ -59,46 +488,132 @@ class TCPClient:
         filename : str
             The name of the file to upload.
         """
-        if not os.path.exists(filename):
-            self.console.log("File not found")
-            return
-
-        file_size = os.path.getsize(filename)
-
         try:
-            start_time = time.time()
-            with open(filename, "rb") as f, Progress(
-                    "[blue]{task.description}",
-                    BarColumn(),
-                    TimeElapsedColumn(),
-                    TransferSpeedColumn(),
-                    "[bold blue]{task.percentage:.0f}%[/bold blue]"
-            ) as progress:
-                task = progress.add_task(f"[cyan]Uploading {filename}...", total=file_size)
-
-                sock.sendall(f"UPLOAD {filename}\n".encode())
-                ack = sock.recv(1024).decode().strip()
-
-                if ack == "READY":
-                    sock.sendall(str(file_size).encode())
-                    sock.recv(1024).decode()
-
-                    while chunk := f.read(1024):
-                        sock.sendall(chunk)
-                        progress.update(task, advance=len(chunk))
-                else:
-                    self.console.log("[red]File upload error")
-
-            elapsed_time = time.time() - start_time
-            bitrate = file_size / elapsed_time / 1024 / 1024
-            self.console.log(f"[green]File {filename} uploaded ({bitrate:.2f} MB/s)[/green]")
-        except Exception as e:
+            stats = self.upload(sock, filename)
+            self.digest_index.save()
+            if stats.deduplicated:
+                self.console.log(f"[green]File {filename} is already on the server[/green]")
+            else:
+                self.console.log(f"[green]File {filename} uploaded ({stats.bitrate:.2f} MB/s)[/green]")
+        except TransferError as e:
+            self.console.log(f"[red]File upload error: {e}")
+        except ValueError as e:
+            # The file shrank mid-upload and the server still waits for the
+            # missing bytes: reconnect to get back in step, then upload again.
+            self.console.log(f"[red]Error: {e}")
+            raise ConnectionAbortedError(str(e)) from e
+        except OSError as e:
+            if connection_lost(e):
+                raise
             self.console.log(f"[red]Error: {e}")
 
+    def upload_chunks(
+        self, sock: socket.socket, filename: str, st: os.stat_result, remote_name: str, start_time: float
+    ) -> Optional[TransferStats]:
+        """
+        Uploads only the chunks missing from the server's chunk store.
+
+        An interrupted upload needs no resume: the chunks that got through
+        are stored and count as present on the next attempt.
+
+        Returns
+        -------
+        Optional[TransferStats]
+            None if the server has no chunk store; the whole file has to be
+            uploaded then. ``start`` counts the bytes that were skipped.
+        """
+        file_size = st.st_size
+        digests = chunk_digests(filename)
+        send_frame(
+            sock, self.next_request_id(), OP_CHUNKS, pack_chunked_upload(file_size, st.st_mtime_ns, digests, remote_name)
+        )
+        ack = recv_frame(sock)
+        if ack.opcode != OP_OK:
+            self.chunked = False
+            return None
+        self.chunked = True
+
+        missing = unpack_indexes(ack.payload)
+        total = sum(min(CHUNK_SIZE, file_size - index * CHUNK_SIZE) for index in missing)
+        sent = 0
+        with open(filename, "rb") as f, self.progress.track(f"Uploading {filename}", total) as counter:
+            for index in missing:
+                position = index * CHUNK_SIZE
+                end = min(position + CHUNK_SIZE, file_size)
+                while position < end:
+                    count = sock.sendfile(f, position, end - position)
+                    if not count:
+                        raise ValueError(f"File {filename} shrank during upload")
+                    position += count
+                    sent += count
+                    counter.done = sent
+
+        done = recv_frame(sock)
+        if done.opcode != OP_DONE:
+            raise TransferError(done.payload.decode())
+        return TransferStats(file_size, file_size - sent, time.time() - start_time)
+
+    def download(self, sock: socket.socket, filename: str, local_path: Optional[str] = None) -> TransferStats:
+        """
+        Downloads a file from the server without logging anything.
+
+        Resumes from the size of an existing local copy if the server agrees.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The connected socket object.
+        filename : str
+            The name of the file on the server.
+        local_path : str, optional
+            Where to write it, by default filename
+
+        Raises
+        ------
+        TransferError
+            If the server refused or aborted the download.
+        OSError
+            If the file cannot be written or the connection fails.
+        """
+        local_path = local_path or filename
+        local_size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+        send_frame(sock, self.next_request_id(), OP_DOWNLOAD, pack_transfer(local_size, filename))
+        ack = recv_frame(sock)
+        if ack.opcode != OP_OK:
+            raise TransferError(ack.payload.decode())
+
+        start_pos, file_size = DOWNLOAD_REPLY.unpack(ack.payload)
+        start_time = time.time()
+        # One buffer for the whole transfer; writes this large bypass the
+        # file object's own buffer. The file only grows by received bytes,
+        # so after a crash its size is still a valid resume offset.
+        buffer = memoryview(bytearray(recv_chunk_size(sock)))
+        with open(local_path, "r+b" if start_pos else "wb") as f, self.progress.track(
+                f"Downloading {filename}", file_size, start_pos
+        ) as counter:
+            f.truncate(start_pos)
+            f.seek(start_pos)
+
+            size = file_size - start_pos
+            while size > 0:
+                n = sock.recv_into(buffer, min(len(buffer), size))
+                if not n:
+                    raise ConnectionError("Connection closed during download")
+                f.write(buffer[:n])
+                counter.done += n
+                size -= n
+
+        done = recv_frame(sock)
+        if done.opcode != OP_DONE:
+            raise TransferError(done.payload.decode())
+        return TransferStats(file_size, start_pos, time.time() - start_time)
+
     def download_file(self, sock: socket.socket, filename: str) -> None:
         """
         Downloads a file from the server.
 
+        Resumes from the size of an existing local copy if the server agrees.
+
         Parameters
         ----------
         sock : socket.socket
@@ -106,78 +621,75 @@ class TCPClient:
         filename : str
             The name of the file to download.
         """
-        sock.sendall(f"DOWNLOAD {filename}\n".encode())
-        ack: str = sock.recv(1024).decode().strip()
+        try:
+            stats = self.download(sock, filename)
+            self.console.log(f"[green]File {filename} downloaded ({stats.bitrate:.2f} MB/s)[/green]")
+        except TransferError as e:
+            self.console.log(f"[red]{e}")
 
-        mode = "wb"
-        start_pos = 0
-        if ack.startswith("RESUME"):
-            mode = "ab"
-            start_pos = int(ack.split()[1])
+    def execute(self, sock: socket.socket, command: str) -> bool:
+        """
+        Runs one line typed by the user.
+
+        Returns
+        -------
+        bool
+            True once the user has closed the session.
+        """
+        if command.upper() in ("CLOSE", "EXIT", "QUIT"):
+            self.send_command(sock, command)
+            return True
+
+        elif command.upper().startswith("UPLOAD"):
+            filename = command.split(" ", 1)[1] if " " in command else ""
+            self.upload_file(sock, filename)
+
+        elif command.upper().startswith("DOWNLOAD"):
+            filename = command.split(" ", 1)[1] if " " in command else ""
+            self.download_file(sock, filename)
 
-            if not os.path.exists(filename):
-                sock.sendall("NOT FOUND".encode())
-                mode = "wb"
-                start_pos = 0
-            else:
-                sock.sendall("FOUND".encode())
-
-            ack = sock.recv(1024).decode().strip()
-
-        if ack.startswith("READY"):
-            start_time = time.time()
-            with open(f"{filename}", mode) as f, Progress(
-                    "[blue]{task.description}",
-                    BarColumn(),
-                    TimeElapsedColumn(),
-                    TransferSpeedColumn(),
-                    "[bold blue]{task.percentage:.0f}%[/bold blue]"
-            ) as progress:
-
-                size_buf = size = int(ack.split()[1])
-                sock.sendall("size is got".encode())
-                task = progress.add_task(f"[cyan]Downloading {filename}...", total=size + start_pos)
-                progress.update(task, completed=start_pos)
-
-                while size > 0:
-                    chunk = sock.recv(1024)
-                    f.write(chunk)
-                    progress.update(task, advance=len(chunk))
-                    size -= len(chunk)
-
-            elapsed_time = time.time() - start_time
-            bitrate = size_buf / elapsed_time / 1024 / 1024
-            self.console.log(f"[green]File {filename} downloaded ({bitrate:.2f} MB/s)[/green]")
         else:
-            self.console.log("[red]File not found on server")
+            # "ECHO a; TIME; STAT f" pipelines all three requests
+            self.pipeline(sock, [c for c in command.split(";") if c.strip()])
+        return False
 
     def run(self) -> None:
         """
         Starts the client and handles user commands interactively.
+
+        A command cut off by a lost connection runs again once the client
+        has reconnected; transfers continue where they stopped, since the
+        server resumes uploads by token and downloads by local file size.
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect((self.server_host, self.server_port))
-            self.console.log(f"[green]Connected to {self.server_host}:{self.server_port}")
+        try:
+            sock = self.connect()
+        except (OSError, ProtocolError) as e:
+            self.console.log(f"[red]Server unavailable: {e}")
+            return
+        self.console.log(f"[green]Connected to {self.server_host}:{self.server_port}")
 
+        try:
             while True:
                 command = input("> ").strip()
                 if not command:
                     continue
 
-                if command.upper() == "CLOSE":
-                    self.send_command(sock, command)
+                while True:
+                    try:
+                        closed = self.execute(sock, command)
+                        break
+                    except (OSError, ProtocolError) as e:
+                        if not connection_lost(e) or command.upper() in ("CLOSE", "EXIT", "QUIT"):
+                            raise
+                        sock.close()
+                        sock = self.reconnect()
+                        self.console.log(f"[green]Reconnected, repeating: {command}")
+                if closed:
                     break
-
-                elif command.upper().startswith("UPLOAD"):
-                    filename = command.split(" ", 1)[1] if " " in command else ""
-                    self.upload_file(sock, filename)
-
-                elif command.upper().startswith("DOWNLOAD"):
-                    filename = command.split(" ", 1)[1] if " " in command else ""
-                    self.download_file(sock, filename)
-
-                else:
-                    self.send_command(sock, command)
+        except (OSError, ProtocolError) as e:
+            self.console.log(f"[red]Error: {e}")
+        finally:
+            sock.close()
 
 
 if __name__ == "__main__":
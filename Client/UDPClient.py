@@ -2,36 +2,90 @@ import socket
 import time
 import os
 import select
-from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, TransferSpeedColumn
-from rich.console import Console
+from digest_index import DigestIndex
+from progress import ProgressRenderer
+from resume_bitmap import SUFFIX as BITMAP_SUFFIX, PacketBitmap
+from terminal import Terminal
 from time import sleep
 
+# A silent server is retried after 1, 2, 4... seconds, at most RECONNECT_PERIOD
+# apart; every attempt resumes the transfer where the previous one stopped.
 RECONNECT_PERIOD = 10
 RECONNECT_ATTEMPTS = 6
+REPLY_TIMEOUT = 5  # seconds to wait for a reply before the server counts as gone
 BUFFER_SIZE = 1024
 RCV_BUFFER_SIZE = 16384
+CHECKPOINT_PACKETS = 4096  # received packets between two bitmap checkpoints
+RETRY_ATTEMPTS = 8
+# Shorter than the server's 1 s wait for an ACK: a RETRY repeated in time
+# stands in for the ACK of a lost retransmission and keeps the server going.
+RETRY_TIMEOUT = 0.25
 SIZE_FOR_WRITE = 32768
 SIZE_FOR_READ = 65536
+DIGEST_INDEX_FILE = ".digest_index.json"
 
-console = Console()
+console = Terminal()
+progress = ProgressRenderer(console, wait_on_finish=True)
 
 class UDPClient:
     def __init__(self, server_port, server_address):
         self.server_address = server_address
         self.server_port = server_port
         self.sock = self.initialize_sock()
+        self.digest_index = DigestIndex(DIGEST_INDEX_FILE)
 
     def initialize_sock(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUFFER_SIZE * SIZE_FOR_WRITE)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 425984)
+        sock.settimeout(REPLY_TIMEOUT)
         console.print(f"[bold green]Initialize completed (address: {self.server_address}, port: {self.server_port})[/bold green]")
         return sock
 
-    def wait(self):
-        ready_to_read, _, _ = select.select([self.sock], [], [], 1)
+    def wait(self, timeout=1):
+        ready_to_read, _, _ = select.select([self.sock], [], [], timeout)
         return ready_to_read
 
+    def drain(self):
+        """Drops datagrams left over from an interrupted exchange."""
+        while self.wait(0):
+            self.sock.recv(RCV_BUFFER_SIZE)
+
+    def with_resume(self, transfer, file_path):
+        """Runs an upload or download, starting it again while the server does not answer."""
+        delay = 1
+        for attempt in range(RECONNECT_ATTEMPTS + 1):
+            if attempt:
+                console.print(f"[bold yellow]Server is not responding, resuming in {delay} s (attempt {attempt}/{RECONNECT_ATTEMPTS})[/bold yellow]")
+                sleep(delay)
+                delay = min(RECONNECT_PERIOD, delay * 2)
+                self.drain()
+            try:
+                transfer(file_path)
+                return
+            except TimeoutError:
+                pass
+        console.print("[bold red]Server is not responding, try again later[/bold red]")
+
+    def transfer_address(self, reply):
+        """
+        Splits a DOWNLOAD or UPLOAD reply into its number and where the transfer runs.
+
+        The server moves every transfer to a port of its own and appends it
+        to the reply; servers that keep transfers on their main port do not.
+        """
+        value, _, port = reply.partition(" ")
+        return int(value), (self.server_address, int(port) if port else self.server_port)
+
+    def server_has(self, file_path, file_name):
+        # The digest comes from the local cache, so an unchanged file is not
+        # read again; if the server already stores the content under
+        # file_name, this one round trip replaces the upload.
+        digest = self.digest_index.digest(file_path)
+        self.digest_index.save()
+        self.sock.sendto(f"HAVE {file_name} {digest.hex()}".encode(), (self.server_address, self.server_port))
+        return self.sock.recv(BUFFER_SIZE).decode() == "1"
+
     def upload_command(self, file_path):
         if not os.path.exists(file_path):
             console.print("[bold red]No such file[/bold red]")
@@ -39,10 +93,13 @@ class UDPClient:
         file_name = os.path.basename(file_path)
         file_size = os.path.getsize(file_path)
         console.print(f"[bold blue]File size: {file_size} bytes[/bold blue]")
+        if self.server_has(file_path, file_name):
+            console.print(f"[bold green]File {file_name} is already on the server[/bold green]")
+            return
         upload_string = f"UPLOAD {file_name} {file_size}"
         console.print(f"[bold blue]Uploading file {file_name} to the server[/bold blue]")
         self.sock.sendto(upload_string.encode(), (self.server_address, self.server_port))
-        offset = int(self.sock.recv(BUFFER_SIZE).decode())
+        offset, address = self.transfer_address(self.sock.recv(BUFFER_SIZE).decode())
         console.print(f"[bold blue]Offset: {offset} bytes[/bold blue]")
         if offset == file_size:
             console.print(f"[bold green]File {file_name} has already been uploaded to the server[/bold green]")
@@ -59,15 +116,7 @@ class UDPClient:
             with open(file_path, "rb") as file:
                 file.seek(offset)
                 current_position = offset
-                with Progress(
-                    TextColumn("[progress.description]{task.description}"),
-                    BarColumn(),
-                    TextColumn("[progress.percentage]{task.percentage:>3.1f}%"),
-                    TimeElapsedColumn(),
-                    TransferSpeedColumn(),
-                    console=console,
-                ) as progress:
-                    task = progress.add_task("Uploading...", total=file_size - offset)
+                with progress.track("Uploading...", file_size - offset) as counter:
                     while True:
                         data = file.read(BUFFER_SIZE)
                         if not data:
@@ -75,13 +124,13 @@ class UDPClient:
                             break
                         start_upload_time = time.time()
                         packet = f"{packet_number}:{data.decode()}"
-                        self.sock.sendto(packet.encode(), (self.server_address, self.server_port))
+                        self.sock.sendto(packet.encode(), address)
                         end_upload_time = time.time()
                         send_time += (end_upload_time - start_upload_time)
                         packet_number += 1
                         current_position += len(data)
-                        progress.update(task, advance=len(data))
-                self.sock.sendto("FIN".encode(), (self.server_address, self.server_port))
+                        counter.done += len(data)
+                self.sock.sendto("FIN".encode(), address)
                 while True:
                     console.print("[bold blue]Waiting for ACK[/bold blue]")
                     data, _ = self.sock.recvfrom(BUFFER_SIZE)
@@ -94,14 +143,14 @@ class UDPClient:
                         file.seek(current_position)
                         data = file.read(BUFFER_SIZE)
                         packet = f"{ack}:{data.decode()}"
-                        self.sock.sendto(packet.encode(), (self.server_address, self.server_port))
+                        self.sock.sendto(packet.encode(), address)
                         sleep(0.07)
                         ack = self.sock.recv(BUFFER_SIZE).decode()
                         console.print(f"[bold blue]ACK from server: {ack}[/bold blue]")
                     if(ack.startswith("FIN_ACK")):
                         break
         finally:
-            self.sock.sendto("CTRL_C".encode(), (self.server_address, self.server_port))
+            self.sock.sendto("CTRL_C".encode(), address)
             console.print(f"[bold blue]Closing file {file_name}[/bold blue]")
             file.close()
         end_upload_time = time.time()
@@ -110,36 +159,35 @@ class UDPClient:
         console.print(f"\n[bold blue]Upload speed: {upload_speed} Kb/s[/bold blue]")
 
 
-    def check_missing_packets(self, received_packets, sequence_number):
-        missing_packets = []
-        for i in range(sequence_number, max(received_packets.keys()) + 1):
-            if i not in received_packets:
-                missing_packets.append(i)
-        console.print(f"[bold yellow]Missing packets: {missing_packets}[/bold yellow]")
-        return missing_packets
-
-    def retry_missing_packets(self, missing_packets, received_packets):
-        for i in missing_packets:
-            retry_message = f"RETRY:{i}"
-            console.print(f"[bold yellow]Retrying packet {i}[/bold yellow]")
-            self.sock.sendto(retry_message.encode(), (self.server_address, self.server_port))
-            data, _ = self.sock.recvfrom(BUFFER_SIZE)
-            sequence_number, data = data.split(b":", 1)
-            sequence_number = int(sequence_number.decode())
-            console.print(f"[bold yellow]Received packet {sequence_number}[/bold yellow]")
-            received_packets[sequence_number] = data
-            ack = f"ACK:{sequence_number}"
-            self.sock.sendto(ack.encode(), (self.server_address, self.server_port))
-        new_missing_packets = self.check_missing_packets(received_packets, sequence_number + 1)
-        if new_missing_packets:
-            console.print(f"[bold yellow]Retrying missing packets: {new_missing_packets}[/bold yellow]")
-            self.retry_missing_packets(new_missing_packets, received_packets)
-        return received_packets
+    def store_packet(self, fd, received, buffer, length, counter):
+        """Writes a "seq:data" datagram at its offset in the file; anything else is dropped."""
+        colon = buffer.find(b":", 0, min(length, 24))
+        try:
+            sequence_number = int(buffer[:colon]) if colon > 0 else -1
+        except ValueError:
+            return
+        if 0 <= sequence_number < received.packets and sequence_number not in received:
+            payload = memoryview(buffer)[colon + 1:length]
+            os.pwrite(fd, payload, sequence_number * BUFFER_SIZE)
+            received.add(sequence_number)
+            counter.done += len(payload)
+
+    def retry_packet(self, address, fd, received, packet, buffer, counter):
+        for _ in range(RETRY_ATTEMPTS):
+            self.sock.sendto(f"RETRY:{packet}".encode(), address)
+            # Late packets of the stream may still come first; keep them too.
+            while packet not in received and self.wait(RETRY_TIMEOUT):
+                length = self.sock.recv_into(buffer)
+                self.store_packet(fd, received, buffer, length, counter)
+            if packet in received:
+                self.sock.sendto(f"ACK:{packet}".encode(), address)
+                return
+        raise TimeoutError(f"Packet {packet} was not resent")
 
     def download_command(self, file_path):
         download_string = f"DOWNLOAD {file_path}"
         self.sock.sendto(download_string.encode(), (self.server_address, self.server_port))
-        file_size = int(self.sock.recv(BUFFER_SIZE).decode())
+        file_size, address = self.transfer_address(self.sock.recv(BUFFER_SIZE).decode())
         if file_size == 0:
             console.print("[bold red]No such file[/bold red]")
             return
@@ -148,76 +196,70 @@ class UDPClient:
         file_name = path_parts[-1]
         downloads_path = "./download_files"
         full_file_path = os.path.join(downloads_path, file_name)
+        bitmap_path = full_file_path + BITMAP_SUFFIX
         console.print(f"[bold blue]File size: {file_size} bytes[/bold blue]")
         console.print(f"[bold blue]Downloading file {file_name} from the server[/bold blue]")
         console.print(f"[bold blue]File path: {full_file_path}[/bold blue]")
-        if os.path.exists(full_file_path):
-            offset = os.path.getsize(full_file_path)
+
+        # Packets are written where they belong as they arrive, so only the
+        # bitmap checkpoint knows what is on disk. Without one, the file was
+        # either completed or written front to back by an older client.
+        received = PacketBitmap.load(bitmap_path, file_size, BUFFER_SIZE)
+        if received is None:
+            received = PacketBitmap(file_size, BUFFER_SIZE)
+            if os.path.exists(full_file_path):
+                local_size = min(os.path.getsize(full_file_path), file_size)
+                received.add_range(0, received.packets if local_size == file_size else local_size // BUFFER_SIZE)
+        if received.complete():
+            console.print(f"[bold green]File {file_name} has already been downloaded to the client[/bold green]")
+            self.sock.sendto(str(file_size).encode(), address)
+            return
+
+        first_packet = received.first_missing()
+        offset = first_packet * BUFFER_SIZE
+        if offset:
             downloadedPart = offset / file_size * 100
-            if offset < file_size:
-                console.print(f"[bold yellow]Part of this file has already been downloaded, downloading will continue from {downloadedPart}%[/bold yellow]")
-            else:
-                console.print(f"[bold green]File {file_name} has already been downloaded to the client[/bold green]")
-                return
-            mode = "ab"
-        else:
-            offset = 0
-            mode = "wb+"
+            console.print(f"[bold yellow]Part of this file has already been downloaded, downloading will continue from {downloadedPart}%[/bold yellow]")
         console.print(f"[bold blue]Offset: {offset} bytes[/bold blue]")
-        self.sock.sendto(str(offset).encode(), (self.server_address, self.server_port))
-        receive_packets = {}
-        sequence_number = -1
 
-        flag = True
+        os.makedirs(downloads_path, exist_ok=True)
+        received.save(bitmap_path)  # before the file can have holes
+        fd = os.open(full_file_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        buffer = bytearray(RCV_BUFFER_SIZE)
+        self.sock.sendto(str(offset).encode(), address)
         try:
-            with open(full_file_path, mode) as file:
-                file.seek(0, os.SEEK_END)
-                with Progress(
-                    TextColumn("[progress.description]{task.description}"),
-                    BarColumn(),
-                    TextColumn("[progress.percentage]{task.percentage:>3.1f}%"),
-                    TimeElapsedColumn(),
-                    TransferSpeedColumn(),
-                    console=console,
-                ) as progress:
-                    task = progress.add_task("Downloading...", total=file_size - offset)
-                    while self.wait():
-                        data = self.sock.recv(RCV_BUFFER_SIZE)
-                        if data == b"FIN":
-                            console.print(f"[bold green]File {file_name} has been downloaded to the client[/bold green]")
-                            missing_packets = self.check_missing_packets(receive_packets, sequence_number)
-                            if missing_packets:
-                                receive_packets = self.retry_missing_packets(missing_packets, receive_packets)
-                            console.print(f"[bold green]Writing file {file_name} and send FIN_ACK[/bold green]")
-                            self.sock.sendto(b"FIN_ACK", (self.server_address, self.server_port))
-                            flag = False
-                            break
-                        sequence_number, data = data.split(b":", 1)
-                        sequence_number = int(sequence_number.decode())
-                        receive_packets[sequence_number] = data
-                        offset = offset + len(data)
-                        progress.update(task, advance=len(data))
-                    for i in sorted(receive_packets.keys()):
-                        file.write(receive_packets[i])
+            done = min(received.count * BUFFER_SIZE, file_size)
+            with progress.track("Downloading...", file_size, done) as counter:
+                unsaved = 0
+                while self.wait():
+                    length = self.sock.recv_into(buffer)
+                    if buffer[:length] == b"FIN":
+                        break
+                    self.store_packet(fd, received, buffer, length, counter)
+                    unsaved += 1
+                    if unsaved >= CHECKPOINT_PACKETS:
+                        received.save(bitmap_path)
+                        unsaved = 0
+
+                missing = sum(1 for _ in received.missing(first_packet))
+                if missing:
+                    console.print(f"[bold yellow]Missing packets: {missing}[/bold yellow]")
+                for packet in received.missing(first_packet):
+                    self.retry_packet(address, fd, received, packet, buffer, counter)
+
+            os.ftruncate(fd, file_size)
+            self.sock.sendto(b"FIN_ACK", address)
+            os.remove(bitmap_path)
+            console.print(f"[bold green]File {file_name} has been downloaded to the client[/bold green]")
+        except TimeoutError:
+            raise
+        except (OSError, ValueError) as e:
+            console.print(f"[bold red]Error: {e}[/bold red]")
         finally:
-            try:
-                if flag:
-                    file = open(full_file_path, mode)
-                    console.print(f"[bold blue]Closing file {file_name}[/bold blue]")
-                    if receive_packets:
-                        x = -1
-                        for i in receive_packets.keys():
-                            console.print(f"[bold yellow]Writing packet {i}[/bold yellow]")
-                            if (i - 1 == x):
-                                file.write(receive_packets[i])
-                            else:
-                                break
-                            x = i
-                        receive_packets.clear()
-
-                    file.close()
-            except Exception as e:
-                console.print(f"[bold red]Error: {e}[/bold red]")
+            os.close(fd)
+            if not received.complete():
+                received.save(bitmap_path)
+                console.print(f"[bold yellow]Download of {file_name} interrupted, progress saved[/bold yellow]")
 
 class CommandHandler:
     def __init__(self, client):
@@ -252,25 +294,29 @@ class CommandHandler:
             first_word = key_command_arr[0].strip().upper()
             arguments = "" if len(key_command_arr) == 1 else key_command_arr[1].strip()
 
-            if first_word == "UPLOAD":
-                self.client.upload_command(arguments)
-            elif first_word == "DOWNLOAD":
-                self.client.download_command(arguments)
-            elif first_word == "TIME":
-                self.time_command()
-            elif first_word == "ECHO":
-                self.echo_command(arguments)
-            elif first_word == "QUIT" or first_word == "EXIT":
-                self.quit_command()
-            else:
-                console.print("[bold red]Unknown command, try again[/bold red]")
+            try:
+                if first_word == "UPLOAD":
+                    self.client.with_resume(self.client.upload_command, arguments)
+                elif first_word == "DOWNLOAD":
+                    self.client.with_resume(self.client.download_command, arguments)
+                elif first_word == "TIME":
+                    self.time_command()
+                elif first_word == "ECHO":
+                    self.echo_command(arguments)
+                elif first_word == "QUIT" or first_word == "EXIT":
+                    self.quit_command()
+                else:
+                    console.print("[bold red]Unknown command, try again[/bold red]")
+            except TimeoutError:
+                console.print("[bold red]Server is not responding[/bold red]")
+                self.client.drain()
             
         self.client.sock.close()
 
 
-def main():
+def main(server_address="192.168.1.107", server_port=None):
     try:
-        client = UDPClient(server_port = 12346, server_address="192.168.1.107")
+        client = UDPClient(server_port=server_port or 12346, server_address=server_address)
         command_handler = CommandHandler(client)
     except socket.error:
         console.print("[bold red]Connection error[/bold red]")
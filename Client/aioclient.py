@@ -0,0 +1,463 @@
+"""asyncio client for the framed TCP file servers (tcp_server and server3).
+
+For programs that drive the servers rather than people: nothing is printed
+and nothing is read from stdin::
+
+    async with await aioclient.connect("127.0.0.1", 12346) as client:
+        print(await client.echo("hi"), await client.time())
+        stats = await client.download("big.bin", progress=lambda done, total: ...)
+        results = await asyncio.gather(*(client.upload(p) for p in paths))
+
+A Client keeps a pool of up to ``max_connections`` connections. ECHO, TIME
+and STAT are pipelined: any number of them share a connection and their
+replies are matched by request id. A transfer owns its connection while it
+runs, since the raw file bytes are not framed; concurrent transfers open
+further connections up to the limit and then wait for one to come free.
+
+Transfers resume like the interactive client: a download continues after
+the bytes of an existing local file, an upload where the server stopped
+receiving for this client's token. Before an upload the server is asked
+whether it already has the content, by a digest from the same local cache
+the interactive client keeps; if so nothing is sent. A connection that
+fails is dropped from the pool and the operation raises; calling it again
+resumes.
+"""
+
+import asyncio
+import os
+import socket
+import time as _time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from protocol import (
+    DOWNLOAD_REPLY,
+    HEADER,
+    MAX_PAYLOAD,
+    OP_CLOSE,
+    OP_DONE,
+    OP_DOWNLOAD,
+    OP_ECHO,
+    OP_ERROR,
+    OP_HAVE,
+    OP_HELLO,
+    OP_OK,
+    OP_STAT,
+    OP_TIME,
+    OP_UPLOAD,
+    STAT_REPLY,
+    TIME_REPLY,
+    TRANSFER,
+    Frame,
+    ProtocolError,
+    encode_frame,
+    pack_have,
+    pack_transfer,
+    pack_upload,
+)
+from digest_index import SAVE_INTERVAL, DigestIndex
+from TCPClient import (
+    DIGEST_INDEX_FILE,
+    SENDFILE_SLICE,
+    TransferError,
+    TransferStats,
+    configure_socket,
+    load_client_token,
+)
+
+DEFAULT_MAX_CONNECTIONS = 8
+RECV_CHUNK = 256 * 1024
+CLOSE_TIMEOUT = 2.0
+
+Progress = Callable[[int, int], None]  # (bytes done, total bytes)
+
+
+class Connection:
+    """
+    One connection of the pool.
+
+    Requests are written as they come; whichever caller is waiting reads
+    the next reply and hands it to the request it belongs to, so no reader
+    task is needed and a transfer can take the stream over.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.last_request_id = 0
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.read_lock = asyncio.Lock()
+        self.transferring = False
+        self.error: Optional[BaseException] = None
+
+    @classmethod
+    async def open(cls, host: str, port: int, token: str) -> "Connection":
+        reader, writer = await asyncio.open_connection(host, port)
+        sock = writer.get_extra_info("socket")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        configure_socket(sock)
+        connection = cls(reader, writer)
+        try:
+            await connection.request(OP_HELLO, token.encode())
+        except BaseException:
+            writer.close()
+            raise
+        return connection
+
+    @property
+    def usable(self) -> bool:
+        return self.error is None and not self.writer.is_closing()
+
+    def next_request_id(self) -> int:
+        self.last_request_id = (self.last_request_id + 1) & 0xFFFFFFFF
+        return self.last_request_id
+
+    async def send(self, request_id: int, opcode: int, payload: bytes = b"") -> None:
+        self.writer.write(encode_frame(request_id, opcode, payload))
+        await self.writer.drain()
+
+    async def read_frame(self) -> Frame:
+        try:
+            length, request_id, opcode = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+            if length > MAX_PAYLOAD:
+                raise ProtocolError(f"Payload too large: {length} bytes")
+            payload = await self.reader.readexactly(length) if length else b""
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed by peer") from None
+        return Frame(request_id, opcode, payload)
+
+    async def request(self, opcode: int, payload: bytes = b"") -> Frame:
+        """Sends a request and waits for its reply, whatever else is in flight."""
+        if self.error is not None:
+            raise self.error
+        request_id = self.next_request_id()
+        reply = asyncio.get_running_loop().create_future()
+        # Removed by whoever reads the reply: a cancelled caller leaves its
+        # entry behind until then, so no transfer takes the stream meanwhile.
+        self.pending[request_id] = reply
+        try:
+            await self.send(request_id, opcode, payload)
+            while not reply.done():
+                async with self.read_lock:
+                    if reply.done():
+                        break
+                    try:
+                        frame = await self.read_frame()
+                    except asyncio.CancelledError:
+                        # Part of a frame may have been consumed.
+                        self.fail(ConnectionError("Request cancelled while reading a reply"))
+                        raise
+                    waiter = self.pending.pop(frame.request_id, None)
+                    if waiter is None:
+                        raise ProtocolError(f"Reply to unknown request #{frame.request_id}")
+                    if not waiter.done():
+                        waiter.set_result(frame)
+        except (OSError, ProtocolError) as e:
+            self.fail(e)
+            raise
+        return reply.result()
+
+    def fail(self, error: BaseException) -> None:
+        """Marks the connection dead and fails every request still waiting on it."""
+        self.error = error
+        for waiter in self.pending.values():
+            if not waiter.done():
+                waiter.set_exception(error)
+                # Marked as retrieved: the request of a cancelled caller
+                # never reads its future; a live one still gets the error.
+                waiter.exception()
+        self.writer.close()
+
+    async def close(self) -> None:
+        if self.usable:
+            try:
+                await asyncio.wait_for(self.request(OP_CLOSE), CLOSE_TIMEOUT)
+            except (OSError, ProtocolError, asyncio.TimeoutError):
+                pass
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+def _reply_payload(frame: Frame, expected: int = OP_OK) -> bytes:
+    if frame.opcode == OP_ERROR:
+        raise TransferError(frame.payload.decode())
+    if frame.opcode != expected:
+        raise ProtocolError(f"Unexpected reply opcode {frame.opcode:#x}")
+    return frame.payload
+
+
+class Client:
+    """
+    A pool of connections to one server; see ``connect``.
+
+    Parameters
+    ----------
+    host : str
+        The address of the server.
+    port : int
+        The port of the server.
+    token : str
+        Identifies the client to the server, which resumes uploads by it.
+    max_connections : int, optional
+        Upper bound on open connections, by default DEFAULT_MAX_CONNECTIONS
+    """
+
+    def __init__(self, host: str, port: int, token: str, max_connections: int = DEFAULT_MAX_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.max_connections = max(1, max_connections)
+        self.connections: List[Connection] = []
+        self.opening = 0
+        self.changed = asyncio.Condition()
+        self.closed = False
+        self.digest_index = DigestIndex(DIGEST_INDEX_FILE)
+
+    async def __aenter__(self) -> "Client":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def _open(self) -> Connection:
+        """Opens a connection; the caller has reserved the slot in ``opening``."""
+        try:
+            connection = await Connection.open(self.host, self.port, self.token)
+        finally:
+            self.opening -= 1
+        self.connections.append(connection)
+        return connection
+
+    async def _acquire(self, exclusive: bool) -> Connection:
+        """
+        A connection for one operation.
+
+        Requests share the least loaded connection that is not transferring;
+        a transfer needs one nobody else is using and marks it as taken.
+        """
+        async with self.changed:
+            while True:
+                if self.closed:
+                    raise ConnectionError("Client is closed")
+                self.connections = [c for c in self.connections if c.usable]
+                free = [c for c in self.connections if not c.transferring and not (exclusive and c.pending)]
+                if free:
+                    connection = min(free, key=lambda c: len(c.pending))
+                    connection.transferring = exclusive
+                    return connection
+                if len(self.connections) + self.opening < self.max_connections:
+                    self.opening += 1
+                    break
+                await self.changed.wait()
+
+        try:
+            connection = await self._open()
+            connection.transferring = exclusive
+            return connection
+        finally:
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def _release(self, connection: Connection) -> None:
+        connection.transferring = False
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def _request(self, opcode: int, payload: bytes = b"") -> Frame:
+        connection = await self._acquire(exclusive=False)
+        try:
+            return await connection.request(opcode, payload)
+        finally:
+            if not connection.pending:
+                # A transfer may be waiting for this connection to go quiet.
+                async with self.changed:
+                    self.changed.notify_all()
+
+    async def echo(self, text: str) -> str:
+        return _reply_payload(await self._request(OP_ECHO, text.encode())).decode()
+
+    async def time(self) -> float:
+        """The server clock, in seconds since the epoch."""
+        (timestamp,) = TIME_REPLY.unpack(_reply_payload(await self._request(OP_TIME)))
+        return timestamp
+
+    async def stat(self, name: str) -> Optional[Tuple[int, float]]:
+        """Size and mtime of a file on the server, or None if it has none."""
+        frame = await self._request(OP_STAT, name.encode())
+        if frame.opcode == OP_ERROR:
+            return None
+        return STAT_REPLY.unpack(_reply_payload(frame))
+
+    async def have(self, digest: bytes, name: str) -> bool:
+        """Asks the server to store content it already has under ``name``; True if it did."""
+        return (await self._request(OP_HAVE, pack_have(digest, name))).opcode == OP_OK
+
+    async def upload(self, path: str, remote_name: Optional[str] = None, progress: Optional[Progress] = None) -> TransferStats:
+        """
+        Uploads a local file.
+
+        Parameters
+        ----------
+        path : str
+            The local file.
+        remote_name : str, optional
+            The name on the server, by default the base name of ``path``
+        progress : Callable[[int, int], None], optional
+            Called with (bytes done, total) as the upload advances.
+
+        Raises
+        ------
+        TransferError
+            If the server refused or aborted the upload.
+        """
+        st = os.stat(path)
+        name = remote_name or os.path.basename(path)
+        started = _time.perf_counter()
+        # Hashing reads the file unless the cache knows it; keep it off the loop.
+        digest = await asyncio.get_running_loop().run_in_executor(None, self.digest_index.digest, path, st)
+        self.digest_index.save(SAVE_INTERVAL)
+        if await self.have(digest, name):
+            if progress:
+                progress(st.st_size, st.st_size)
+            return TransferStats(st.st_size, st.st_size, _time.perf_counter() - started, deduplicated=True)
+
+        connection = await self._acquire(exclusive=True)
+        try:
+            return await self._upload(connection, path, st, name, progress)
+        except TransferError:
+            raise  # an ERROR frame leaves the stream in step
+        except BaseException as e:
+            # Anything else, cancellation included, may strike mid-stream.
+            connection.fail(e if isinstance(e, Exception) else ConnectionError("Transfer cancelled"))
+            raise
+        finally:
+            await self._release(connection)
+
+    async def _upload(self, connection: Connection, path: str, st: os.stat_result, name: str, progress: Optional[Progress]) -> TransferStats:
+        started = _time.perf_counter()
+        request_id = connection.next_request_id()
+        await connection.send(request_id, OP_UPLOAD, pack_upload(st.st_size, st.st_mtime_ns, name))
+        (offset,) = TRANSFER.unpack(_reply_payload(await connection.read_frame()))
+
+        loop = asyncio.get_running_loop()
+        with open(path, "rb") as f:
+            position = offset
+            if progress:
+                progress(position, st.st_size)
+            while position < st.st_size:
+                # Zero-copy where the transport allows it; slices keep progress moving.
+                count = min(SENDFILE_SLICE, st.st_size - position)
+                sent = await loop.sendfile(connection.writer.transport, f, position, count)
+                if not sent:
+                    raise ValueError(f"File {path} shrank during upload")
+                position += sent
+                if progress:
+                    progress(position, st.st_size)
+
+        _reply_payload(await connection.read_frame(), OP_DONE)
+        return TransferStats(st.st_size, offset, _time.perf_counter() - started)
+
+    async def download(self, name: str, local_path: Optional[str] = None, progress: Optional[Progress] = None) -> TransferStats:
+        """
+        Downloads a file, resuming after the bytes of an existing local copy.
+
+        Parameters
+        ----------
+        name : str
+            The name on the server.
+        local_path : str, optional
+            Where to write it, by default the base name of ``name``
+        progress : Callable[[int, int], None], optional
+            Called with (bytes done, total) as the download advances.
+
+        Raises
+        ------
+        TransferError
+            If the server refused or aborted the download.
+        """
+        local_path = local_path or os.path.basename(name)
+        connection = await self._acquire(exclusive=True)
+        try:
+            return await self._download(connection, name, local_path, progress)
+        except TransferError:
+            raise  # an ERROR frame leaves the stream in step
+        except BaseException as e:
+            # Anything else, cancellation included, may strike mid-stream.
+            connection.fail(e if isinstance(e, Exception) else ConnectionError("Transfer cancelled"))
+            raise
+        finally:
+            await self._release(connection)
+
+    async def _download(self, connection: Connection, name: str, local_path: str, progress: Optional[Progress]) -> TransferStats:
+        started = _time.perf_counter()
+        local_size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+        request_id = connection.next_request_id()
+        await connection.send(request_id, OP_DOWNLOAD, pack_transfer(local_size, name))
+        frame = await connection.read_frame()
+        if frame.opcode == OP_ERROR:
+            # Nothing follows a refusal, so the connection stays usable.
+            raise TransferError(frame.payload.decode())
+        start, size = DOWNLOAD_REPLY.unpack(_reply_payload(frame))
+
+        with open(local_path, "r+b" if start else "wb") as f:
+            f.truncate(start)
+            f.seek(start)
+            done = start
+            if progress:
+                progress(done, size)
+            while done < size:
+                data = await connection.reader.read(min(RECV_CHUNK, size - done))
+                if not data:
+                    raise ConnectionError("Connection closed during download")
+                # Page-cache writes; the file only grows by received bytes,
+                # so its size stays a valid resume offset.
+                f.write(data)
+                done += len(data)
+                if progress:
+                    progress(done, size)
+
+        _reply_payload(await connection.read_frame(), OP_DONE)
+        return TransferStats(size, start, _time.perf_counter() - started)
+
+    async def close(self) -> None:
+        """Says goodbye on every connection and closes them."""
+        async with self.changed:
+            self.closed = True
+            connections, self.connections = self.connections, []
+            self.changed.notify_all()
+        self.digest_index.save()
+        await asyncio.gather(*(c.close() for c in connections), return_exceptions=True)
+
+
+async def connect(
+    host: str,
+    port: int,
+    token: Optional[str] = None,
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+) -> Client:
+    """
+    Connects to a framed TCP server.
+
+    Parameters
+    ----------
+    host : str
+        The address of the server.
+    port : int
+        The port of the server.
+    token : str, optional
+        The client token, by default the one in .client_token (see
+        TCPClient.load_client_token); uploads resume only under the same token.
+    max_connections : int, optional
+        Upper bound on open connections, by default DEFAULT_MAX_CONNECTIONS
+
+    Returns
+    -------
+    Client
+        With one connection already open, so a wrong address fails here.
+    """
+    client = Client(host, port, token or load_client_token(), max_connections)
+    client.opening += 1
+    await client._open()
+    return client
@@ -0,0 +1,335 @@
+"""Non-interactive transfers for scripts, cron and CI.
+
+``client.py get|put|sync|bench`` run a list of transfers against the TCP
+server, up to ``--jobs`` at a time. Every worker thread keeps its own
+connection, so a long list costs one handshake per worker rather than per
+file. Transfers come from the command line and/or a list file (``-i FILE``,
+``-i -`` for stdin) with one ``SOURCE [DEST]`` per line; blank lines and
+``#`` comments are skipped. Uploads are stored under the base name of the
+local file unless DEST says otherwise.
+
+``sync`` uploads a directory tree. Both sides keep a digest index of their
+files (see digest_index.py), so the client diffs its own manifest against
+the one the server sends for ``--prefix`` and uploads only new or changed
+files; an unchanged tree costs a stat per file and a single request.
+Against a server without MANIFEST every file is checked with STAT instead.
+
+The result is a table, or with ``--json`` a single JSON document on
+stdout::
+
+    {"command": "get", "ok": 2, "failed": 1, "skipped": 0, "bytes": ...,
+     "seconds": ..., "mib_s": ..., "transfers": [
+        {"op": "get", "remote": "a.bin", "local": "a.bin", "status": "ok",
+         "size": ..., "start": ..., "bytes": ..., "seconds": ..., "mib_s": ...,
+         "retries": 0, "deduplicated": false, "error": null}, ...]}
+
+A dropped connection is re-established with exponential backoff and the
+transfer resumed; ``retries`` counts how often that happened. ``bytes``
+counts what the last attempt actually sent, so a resumed transfer reports
+only its tail. Uploads whose content the server already has are stored
+from its copy without sending a byte (``deduplicated``). The exit status
+is 1 if any transfer failed.
+"""
+
+import argparse
+import json
+import os
+import posixpath
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from progress import ProgressRenderer
+from protocol import ProtocolError
+from TCPClient import TCPClient, TransferError, TransferStats, backoff_delays, connection_lost
+
+
+class Job(NamedTuple):
+    op: str  # "get", "put" or "sync"
+    local: str
+    remote: str
+
+
+def read_transfer_list(path: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    Reads ``SOURCE [DEST]`` lines from a file, or from stdin for "-".
+
+    Returns
+    -------
+    List[Tuple[str, Optional[str]]]
+        (source, destination or None) in file order.
+    """
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        entries = []
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            source, _, destination = line.partition(" ")
+            entries.append((source, destination.strip() or None))
+        return entries
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def transfer_entries(args: argparse.Namespace) -> List[Tuple[str, Optional[str]]]:
+    entries = [(name, None) for name in args.names]
+    if args.input:
+        entries += read_transfer_list(args.input)
+    return entries
+
+
+def get_jobs(args: argparse.Namespace) -> List[Job]:
+    return [
+        Job("get", os.path.join(args.output_dir, local or remote), remote)
+        for remote, local in transfer_entries(args)
+    ]
+
+
+def put_jobs(args: argparse.Namespace) -> List[Job]:
+    return [Job("put", local, remote or os.path.basename(local)) for local, remote in transfer_entries(args)]
+
+
+def sync_jobs(args: argparse.Namespace, runner: "BatchRunner") -> Tuple[List[Job], int]:
+    """
+    The files under the directory that are missing or differ on the server.
+
+    Returns
+    -------
+    Tuple[List[Job], int]
+        The uploads, and the number of files found up to date.
+    """
+    files = runner.client.digest_index.manifest(args.directory)
+    try:
+        remote = runner.client.manifest(runner.connection(), args.prefix)
+    except (OSError, ProtocolError):
+        # The uploads retry and report the connection themselves.
+        runner.drop_connection()
+        remote = None
+    # Without a manifest every upload asks STAT first.
+    runner.check_remote = remote is None
+
+    jobs = []
+    for name, entry in sorted(files.items()):
+        known = remote.get(name) if remote is not None else None
+        if known is not None and known[0] == entry.size and known[2] == entry.digest:
+            continue
+        jobs.append(Job("sync", os.path.join(args.directory, name), posixpath.join(args.prefix, name)))
+    return jobs, len(files) - len(jobs)
+
+
+class BatchRunner:
+    """
+    Runs transfers on a pool of worker threads, one connection per worker.
+
+    Parameters
+    ----------
+    client : TCPClient
+        Does the actual transfers; shared by all workers.
+    jobs : int
+        Number of transfers in flight at once.
+    """
+
+    def __init__(self, client: TCPClient, jobs: int):
+        self.client = client
+        self.jobs = jobs
+        self.local = threading.local()
+        self.sockets: List[socket.socket] = []
+        self.lock = threading.Lock()
+        self.check_remote = True
+        self.dedupe = True
+
+    def connection(self) -> socket.socket:
+        """The connection of the calling worker, opened on first use."""
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = self.client.connect()
+            self.local.sock = sock
+            with self.lock:
+                self.sockets.append(sock)
+        return sock
+
+    def drop_connection(self) -> None:
+        """Closes a connection left in an unknown state; the next job reconnects."""
+        sock = getattr(self.local, "sock", None)
+        if sock is not None:
+            self.local.sock = None
+            with self.lock:
+                self.sockets.remove(sock)
+            sock.close()
+
+    def transfer(self, job: Job) -> Optional[TransferStats]:
+        """Runs one attempt of ``job``; None if sync found it up to date."""
+        sock = self.connection()
+        if job.op == "get":
+            directory = os.path.dirname(job.local)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            return self.client.download(sock, job.remote, job.local)
+        if job.op == "sync" and self.check_remote and self.up_to_date(sock, job):
+            return None
+        return self.client.upload(sock, job.local, job.remote, dedupe=self.dedupe)
+
+    def run_job(self, job: Job) -> Dict[str, Any]:
+        """
+        Runs ``job`` to completion, reconnecting with backoff when the
+        connection drops; each new attempt resumes where the last stopped.
+        """
+        result: Dict[str, Any] = {
+            "op": job.op,
+            "remote": job.remote,
+            "local": job.local,
+            "status": "ok",
+            "size": None,
+            "start": 0,
+            "bytes": 0,
+            "seconds": 0.0,
+            "mib_s": 0.0,
+            "retries": 0,
+            "deduplicated": False,
+            "error": None,
+        }
+        delays = backoff_delays()
+        while True:
+            try:
+                stats = self.transfer(job)
+                break
+            except TransferError as e:
+                # The server answered, so the connection is still in step.
+                result.update(status="error", error=str(e))
+                return result
+            except (OSError, ValueError, ProtocolError) as e:
+                self.drop_connection()
+                delay = next(delays, None) if connection_lost(e) else None
+                if delay is None:
+                    message = e.strerror if isinstance(e, OSError) and e.strerror else str(e)
+                    result.update(status="error", error=message or type(e).__name__)
+                    return result
+                result["retries"] += 1
+                time.sleep(delay)
+
+        if stats is None:
+            result.update(status="skipped", size=os.path.getsize(job.local))
+        else:
+            result.update(
+                size=stats.size,
+                start=stats.start,
+                bytes=stats.transferred,
+                seconds=round(stats.seconds, 6),
+                mib_s=round(stats.bitrate, 3),
+                deduplicated=stats.deduplicated,
+            )
+        return result
+
+    def up_to_date(self, sock: socket.socket, job: Job) -> bool:
+        """True if the server copy has the same size and is not older."""
+        remote = self.client.stat(sock, job.remote)
+        if remote is None:
+            return False
+        st = os.stat(job.local)
+        return remote[0] == st.st_size and remote[1] >= st.st_mtime
+
+    def run(self, jobs: Iterable[Job]) -> List[Dict[str, Any]]:
+        """Results in the order of ``jobs``."""
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="transfer") as pool:
+                return list(pool.map(self.run_job, jobs))
+        finally:
+            with self.lock:
+                for sock in self.sockets:
+                    sock.close()
+                self.sockets.clear()
+
+
+def summarize(command: str, results: List[Dict[str, Any]], seconds: float, unchanged: int = 0) -> Dict[str, Any]:
+    """``unchanged`` counts files skipped without a transfer entry, such as those a manifest showed up to date."""
+    total = sum(r["bytes"] for r in results)
+    return {
+        "command": command,
+        "ok": sum(r["status"] == "ok" for r in results),
+        "failed": sum(r["status"] == "error" for r in results),
+        "skipped": sum(r["status"] == "skipped" for r in results) + unchanged,
+        "bytes": total,
+        "seconds": round(seconds, 6),
+        "mib_s": round(total / seconds / 1024 ** 2, 3) if seconds else 0.0,
+        "transfers": results,
+    }
+
+
+def print_table(summary: Dict[str, Any], console) -> None:
+    for r in summary["transfers"]:
+        name = r["remote"] if r["op"] == "get" else r["local"]
+        if r["status"] == "error":
+            console.print(f"[red]{r['op']:<4} {name}: {r['error']}[/red]")
+        elif r["status"] == "skipped":
+            console.print(f"{r['op']:<4} {name}: up to date")
+        elif r["deduplicated"]:
+            console.print(f"{r['op']:<4} {name}: already on the server")
+        else:
+            resumed = f", resumed at {r['start']}" if r["start"] else ""
+            console.print(f"{r['op']:<4} {name}: {r['bytes']} bytes in {r['seconds']:.3f}s ({r['mib_s']:.2f} MiB/s{resumed})")
+    console.print(
+        f"[bold]{summary['ok']} ok, {summary['failed']} failed, {summary['skipped']} skipped: "
+        f"{summary['bytes']} bytes in {summary['seconds']:.3f}s ({summary['mib_s']:.2f} MiB/s)[/bold]"
+    )
+
+
+def bench_jobs(args: argparse.Namespace, scratch: str) -> List[Job]:
+    """``--repeat`` full transfers of every entry; downloads go to ``scratch`` so none resumes."""
+    entries = transfer_entries(args)
+    jobs = []
+    for run in range(args.repeat):
+        for source, destination in entries:
+            if args.put:
+                jobs.append(Job("put", source, destination or os.path.basename(source)))
+            else:
+                local = os.path.join(scratch, f"{run}-{len(jobs)}-{os.path.basename(source)}")
+                jobs.append(Job("get", local, source))
+    return jobs
+
+
+def run_batch(args: argparse.Namespace, client: TCPClient) -> int:
+    """
+    Runs the ``get``, ``put``, ``sync`` or ``bench`` subcommand.
+
+    Returns
+    -------
+    int
+        The exit status: 0 if every transfer succeeded or was skipped.
+    """
+    if args.json:
+        # stdout carries only the JSON document.
+        client.progress = ProgressRenderer(client.console, headless=True)
+
+    runner = BatchRunner(client, max(1, args.jobs))
+    # A benchmark times real transfers, not the server copying its own files.
+    runner.dedupe = args.command != "bench"
+    unchanged = 0
+    with tempfile.TemporaryDirectory(prefix="np-bench-") as scratch:
+        started = time.perf_counter()
+        if args.command == "get":
+            jobs = get_jobs(args)
+        elif args.command == "put":
+            jobs = put_jobs(args)
+        elif args.command == "sync":
+            jobs, unchanged = sync_jobs(args, runner)
+        else:
+            jobs = bench_jobs(args, scratch)
+
+        results = runner.run(jobs)
+        client.digest_index.save()
+        summary = summarize(args.command, results, time.perf_counter() - started, unchanged)
+
+    summary.update(host=client.server_host, port=client.server_port, jobs=runner.jobs)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print_table(summary, client.console)
+    return 1 if summary["failed"] else 0
@@ -1,21 +1,67 @@
 import argparse
-from UDPClient import main as udp_main
-from TCPClient import TCPClient
+import sys
+
+DEFAULT_HOST = "192.168.1.107"
+DEFAULT_PORT = 12346
+DEFAULT_JOBS = 4
+DEFAULT_REPEAT = 3
+
+
+def add_batch_commands(subparsers) -> None:
+    """Пакетные команды get, put, sync и bench; выполняет их batch.py."""
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS, help="Одновременных передач")
+    common.add_argument("--json", action="store_true", help="Вывести результаты одним JSON-документом")
+
+    listed = argparse.ArgumentParser(add_help=False, parents=[common])
+    listed.add_argument("names", nargs="*", help="Файлы для передачи")
+    listed.add_argument("-i", "--input", metavar="FILE", help="Строки 'ИСТОЧНИК [НАЗНАЧЕНИЕ]' из FILE ('-' для stdin)")
+
+    get = subparsers.add_parser("get", parents=[listed], help="Скачать файлы")
+    get.add_argument("-o", "--output-dir", default=".", help="Локальный каталог для скачанных файлов")
+
+    subparsers.add_parser("put", parents=[listed], help="Загрузить файлы")
+
+    sync = subparsers.add_parser("sync", parents=[common], help="Загрузить файлы дерева каталогов, которых нет на сервере или которые отличаются")
+    sync.add_argument("directory")
+    sync.add_argument("--prefix", default="", help="Каталог на сервере")
+
+    bench = subparsers.add_parser("bench", parents=[listed], help="Замерить повторные полные передачи")
+    bench.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Передач каждого файла")
+    bench.add_argument("--put", action="store_true", help="Загружать вместо скачивания")
+
 
 def main():
-    parser = argparse.ArgumentParser(description="Выбор клиента: TCP или UDP")
+    parser = argparse.ArgumentParser(
+        description="Клиент передачи файлов: интерактивный (--tcp/--udp) или пакетный (get, put, sync, bench)"
+    )
     parser.add_argument("--tcp", action="store_true", help="Запустить TCP клиента")
     parser.add_argument("--udp", action="store_true", help="Запустить UDP клиента")
-
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Адрес сервера")
+    parser.add_argument("--port", type=int, help=f"Порт сервера, для TCP по умолчанию {DEFAULT_PORT}")
+    add_batch_commands(parser.add_subparsers(dest="command", metavar="{get,put,sync,bench}"))
     args = parser.parse_args()
 
-    if args.tcp:
-        client = TCPClient("192.168.1.107", 12346)
+    # Only the chosen mode is imported, so --help and typos answer at once.
+    if args.command:
+        if args.udp:
+            parser.error("пакетные команды работают только по TCP")
+        from batch import run_batch
+        from TCPClient import TCPClient
+
+        client = TCPClient(args.host, args.port or DEFAULT_PORT)
+        sys.exit(run_batch(args, client))
+    elif args.tcp:
+        from TCPClient import TCPClient
+
+        client = TCPClient(args.host, args.port or DEFAULT_PORT)
         client.run()
     elif args.udp:
-        udp_main()
+        from UDPClient import main as udp_main
+
+        udp_main(args.host, args.port)
     else:
-        print("Укажите --tcp или --udp для выбора клиента.")
+        print("Укажите --tcp или --udp для выбора клиента, либо команду get, put, sync или bench.")
 
 if __name__ == "__main__":
     main()
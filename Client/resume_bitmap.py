@@ -0,0 +1,115 @@
+"""Which packets of a UDP transfer are already on disk.
+
+The receiving side (the client of a download, the server of an upload)
+writes every datagram at its offset in the destination file as it
+arrives, so the file is no longer filled front to back and its size says
+nothing about what is missing. A PacketBitmap keeps one bit per packet
+instead (128 KiB for a 1 GiB file) and is checkpointed next to the file
+as ``<file>.bitmap``::
+
+    "NPBM" | version u8 | file size u64 | packet size u32 | bits
+
+While the checkpoint exists the transfer is incomplete; it is removed once
+every packet has arrived.
+"""
+
+import os
+import struct
+from typing import Iterator, Optional
+
+MAGIC = b"NPBM"
+VERSION = 1
+HEADER = struct.Struct("<4sBQI")
+SUFFIX = ".bitmap"
+
+
+class PacketBitmap:
+    """
+    One bit per packet of a file.
+
+    Parameters
+    ----------
+    file_size : int
+        Size of the whole file in bytes.
+    packet_size : int
+        File bytes carried by every packet but the last.
+    """
+
+    def __init__(self, file_size: int, packet_size: int):
+        self.file_size = file_size
+        self.packet_size = packet_size
+        self.packets = -(-file_size // packet_size)
+        self.bits = bytearray(-(-self.packets // 8))
+        self.count = 0
+
+    def __contains__(self, packet: int) -> bool:
+        return bool(self.bits[packet >> 3] & (1 << (packet & 7)))
+
+    def add(self, packet: int) -> bool:
+        """Marks ``packet`` as received; False if it already was."""
+        mask = 1 << (packet & 7)
+        if self.bits[packet >> 3] & mask:
+            return False
+        self.bits[packet >> 3] |= mask
+        self.count += 1
+        return True
+
+    def add_range(self, start: int, stop: int) -> None:
+        for packet in range(start, stop):
+            self.add(packet)
+
+    def complete(self) -> bool:
+        return self.count == self.packets
+
+    def first_missing(self) -> int:
+        """The lowest packet not received yet, ``packets`` when none is missing."""
+        for index, byte in enumerate(self.bits):
+            if byte != 0xFF:
+                packet = index * 8
+                while packet in self:
+                    packet += 1
+                return min(packet, self.packets)
+        return self.packets
+
+    def missing(self, start: int = 0) -> Iterator[int]:
+        """Packets from ``start`` on that have not been received, in order."""
+        for packet in range(start, self.packets):
+            if not self.bits[packet >> 3] & (1 << (packet & 7)):
+                yield packet
+
+    def save(self, path: str) -> None:
+        """Writes the checkpoint atomically, so a crash leaves the old one intact."""
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.file_size, self.packet_size))
+            f.write(self.bits)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str, file_size: int, packet_size: int) -> Optional["PacketBitmap"]:
+        """
+        Reads a checkpoint written by ``save``.
+
+        Returns
+        -------
+        PacketBitmap or None
+            None if there is no usable checkpoint for a file of this size,
+            e.g. because the file changed on the server.
+        """
+        try:
+            with open(path, "rb") as f:
+                header = f.read(HEADER.size)
+                bits = f.read()
+        except OSError:
+            return None
+        if len(header) < HEADER.size:
+            return None
+        magic, version, saved_size, saved_packet_size = HEADER.unpack(header)
+        bitmap = cls(file_size, packet_size)
+        if (magic, version, saved_size, saved_packet_size) != (MAGIC, VERSION, file_size, packet_size):
+            return None
+        if len(bits) != len(bitmap.bits):
+            return None
+        bitmap.bits[:] = bits
+        bitmap.count = sum(bin(byte).count("1") for byte in bits)
+        return bitmap
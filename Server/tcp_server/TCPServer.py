@@ -1,23 +1,84 @@
-import datetime
+import argparse
+import hashlib
 import os
+import signal
 import socket
 import threading
 import time
-from typing import Dict, List, Tuple
-
-from rich.progress import (
-    BarColumn,
-    Console,
-    Progress,
-    TimeElapsedColumn,
-    TransferSpeedColumn,
+from typing import List, Optional, Tuple
+
+
+from protocol import (
+    CHUNK_SIZE,
+    DOWNLOAD_REPLY,
+    OP_CHUNKS,
+    OP_CLOSE,
+    OP_DONE,
+    OP_DOWNLOAD,
+    OP_ECHO,
+    OP_HAVE,
+    OP_ERROR,
+    OP_HELLO,
+    OP_MANIFEST,
+    OP_NAMES,
+    OP_OK,
+    OP_STAT,
+    OP_TIME,
+    OP_UPLOAD,
+    STAT_REPLY,
+    TIME_REPLY,
+    TRANSFER,
+    Frame,
+    ProtocolError,
+    recv_exact,
+    recv_frame,
+    pack_indexes,
+    pack_manifest,
+    send_frame,
+    unpack_chunked_upload,
+    unpack_have,
+    unpack_transfer,
+    unpack_upload,
 )
+from metrics import (
+    ACTIVE_SESSIONS,
+    BYTES_IN,
+    BYTES_OUT,
+    COMMAND_LATENCY,
+    QUEUE_DEPTH,
+    TRANSFERS_ABORTED,
+    TRANSFERS_COMPLETED,
+    TRANSFERS_STARTED,
+    start_http_server,
+)
+from prefork import SharedStats, Supervisor, WorkerStats, reuseport_listener
+from profiling import Profiler
+from progress import ProgressRenderer
+from terminal import Terminal
+from resume_index import ResumeIndex
+from digest_index import SAVE_INTERVAL, DigestIndex
+from chunk_store import ChunkStore, StoreError, chunk_count, chunk_length
+
+console = Terminal()
+progress = ProgressRenderer(console)
 
-console = Console()
+RESUME_INDEX_PATH = "resume_index.log"
+DIGEST_INDEX_PATH = "digest_index.json"
+RESUME_CHECKPOINT = 4 * 1024 * 1024  # bytes between persisted progress records
+METRICS_PORT = 9346
+
+Response = Tuple[int, bytes]
 
 
 class TCPServer:
-    def __init__(self, host: str = "0.0.0.0", port: int = 12346):
+    def __init__(
+        self,
+        host: str = "0.0.0.0",
+        port: int = 12346,
+        stats: Optional[WorkerStats] = None,
+        metrics_port: int = 0,
+        store: Optional[str] = None,
+    ):
         """
         Initialize the TCP server with given host and port.
 
@@ -27,32 +88,79 @@ class TCPServer:
             The IP address to bind the server to, by default "0.0.0.0"
         port : int, optional
             The port number to listen on, by default 12346
+        stats : WorkerStats, optional
+            Counters shared with the pre-fork supervisor. When given, the
+            server runs as one of several workers listening on the same port.
+        metrics_port : int, optional
+            Serve Prometheus metrics on 127.0.0.1:metrics_port, by default off.
+        store : str, optional
+            Keep files in a deduplicating chunk store in this directory
+            (see chunk_store.py) instead of as plain files, by default off.
         """
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.prefork = stats is not None
+        self.stats = stats if stats is not None else SharedStats().worker(0)
+        self.metrics_port = metrics_port
+        self.server_socket: Optional[socket.socket] = None
 
-        self.interrupted_downloads: Dict[str, str | int] = dict()
+        self.resume_index = ResumeIndex(RESUME_INDEX_PATH)
+        self.digest_index = DigestIndex(DIGEST_INDEX_PATH)
+        self.store = ChunkStore(store) if store else None
 
     def start(self) -> None:
         """
         Starts the server and begins listening for connections.
+
+        As a pre-fork worker the server stops accepting on SIGTERM; the
+        supervisor then waits for the running client threads to finish.
+        SIGUSR2 toggles a profiling window (see profiling.py).
         """
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        if self.prefork:
+            self.server_socket = reuseport_listener(self.host, self.port)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(5)
         console.log(
-            f"[bold green]Server started on {self.host}:{self.port}[/bold green]"
+            f"[bold green]Server {os.getpid()} started on {self.host}:{self.port}[/bold green]"
         )
+        Profiler(
+            "tcp_server",
+            focus=(
+                "process_command",
+                "_handle_upload_file",
+                "_send_file_chunks",
+                "_handle_chunked_upload",
+                "_handle_manifest",
+            ),
+            report=console.log,
+        ).install()
+        if self.metrics_port:
+            start_http_server(self.metrics_port)
+            QUEUE_DEPTH.set_function(lambda: threading.active_count() - 1, queue="threads")
+            console.log(f"[green]Metrics on http://127.0.0.1:{self.metrics_port}/metrics[/green]")
 
-        while True:
-            client_socket, addr = self.server_socket.accept()
-            console.log(f"[cyan]New connection from {addr}[/cyan]")
-
-            threading.Thread(
-                target=self.handle_client, args=(client_socket, addr)
-            ).start()
+        try:
+            while True:
+                client_socket, addr = self.server_socket.accept()
+                client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                # The DONE frame after a file's raw bytes must not wait for
+                # the client's delayed ACK.
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                console.log(f"[cyan]New connection from {addr}[/cyan]")
+                self.stats.add("accepted")
+                self.stats.add("active")
+                ACTIVE_SESSIONS.inc()
+
+                threading.Thread(
+                    target=self.handle_client, args=(client_socket, addr)
+                ).start()
+        finally:
+            self.server_socket.close()
+            self.digest_index.save()
 
     def handle_client(
         self, client_socket: socket.socket, addr: Tuple[str, int]
@@ -67,114 +175,443 @@ class TCPServer:
         addr : tuple
             The client address (IP, port).
         """
+        token = addr[0]  # until the client introduces itself with HELLO
         with client_socket:
             while True:
                 try:
-                    data = client_socket.recv(1024).decode().strip()
-                    if not data:
-                        break
-
-                    console.log(f"[blue]{addr} -> {data}[/blue]")
-                    command = data.split(" ", 1)
-                    response = self.process_command(command, client_socket)
+                    frame = recv_frame(client_socket)
+                    self.stats.add("requests")
+                    console.log(
+                        f"[blue]{addr} -> {OP_NAMES.get(frame.opcode, frame.opcode)} "
+                        f"#{frame.request_id}[/blue]"
+                    )
+                    if frame.opcode == OP_HELLO and frame.payload:
+                        token = frame.payload.decode()
+                    started = time.perf_counter()
+                    response = self.process_command(frame, client_socket, token)
+                    COMMAND_LATENCY.observe(
+                        time.perf_counter() - started,
+                        command=OP_NAMES.get(frame.opcode, "UNKNOWN"),
+                    )
 
                     if response:
-                        client_socket.sendall(response.encode())
-                except Exception as e:
+                        send_frame(client_socket, frame.request_id, *response)
+                    if frame.opcode == OP_CLOSE:
+                        break
+                except ConnectionError:
+                    break
+                except (ProtocolError, OSError) as e:
                     console.log(f"[red]Error with {addr}: {e}[/red]")
                     break
 
+        self.stats.add("active", -1)
+        ACTIVE_SESSIONS.dec()
         console.log(f"[magenta]Disconnected {addr}[/magenta]")
 
-    def process_command(self, command: List[str], client_socket: socket.socket) -> str:
+    def process_command(
+        self, frame: Frame, client_socket: socket.socket, token: str
+    ) -> Optional[Response]:
         """
-        Processes client commands and returns a response.
+        Processes a client request frame and returns the response.
 
         Parameters
         ----------
-        command : list
-            A list containing the command and its arguments.
+        frame : Frame
+            The decoded request.
         client_socket : socket.socket
             The socket object representing the client connection.
+        token : str
+            Identifies the client across reconnects in the resume index.
 
         Returns
         -------
-        str
-            The response message to be sent back to the client.
+        Optional[Tuple[int, bytes]]
+            The response opcode and payload to be sent back to the client.
         """
-        cmd: str = command[0].upper()
-        arg: str = command[1] if len(command) > 1 else ""
+        if frame.opcode == OP_ECHO:
+            return OP_OK, frame.payload
 
-        if cmd == "ECHO":
-            return f"ECHO: {arg}\n"
+        elif frame.opcode == OP_TIME:
+            return OP_OK, TIME_REPLY.pack(time.time())
 
-        elif cmd == "TIME":
-            return f"TIME: {datetime.datetime.now()}\n"
+        elif frame.opcode == OP_STAT:
+            return self._handle_stat(frame.payload.decode())
 
-        elif cmd in ("CLOSE", "EXIT", "QUIT"):
-            return "Connection closed\n"
-        elif cmd == "UPLOAD":
-            return self._handle_upload_file(client_socket, arg)
+        elif frame.opcode == OP_CLOSE:
+            return OP_OK, b"Connection closed"
 
-        elif cmd == "DOWNLOAD":
-            return self._handle_download_file(client_socket, arg)
+        elif frame.opcode == OP_HELLO:
+            return OP_OK, b""
+
+        elif frame.opcode == OP_UPLOAD:
+            filesize, mtime_ns, filename = unpack_upload(frame.payload)
+            return self._handle_upload_file(
+                client_socket, frame, token, filename, filesize, mtime_ns
+            )
+
+        elif frame.opcode == OP_DOWNLOAD:
+            offset, filename = unpack_transfer(frame.payload)
+            return self._handle_download_file(
+                client_socket, frame, token, filename, offset
+            )
+
+        elif frame.opcode == OP_CHUNKS:
+            filesize, mtime_ns, digests, filename = unpack_chunked_upload(frame.payload)
+            return self._handle_chunked_upload(
+                client_socket, frame, filename, filesize, mtime_ns, digests
+            )
+
+        elif frame.opcode == OP_HAVE:
+            digest, filename = unpack_have(frame.payload)
+            return self._handle_have(filename, digest)
+
+        elif frame.opcode == OP_MANIFEST:
+            return self._handle_manifest(client_socket, frame, frame.payload.decode())
 
         else:
-            return "Unknown command\n"
+            return OP_ERROR, b"Unknown command"
+
+    def _handle_stat(self, filename: str) -> Response:
+        """
+        Returns size and modification time of a file.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file.
+
+        Returns
+        -------
+        Tuple[int, bytes]
+            OK with STAT_REPLY, or ERROR if the file does not exist or
+            the name is outside the server root.
+        """
+        if self._outside_root(filename):
+            return OP_ERROR, b"Invalid filename"
+        if self.store:
+            recipe = self.store.recipe(filename)
+            if recipe is None:
+                return OP_ERROR, b"File not found"
+            return OP_OK, STAT_REPLY.pack(recipe.size, recipe.mtime_ns / 1e9)
+
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return OP_ERROR, b"File not found"
+        return OP_OK, STAT_REPLY.pack(st.st_size, st.st_mtime)
+
+    @staticmethod
+    def _outside_root(path: str) -> bool:
+        """True if a client-supplied relative path could leave the server root."""
+        return os.path.isabs(path) or ".." in path.split("/")
+
+    def _make_parent(self, filename: str) -> Optional[Response]:
+        """Creates the directory of ``filename``; an ERROR response if that fails."""
+        directory = os.path.dirname(filename)
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                return OP_ERROR, f"Cannot create {directory}: {e.strerror}".encode()
+        return None
+
+    def _handle_have(self, filename: str, digest: bytes) -> Response:
+        """
+        Stores content the server already has under a new name.
+
+        The digest index knows every file the server received or listed. A
+        client asks before uploading, so a repeated upload of the same
+        bytes costs one round trip and a local copy instead of a transfer.
+
+        Parameters
+        ----------
+        filename : str
+            The name the client would upload to.
+        digest : bytes
+            SHA-256 of the client's file.
 
-    def _handle_upload_file(self, client_socket: socket.socket, filename: str) -> str:
+        Returns
+        -------
+        Tuple[int, bytes]
+            OK if ``filename`` now has that content, ERROR otherwise.
+        """
+        if not filename:
+            return OP_ERROR, b"Error: No filename provided"
+        if self._outside_root(filename):
+            return OP_ERROR, b"Invalid filename"
+        if self.store:
+            source = self.store.lookup(digest)
+            if source is None or not self.store.copy(source, filename):
+                return OP_ERROR, b"Unknown digest"
+            console.log(f"[bold green]File {filename} already stored, not uploaded[/bold green]")
+            return OP_OK, b"Already stored"
+
+        error = self._make_parent(filename)
+        if error:
+            return error
+        if not self.digest_index.copy_to(digest, filename):
+            return OP_ERROR, b"Unknown digest"
+
+        self.digest_index.save(SAVE_INTERVAL)
+        console.log(f"[bold green]File {filename} already stored, not uploaded[/bold green]")
+        return OP_OK, b"Already stored"
+
+    def _handle_manifest(
+        self, client_socket: socket.socket, frame: Frame, directory: str
+    ) -> Response:
+        """
+        Sends size, mtime and digest of every file under a directory.
+
+        Digests come from the digest index, so only files that changed since
+        the last manifest are read. A directory that does not exist yet has
+        an empty manifest.
+
+        Parameters
+        ----------
+        client_socket : socket.socket
+            The socket object representing the client connection.
+        frame : Frame
+            The MANIFEST request.
+        directory : str
+            Relative path of the directory, empty for the server root.
+
+        Returns
+        -------
+        Tuple[int, bytes]
+            DONE after the OK frames with the entries, or ERROR for a path
+            outside the server root.
+        """
+        if self._outside_root(directory):
+            return OP_ERROR, b"Invalid directory"
+
+        root = directory or "."
+        if self.store:
+            files = self.store.manifest(directory)
+        else:
+            files = self.digest_index.manifest(root) if os.path.isdir(root) else {}
+            self.digest_index.save()
+        entries = ((name, e.size, e.mtime_ns, e.digest) for name, e in sorted(files.items()))
+        for payload in pack_manifest(entries):
+            send_frame(client_socket, frame.request_id, OP_OK, payload)
+        console.log(f"[bold blue]Manifest of {root}: {len(files)} files[/bold blue]")
+        return OP_DONE, f"{len(files)} files".encode()
+
+    def _handle_upload_file(
+        self,
+        client_socket: socket.socket,
+        frame: Frame,
+        token: str,
+        filename: str,
+        filesize: int,
+        mtime_ns: int,
+    ) -> Response:
         """
         Handles file upload command.
 
+        A previously interrupted upload of the same source file (same size
+        and modification time) by the same client continues where the
+        resume index says it stopped.
+
         Parameters
         ----------
         client_socket : socket.socket
             The socket object representing the client connection.
+        frame : Frame
+            The UPLOAD request.
+        token : str
+            The client token.
         filename : str
             The name of the file to be uploaded.
+        filesize : int
+            The size of the file announced by the client.
+        mtime_ns : int
+            The modification time of the client's copy.
 
         Returns
         -------
-        str
-            A response message indicating the success or failure of the operation.
+        Tuple[int, bytes]
+            A response indicating the success or failure of the operation.
         """
         if not filename:
-            return "Error: No filename provided\n"
+            return OP_ERROR, b"Error: No filename provided"
+        if self._outside_root(filename):
+            return OP_ERROR, b"Invalid filename"
+
+        if self.store:
+            # Received whole into the staging area, then chunked.
+            path = self.store.staging_path(token, filename)
+        else:
+            path = filename
+            error = self._make_parent(filename)
+            if error:
+                return error
+
+        identity = f"{filesize}:{mtime_ns}"
+        offset = self.resume_index.get(token, "upload", filename, identity)
+        if offset and (not os.path.exists(path) or os.path.getsize(path) < offset):
+            offset = 0
+        if offset:
+            console.log(f"[yellow]Resuming upload of {filename} from {offset}[/yellow]")
 
-        client_socket.sendall(b"READY\n")
-        filesize = int(client_socket.recv(1024).decode())
-        _ = client_socket.sendall(b"OK\n")  # ACK
+        send_frame(client_socket, frame.request_id, OP_OK, TRANSFER.pack(offset))
+        TRANSFERS_STARTED.inc(direction="upload")
 
         start_time = time.time()
+        received = counted = offset
+        checkpoint = offset + RESUME_CHECKPOINT
         with (
-            open(filename, "wb") as f,
-            Progress(
-                "[blue]{task.description}",
-                BarColumn(),
-                TimeElapsedColumn(),
-                TransferSpeedColumn(),
-            ) as progress,
+            open(path, "r+b" if offset else "wb") as f,
+            progress.track(f"Uploading {filename}", filesize, offset) as counter,
         ):
-            task = progress.add_task(f"[green]Uploading {filename}...", total=filesize)
+            f.truncate(offset)
+            f.seek(offset)
 
-            received = 0
-            while received < filesize:
-                chunk = client_socket.recv(1024)
-                if not chunk:
-                    break
+            try:
+                while received < filesize:
+                    chunk = client_socket.recv(min(1024, filesize - received))
+                    if not chunk:
+                        break
+
+                    f.write(chunk)
+                    received += len(chunk)
+                    counter.done = received
+
+                    if received >= checkpoint:
+                        f.flush()
+                        self.resume_index.put(token, "upload", filename, identity, received)
+                        self.stats.add("bytes_in", received - counted)
+                        BYTES_IN.inc(received - counted)
+                        counted = received
+                        checkpoint = received + RESUME_CHECKPOINT
+            finally:
+                self.stats.add("bytes_in", received - counted)
+                BYTES_IN.inc(received - counted)
+                if received < filesize:
+                    # Cut off by EOF or by a recv error alike.
+                    TRANSFERS_ABORTED.inc(direction="upload")
+                    f.flush()
+                    self.resume_index.put(token, "upload", filename, identity, received)
 
-                f.write(chunk)
-                received += len(chunk)
-                progress.update(task, advance=len(chunk))
         elapsed_time = time.time() - start_time
-        bitrate = filesize / elapsed_time / (1024 * 1024)
+        bitrate = (received - offset) / elapsed_time / (1024 * 1024)
         console.log(f"[bold blue]Transfer speed: {bitrate:.2f} MB/s[/bold blue]")
 
+        if received < filesize:
+            raise ConnectionError(f"Upload of {filename} interrupted at {received}")
+
+        TRANSFERS_COMPLETED.inc(direction="upload")
+        self.resume_index.discard(token, "upload", filename, identity)
+        if self.store:
+            self.store.ingest(filename, path, mtime_ns)
+        else:
+            self.digest_index.record(filename)
+            self.digest_index.save(SAVE_INTERVAL)
         console.log(
             f"[bold green]File {filename} uploaded ({filesize} bytes)[/bold green]"
         )
+        return OP_DONE, b"Upload complete"
 
-    def _handle_download_file(self, client_socket: socket.socket, filename: str) -> str:
+    def _handle_chunked_upload(
+        self,
+        client_socket: socket.socket,
+        frame: Frame,
+        filename: str,
+        filesize: int,
+        mtime_ns: int,
+        digests: List[bytes],
+    ) -> Response:
+        """
+        Handles an upload that skips the chunks the store already has.
+
+        The OK reply lists the missing chunks and the client sends only
+        those, in order. Each chunk is checked against its digest and stored
+        as it arrives, so an interrupted upload needs no resume record: the
+        next attempt finds those chunks present.
+
+        Parameters
+        ----------
+        client_socket : socket.socket
+            The socket object representing the client connection.
+        frame : Frame
+            The CHUNKS request.
+        filename : str
+            The name to store the file under.
+        filesize : int
+            The size of the file announced by the client.
+        mtime_ns : int
+            The modification time of the client's copy.
+        digests : List[bytes]
+            SHA-256 of every CHUNK_SIZE chunk of the file.
+
+        Returns
+        -------
+        Tuple[int, bytes]
+            DONE once the file is stored; ERROR without a chunk store, for a
+            name outside the server root, for chunks that do not match their
+            digest, or if a chunk the client skipped was deleted meanwhile.
+        """
+        if not self.store:
+            return OP_ERROR, b"No chunk store"
+        if not filename:
+            return OP_ERROR, b"Error: No filename provided"
+        if self._outside_root(filename):
+            return OP_ERROR, b"Invalid filename"
+        if len(digests) != chunk_count(filesize):
+            return OP_ERROR, b"Wrong number of chunks"
+
+        missing = self.store.missing(digests)
+        send_frame(client_socket, frame.request_id, OP_OK, pack_indexes(missing))
+        TRANSFERS_STARTED.inc(direction="upload")
+        total = sum(chunk_length(filesize, index) for index in missing)
+        console.log(
+            f"[bold blue]Receiving {len(missing)} of {len(digests)} chunks of {filename} ({total} bytes)[/bold blue]"
+        )
+
+        start_time = time.time()
+        received = corrupt = 0
+        with progress.track(f"Uploading {filename}", total) as counter:
+            try:
+                for index in missing:
+                    data = recv_exact(client_socket, chunk_length(filesize, index))
+                    received += len(data)
+                    counter.done = received
+                    if hashlib.sha256(data).digest() != digests[index]:
+                        corrupt += 1
+                        continue
+                    self.store.put_chunk(data, digests[index])
+            finally:
+                self.stats.add("bytes_in", received)
+                BYTES_IN.inc(received)
+                if received < total:
+                    TRANSFERS_ABORTED.inc(direction="upload")
+
+        if corrupt:
+            TRANSFERS_ABORTED.inc(direction="upload")
+            return OP_ERROR, f"{corrupt} chunks do not match their digest".encode()
+        try:
+            digest = self.store.file_digest(digests)
+            self.store.commit(filename, filesize, mtime_ns, digest, digests)
+        except StoreError as e:
+            TRANSFERS_ABORTED.inc(direction="upload")
+            return OP_ERROR, str(e).encode()
+
+        TRANSFERS_COMPLETED.inc(direction="upload")
+        elapsed_time = time.time() - start_time
+        bitrate = received / elapsed_time / (1024 * 1024) if elapsed_time else 0.0
+        console.log(f"[bold blue]Transfer speed: {bitrate:.2f} MB/s[/bold blue]")
+        console.log(
+            f"[bold green]File {filename} stored ({filesize} bytes, {len(missing)} new chunks)[/bold green]"
+        )
+        return OP_DONE, b"Upload complete"
+
+    def _handle_download_file(
+        self,
+        client_socket: socket.socket,
+        frame: Frame,
+        token: str,
+        filename: str,
+        offset: int,
+    ) -> Response:
         """
         Handles file download for a client without terminal progress output.
 
@@ -182,86 +619,113 @@ class TCPServer:
         ----------
         client_socket : socket.socket
             The socket object representing the client connection.
+        frame : Frame
+            The DOWNLOAD request.
+        token : str
+            The client token.
         filename : str
             The name of the file to be downloaded.
+        offset : int
+            The size of the partial copy the client already has.
 
         Returns
         -------
-        str
-            A response message indicating the success or failure of the operation.
+        Tuple[int, bytes]
+            A response indicating the success or failure of the operation.
         """
-        if not os.path.exists(filename):
-            return "File not found\n"
-
-        filesize = os.path.getsize(filename)
-        starts_from, bytes_to_send = self.__determine_starting_position(
-            client_socket, filename, filesize
+        if self._outside_root(filename):
+            return OP_ERROR, b"Invalid filename"
+        if self.store:
+            recipe = self.store.recipe(filename)
+            if recipe is None:
+                return OP_ERROR, b"File not found"
+            filesize = recipe.size
+            identity = f"store:{recipe.digest.hex()}"
+        else:
+            if not os.path.isfile(filename):
+                return OP_ERROR, b"File not found"
+            st = os.stat(filename)
+            filesize = st.st_size
+            identity = f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+        starts_from = self.__determine_starting_position(
+            token, filename, identity, filesize, offset
         )
 
-        client_socket.sendall(f"READY {bytes_to_send}".encode())
+        send_frame(
+            client_socket,
+            frame.request_id,
+            OP_OK,
+            DOWNLOAD_REPLY.pack(starts_from, filesize),
+        )
         console.log(
             f"[bold blue]Sending {filename} ({filesize} bytes) starting from {starts_from}[/bold blue]"
         )
 
-        _ = client_socket.recv(1024)  # Client confirmation
-
-        return self._send_file_chunks(client_socket, filename, starts_from, filesize)
+        return self._send_file_chunks(
+            client_socket, token, filename, identity, starts_from, filesize
+        )
 
     def __determine_starting_position(
-        self, client_socket: socket.socket, filename: str, filesize: int
-    ) -> Tuple[int, int]:
+        self, token: str, filename: str, identity: str, filesize: int, offset: int
+    ) -> int:
         """
-        Determines the starting position for resumed downloads and calculates remaining bytes.
+        Determines the starting position for resumed downloads.
+
+        The client's partial copy is only trusted if the resume index shows
+        that this client was sending this very version of the file.
 
         Parameters
         ----------
-        client_socket : socket.socket
-            The socket object representing the client connection.
+        token : str
+            The client token.
         filename : str
             The name of the file.
+        identity : str
+            Fingerprint of the file on the server.
         filesize : int
             The total size of the file.
+        offset : int
+            The size of the partial copy the client already has.
 
         Returns
         -------
-        Tuple[int, int]
-            The start position and bytes to send.
+        int
+            The byte position to start sending from.
         """
         starts_from = 0
-        bytes_to_send = filesize
-        client_ip = client_socket.getpeername()[0]
-
-        if client_ip == self.interrupted_downloads.get(
-            "client_ip", ""
-        ) and filename == self.interrupted_downloads.get("filename", ""):
-            starts_from = self.interrupted_downloads["position"] + 1
-            bytes_to_send = filesize - starts_from
-            client_socket.sendall(f"RESUME {starts_from}".encode())
-
-            if client_socket.recv(1024).decode() == "NOT FOUND":
-                starts_from = 0
-                bytes_to_send = filesize
+        recorded = self.resume_index.get(token, "download", filename, identity)
 
+        if offset and recorded:
+            starts_from = min(offset, recorded, filesize)
             console.log(f"[yellow]Resuming {filename} from {starts_from}[/yellow]")
 
-        return starts_from, bytes_to_send
+        return starts_from
 
     def _send_file_chunks(
         self,
         client_socket: socket.socket,
+        token: str,
         filename: str,
+        identity: str,
         starts_from: int,
         filesize: int,
-    ) -> str:
+    ) -> Response:
         """
         Sends the file to the client in chunks.
 
+        Progress is checkpointed into the resume index, so an interrupted
+        download can continue even after a server restart.
+
         Parameters
         ----------
         client_socket : socket.socket
             The socket object representing the client connection.
+        token : str
+            The client token.
         filename : str
             The name of the file.
+        identity : str
+            Fingerprint of the file on the server.
         starts_from : int
             The byte position to start sending from.
         filesize : int
@@ -269,51 +733,109 @@ class TCPServer:
 
         Returns
         -------
-        str
+        Tuple[int, bytes]
             A confirmation message upon completion.
         """
         start_time = time.time()
+        sent_bytes = counted = starts_from
+        checkpoint = starts_from + RESUME_CHECKPOINT
+        TRANSFERS_STARTED.inc(direction="download")
 
         try:
-            with open(filename, "rb") as f:
+            with (
+                self.store.open(filename) if self.store else open(filename, "rb") as f,
+                progress.track(f"Sending {filename}", filesize, starts_from) as counter,
+            ):
                 f.seek(starts_from)
-                sent_bytes = starts_from
-
-                with Progress(
-                    "[blue]{task.description}",
-                    BarColumn(),
-                    TimeElapsedColumn(),
-                    TransferSpeedColumn(),
-                    "[bold blue]{task.percentage:.0f}%[/bold blue]",
-                ) as progress:
-                    task = progress.add_task(
-                        f"[blue]Sending {filename}...", total=filesize
-                    )
-                    progress.update(task, completed=starts_from)
 
-                    while chunk := f.read(1024):
-                        client_socket.sendall(chunk)
-                        sent_bytes += len(chunk)
-                        progress.update(task, advance=len(chunk))
+                while sent_bytes < filesize and (
+                    chunk := f.read(min(1024, filesize - sent_bytes))
+                ):
+                    client_socket.sendall(chunk)
+                    sent_bytes += len(chunk)
+                    counter.done = sent_bytes
+
+                    if sent_bytes >= checkpoint:
+                        self.resume_index.put(
+                            token, "download", filename, identity, sent_bytes
+                        )
+                        self.stats.add("bytes_out", sent_bytes - counted)
+                        BYTES_OUT.inc(sent_bytes - counted)
+                        counted = sent_bytes
+                        checkpoint = sent_bytes + RESUME_CHECKPOINT
 
         except socket.error as e:
             console.log(f"[red]Connection error: {e}[/red]")
-            self.interrupted_downloads.update(
-                {
-                    "client_ip": client_socket.getpeername()[0],
-                    "filename": filename,
-                    "position": sent_bytes,
-                }
-            )
-
+            self.resume_index.put(token, "download", filename, identity, sent_bytes)
+            TRANSFERS_ABORTED.inc(direction="download")
+            raise
+        finally:
+            self.stats.add("bytes_out", sent_bytes - counted)
+            BYTES_OUT.inc(sent_bytes - counted)
+
+        TRANSFERS_COMPLETED.inc(direction="download")
+        self.resume_index.discard(token, "download", filename, identity)
         elapsed_time = time.time() - start_time
-        bitrate = filesize / elapsed_time / (1024 * 1024)
+        bitrate = (filesize - starts_from) / elapsed_time / (1024 * 1024)
         console.log(f"[bold blue]Transfer speed: {bitrate:.2f} MB/s[/bold blue]")
         console.log(f"[bold blue]File {filename} sent ({filesize} bytes)[/bold blue]")
 
-        return "Download complete\n"
+        return OP_DONE, b"Download complete"
+
+
+def run_worker(
+    index: int,
+    stats: WorkerStats,
+    host: str,
+    port: int,
+    metrics_port: int,
+    store: Optional[str],
+) -> None:
+    try:
+        TCPServer(host, port, stats=stats, metrics_port=metrics_port, store=store).start()
+    except KeyboardInterrupt:
+        console.log(f"[magenta]Worker {index} draining[/magenta]")
 
 
 if __name__ == "__main__":
-    server = TCPServer()
-    server.start()
+    parser = argparse.ArgumentParser(description="Threaded TCP file server")
+    parser.add_argument("--host", default="0.0.0.0", help="Address to bind to")
+    parser.add_argument("--port", type=int, default=12346, help="Port to listen on")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Pre-fork this many worker processes sharing the port via SO_REUSEPORT",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="Serve Prometheus metrics on this local port, 0 to disable "
+        "(worker N of a pre-forked server uses this port + N)",
+    )
+    parser.add_argument(
+        "--store",
+        metavar="DIR",
+        help="Keep files deduplicated as content-addressed chunks in DIR "
+        "instead of as plain files in the working directory",
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        Supervisor(
+            lambda index, stats: run_worker(
+                index,
+                stats,
+                args.host,
+                args.port,
+                args.metrics_port and args.metrics_port + index,
+                args.store,
+            ),
+            args.workers,
+        ).run()
+    else:
+        server = TCPServer(
+            args.host, args.port, metrics_port=args.metrics_port, store=args.store
+        )
+        server.start()
@@ -0,0 +1,354 @@
+"""Content-addressed, deduplicating file store for the TCP server.
+
+With ``--store DIR`` uploaded files are split into CHUNK_SIZE chunks that
+are kept once under ``DIR/chunks``, named by their SHA-256, however many
+files contain them. A file name maps to a recipe: size, mtime and digest of
+the whole file plus the list of its chunk digests. Recipes and chunk
+reference counts live in an SQLite database next to the chunks, so
+pre-forked workers share the store, and a file that is replaced releases
+the chunks no other file uses.
+
+Every change of the chunk set runs in an immediate transaction, which
+serializes writers across threads and processes: a chunk is never deleted
+while another upload stores or references it.
+
+Chunks of an upload that never commits (aborted, or rejected as corrupt)
+keep no references. They stay for ORPHAN_AGE, so that a retry finds them
+present, and are then swept.
+"""
+
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+from protocol import CHUNK_SIZE
+
+DIGEST_SIZE = 32
+QUERY_BATCH = 500  # digests per IN (...) query
+ORPHAN_AGE = 24 * 3600  # seconds an unreferenced chunk is kept for a retry
+SWEEP_INTERVAL = 3600  # seconds between two sweeps of a running store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    digest BLOB PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    chunks BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_digest ON files (digest);
+"""
+
+
+class StoreError(Exception):
+    """Raised when an upload references a chunk the store does not have."""
+
+
+class Recipe(NamedTuple):
+    size: int
+    mtime_ns: int
+    digest: bytes
+    chunks: List[bytes]
+
+
+def chunk_count(size: int) -> int:
+    return -(-size // CHUNK_SIZE)
+
+
+def chunk_length(size: int, index: int) -> int:
+    return min(CHUNK_SIZE, size - index * CHUNK_SIZE)
+
+
+def split_digests(packed: bytes) -> List[bytes]:
+    return [packed[i:i + DIGEST_SIZE] for i in range(0, len(packed), DIGEST_SIZE)]
+
+
+class ChunkReader(io.RawIOBase):
+    """Reads a stored file by reassembling its chunks, keeping the current one open."""
+
+    def __init__(self, store: "ChunkStore", recipe: Recipe):
+        self.store = store
+        self.recipe = recipe
+        self.position = 0
+        self.index = -1
+        self.chunk: Optional[io.BufferedReader] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.recipe.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.recipe.size:
+            return 0
+        index, skip = divmod(self.position, CHUNK_SIZE)
+        if index != self.index:
+            if self.chunk:
+                self.chunk.close()
+            self.chunk = open(self.store.chunk_path(self.recipe.chunks[index]), "rb")
+            self.index = index
+        self.chunk.seek(skip)
+        wanted = min(len(buffer), chunk_length(self.recipe.size, index) - skip)
+        n = self.chunk.readinto(memoryview(buffer)[:wanted])
+        if not n:
+            raise OSError(f"Chunk {self.recipe.chunks[index].hex()} is truncated")
+        self.position += n
+        return n
+
+    def close(self) -> None:
+        if self.chunk:
+            self.chunk.close()
+            self.chunk = None
+        super().close()
+
+
+class ChunkStore:
+    """
+    Files kept as reference-counted, content-addressed chunks.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the store; created if missing.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.db_path = os.path.join(root, "store.db")
+        self.local = threading.local()
+        os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+        os.makedirs(os.path.join(root, "staging"), exist_ok=True)
+
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        self.next_sweep = 0.0
+        self.sweep()
+
+    def _db(self) -> sqlite3.Connection:
+        """The connection of the calling thread; sqlite3 connections are not shared."""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            self.local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def chunk_path(self, digest: bytes) -> str:
+        name = digest.hex()
+        return os.path.join(self.root, "chunks", name[:2], name)
+
+    def staging_path(self, token: str, name: str) -> str:
+        """
+        Where a plain upload of ``name`` is received before it is chunked.
+
+        Keyed by client and name like the resume index, so concurrent
+        uploads of one name by different clients do not share a file.
+        """
+        key = f"{token}\0{name}".encode()
+        return os.path.join(self.root, "staging", hashlib.sha256(key).hexdigest())
+
+    def missing(self, digests: Sequence[bytes]) -> List[int]:
+        """Indexes of the digests whose chunk is not stored."""
+        present = set()
+        unique = list(set(digests))
+        db = self._db()
+        for i in range(0, len(unique), QUERY_BATCH):
+            batch = unique[i:i + QUERY_BATCH]
+            rows = db.execute(
+                f"SELECT digest FROM chunks WHERE digest IN ({','.join('?' * len(batch))})", batch
+            )
+            present.update(row[0] for row in rows)
+        return [i for i, digest in enumerate(digests) if digest not in present]
+
+    def put_chunk(self, data, digest: Optional[bytes] = None) -> bytes:
+        """
+        Stores a chunk unless it is already there.
+
+        A new chunk has no references until a recipe that uses it is
+        committed.
+
+        Returns
+        -------
+        bytes
+            The digest of ``data``.
+        """
+        if digest is None:
+            digest = hashlib.sha256(data).digest()
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM chunks WHERE digest = ?", (digest,)).fetchone():
+                return digest
+            path = self.chunk_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            db.execute("INSERT INTO chunks VALUES (?, ?, 0)", (digest, len(data)))
+        return digest
+
+    def commit(self, name: str, size: int, mtime_ns: int, digest: bytes, chunks: Sequence[bytes]) -> None:
+        """
+        Makes ``name`` refer to the given chunks, replacing its old recipe.
+
+        Raises
+        ------
+        StoreError
+            If a chunk is not stored (any more).
+        """
+        freed = []
+        with self._transaction() as db:
+            for chunk in chunks:
+                updated = db.execute("UPDATE chunks SET refs = refs + 1 WHERE digest = ?", (chunk,))
+                if not updated.rowcount:
+                    raise StoreError(f"Chunk {chunk.hex()} is not stored")
+
+            old = db.execute("SELECT chunks FROM files WHERE name = ?", (name,)).fetchone()
+            for chunk in split_digests(old[0]) if old else ():
+                db.execute("UPDATE chunks SET refs = refs - 1 WHERE digest = ?", (chunk,))
+                row = db.execute("SELECT refs FROM chunks WHERE digest = ?", (chunk,)).fetchone()
+                if row and row[0] <= 0:
+                    db.execute("DELETE FROM chunks WHERE digest = ?", (chunk,))
+                    freed.append(chunk)
+
+            db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (name, size, mtime_ns, digest, b"".join(chunks)),
+            )
+            # Still inside the transaction, so no upload can store these again meanwhile.
+            for chunk in freed:
+                try:
+                    os.remove(self.chunk_path(chunk))
+                except FileNotFoundError:
+                    pass
+
+        if time.monotonic() >= self.next_sweep:
+            self.sweep()
+
+    def sweep(self, max_age: float = ORPHAN_AGE) -> int:
+        """
+        Deletes the unreferenced chunks stored more than ``max_age`` seconds ago.
+
+        Returns
+        -------
+        int
+            The number of chunks deleted.
+        """
+        self.next_sweep = time.monotonic() + SWEEP_INTERVAL
+        cutoff = time.time() - max_age
+        swept = 0
+        with self._transaction() as db:
+            for (chunk,) in db.execute("SELECT digest FROM chunks WHERE refs <= 0").fetchall():
+                path = self.chunk_path(chunk)
+                try:
+                    if os.path.getmtime(path) > cutoff:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                db.execute("DELETE FROM chunks WHERE digest = ?", (chunk,))
+                swept += 1
+        return swept
+
+    def ingest(self, name: str, path: str, mtime_ns: int) -> Recipe:
+        """Chunks a received file into the store under ``name`` and removes it."""
+        whole = hashlib.sha256()
+        chunks = []
+        size = 0
+        with open(path, "rb") as f:
+            while data := f.read(CHUNK_SIZE):
+                whole.update(data)
+                chunks.append(self.put_chunk(data))
+                size += len(data)
+        self.commit(name, size, mtime_ns, whole.digest(), chunks)
+        os.remove(path)
+        return Recipe(size, mtime_ns, whole.digest(), chunks)
+
+    def file_digest(self, chunks: Sequence[bytes]) -> bytes:
+        """
+        Hashes the file made of the given stored chunks.
+
+        Raises
+        ------
+        StoreError
+            If a chunk is not stored (any more).
+        """
+        whole = hashlib.sha256()
+        for chunk in chunks:
+            try:
+                with open(self.chunk_path(chunk), "rb") as f:
+                    whole.update(f.read())
+            except FileNotFoundError:
+                raise StoreError(f"Chunk {chunk.hex()} is not stored") from None
+        return whole.digest()
+
+    def recipe(self, name: str) -> Optional[Recipe]:
+        row = self._db().execute(
+            "SELECT size, mtime_ns, digest, chunks FROM files WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        return Recipe(row[0], row[1], row[2], split_digests(row[3]))
+
+    def lookup(self, digest: bytes) -> Optional[str]:
+        """The name of a stored file with the given content, or None."""
+        row = self._db().execute("SELECT name FROM files WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def copy(self, source: str, target: str) -> bool:
+        """Stores ``target`` with the chunks of ``source``; no data is copied."""
+        recipe = self.recipe(source)
+        if recipe is None:
+            return False
+        try:
+            self.commit(target, recipe.size, recipe.mtime_ns, recipe.digest, recipe.chunks)
+        except StoreError:
+            return False  # source was replaced meanwhile
+        return True
+
+    def manifest(self, directory: str) -> Dict[str, Recipe]:
+        """The files under ``directory``, keyed by their name relative to it."""
+        prefix = directory.rstrip("/") + "/" if directory else ""
+        rows = self._db().execute(
+            "SELECT name, size, mtime_ns, digest FROM files WHERE substr(name, 1, ?) = ?",
+            (len(prefix), prefix),
+        )
+        return {name[len(prefix):]: Recipe(size, mtime_ns, digest, []) for name, size, mtime_ns, digest in rows}
+
+    def open(self, name: str) -> io.BufferedReader:
+        recipe = self.recipe(name)
+        if recipe is None:
+            raise FileNotFoundError(name)
+        return io.BufferedReader(ChunkReader(self, recipe), CHUNK_SIZE)
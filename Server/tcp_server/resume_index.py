@@ -0,0 +1,223 @@
+"""Persistent index of interrupted TCP transfers."""
+
+import fcntl
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Tuple
+
+Key = Tuple[str, str, str, str]
+
+
+class ResumeIndex:
+    """
+    Remembers how far interrupted uploads and downloads got.
+
+    Entries are keyed by (client token, direction, file path, file identity),
+    so one client can have many transfers pending, clients behind the same
+    NAT do not collide, and a changed file never resumes from a stale offset.
+    The index is kept in memory as an LRU and persisted as an append-only
+    log of checksummed JSON lines: a torn last line after a crash is simply
+    skipped on the next start, and the log is rewritten atomically once it
+    grows well past the number of live entries.
+
+    Pre-forked workers share one log: appends and compaction hold an
+    exclusive flock on a sibling ``.lock`` file, and every lookup first
+    applies the records other processes appended since the last one, so a
+    client that reconnects to a different worker still resumes.
+    """
+
+    def __init__(
+        self,
+        path: str = "resume_index.log",
+        max_entries: int = 4096,
+        ttl: float = 7 * 24 * 3600,
+    ):
+        """
+        Loads the index from ``path``.
+
+        Parameters
+        ----------
+        path : str, optional
+            Log file location, by default "resume_index.log"
+        max_entries : int, optional
+            Least recently used entries beyond this count are dropped.
+        ttl : float, optional
+            Entries not touched for this many seconds are dropped, by default a week.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[Key, Tuple[int, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.log_records = 0
+
+        self._open()
+
+    def get(self, token: str, direction: str, path: str, identity: str) -> int:
+        """
+        Returns the resumable offset of a transfer, or 0 if none is known.
+
+        Parameters
+        ----------
+        token : str
+            Client token sent with HELLO (the client IP if there was none).
+        direction : str
+            "upload" or "download".
+        path : str
+            File path on the server.
+        identity : str
+            Fingerprint of the file contents the offset refers to.
+        """
+        key = (token, direction, path, identity)
+        with self.lock:
+            self._sync()
+            entry = self.entries.get(key)
+            if entry is None:
+                return 0
+            if time.time() - entry[1] > self.ttl:
+                del self.entries[key]
+                return 0
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, token: str, direction: str, path: str, identity: str, offset: int) -> None:
+        """Records that a transfer is known to be complete up to ``offset``."""
+        key = (token, direction, path, identity)
+        now = time.time()
+        with self.lock:
+            self._set(key, offset, now)
+            self._append({"key": key, "offset": offset, "ts": now})
+
+    def discard(self, token: str, direction: str, path: str, identity: str) -> None:
+        """Forgets a transfer, typically because it has completed."""
+        key = (token, direction, path, identity)
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self._append({"key": key, "offset": None, "ts": time.time()})
+
+    def close(self) -> None:
+        with self.lock:
+            self.log.close()
+            self.reader.close()
+            self.lock_file.close()
+
+    def _set(self, key: Key, offset: int, ts: float) -> None:
+        self.entries[key] = (offset, ts)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _append(self, record: dict) -> None:
+        line = json.dumps(record, separators=(",", ":"))
+        with self._exclusive():
+            self._reopen_if_replaced()
+            self.log.write(f"{zlib.crc32(line.encode()):08x} {line}\n")
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            # Reads back everything up to and including this record.
+            self._read_new()
+
+            if self.log_records > 4 * max(len(self.entries), 256):
+                self._compact()
+
+    def _open(self) -> None:
+        self.lock_file = open(self.path + ".lock", "a")
+        self.log = open(self.path, "a", encoding="utf-8")
+        self.reader = open(self.path, "rb")
+        with self._exclusive():
+            # Terminate a line torn by a crash so the next record starts clean.
+            size = os.fstat(self.reader.fileno()).st_size
+            if size and os.pread(self.reader.fileno(), 1, size - 1) != b"\n":
+                self.log.write("\n")
+                self.log.flush()
+            self._read_new()
+
+    def _exclusive(self) -> "_Flock":
+        """Context manager holding the cross-process lock on the log."""
+        return _Flock(self.lock_file)
+
+    def _reopen_if_replaced(self) -> None:
+        try:
+            current = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current == os.fstat(self.reader.fileno()).st_ino:
+            return
+
+        # Another process compacted the log: rebuild from the new file.
+        self.log.close()
+        self.reader.close()
+        self.entries.clear()
+        self.log_records = 0
+        self.log = open(self.path, "a", encoding="utf-8")
+        self.reader = open(self.path, "rb")
+
+    def _sync(self) -> None:
+        """Applies the records appended by other processes since the last call."""
+        with self._exclusive():
+            self._reopen_if_replaced()
+            self._read_new()
+
+    def _read_new(self) -> None:
+        now = time.time()
+        while True:
+            position = self.reader.tell()
+            raw = self.reader.readline()
+            if not raw:
+                return
+            if not raw.endswith(b"\n"):
+                self.reader.seek(position)  # still being written
+                return
+
+            self.log_records += 1
+            crc, _, body = raw.rstrip(b"\n").partition(b" ")
+            try:
+                if int(crc, 16) != zlib.crc32(body):
+                    continue
+                record = json.loads(body)
+                key = tuple(record["key"])
+                offset, ts = record["offset"], record["ts"]
+            except (ValueError, KeyError, TypeError):
+                continue  # torn or corrupted line
+
+            if offset is None or now - ts > self.ttl:
+                self.entries.pop(key, None)
+            else:
+                self._set(key, offset, ts)
+
+    def _compact(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp:
+            for key, (offset, ts) in self.entries.items():
+                line = json.dumps({"key": key, "offset": offset, "ts": ts}, separators=(",", ":"))
+                tmp.write(f"{zlib.crc32(line.encode()):08x} {line}\n")
+            tmp.flush()
+            os.fsync(tmp.fileno())
+
+        # Still under the lock: other processes notice the new inode before
+        # they read or append again.
+        os.replace(tmp_path, self.path)
+        self.log.close()
+        self.reader.close()
+        self.log = open(self.path, "a", encoding="utf-8")
+        self.reader = open(self.path, "rb")
+        self.reader.seek(0, os.SEEK_END)
+        self.log_records = len(self.entries)
+
+
+class _Flock:
+    """Holds an exclusive flock on an open file for the duration of a with block."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self.file
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
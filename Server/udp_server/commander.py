@@ -1,22 +1,109 @@
 import time
 import os
 import datetime
-from config import BUFFER_SIZE, UPLOAD_PATH, SERVER_FILES_PATH, console, log
-from rich.panel import Panel
-from file_handler import File
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    BUFFER_SIZE,
+    UPLOAD_PATH,
+    SERVER_FILES_PATH,
+    DIGEST_INDEX_PATH,
+    MAX_BUFFER,
+    SIZE_FOR_WRITE,
+    WRITE_BUFFER_SIZE,
+    REQUEST,
+    console,
+    log,
+)
+from digest_index import DigestIndex
+from file_handler import Download, Upload
+from metrics import COMMAND_LATENCY
+
+COMMANDS = ("QUIT", "TIME", "ECHO", "DOWNLOAD", "UPLOAD", "HAVE")
+# Tails of finished transfers, e.g. the CTRL_C a client sends after every upload.
+STRAY = (b"CTRL_C", b"FIN", b"ACK", b"RETRY")
+
+_digest_index = None
+_hasher = None
+
+
+def digest_index():
+    """Digests of the uploaded files, shared by all client sessions."""
+    global _digest_index
+    if _digest_index is None:
+        _digest_index = DigestIndex(DIGEST_INDEX_PATH)
+    return _digest_index
+
+
+def hasher():
+    """
+    The thread that hashes and copies files for the digest index.
+
+    Reading a whole file would stall every transfer of the event loop.
+    One thread runs the jobs in order, so a HAVE sent after an upload
+    finds the digest the upload recorded.
+    """
+    global _hasher
+    if _hasher is None:
+        _hasher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hasher")
+    return _hasher
+
+
+def record_upload(file_name):
+    digest_index().record(file_name)
+    digest_index().save()
 
 
 class ServerCommander:
+    """
+    The session of one client address.
+
+    Commands are answered at once. DOWNLOAD and UPLOAD only start a
+    transfer on a socket of its own and reply with its port; the server
+    loop drives the transfer until it is over. Datagrams of the transfer
+    that still reach the server port are handed to it as well.
+    """
+
     def __init__(self, server_socket):
         self.server_socket = server_socket
         self.client_is_active = True
+        self.transfer = None
 
     def send_msg(self, data):
         self.server_socket.sendto(str(data).encode("utf-8"), self.client_address)
 
-    def recv_msg(self):
-        recv_data, recv_address = self.server_socket.recvfrom(BUFFER_SIZE)
-        return (recv_data.decode("utf-8"), recv_address)
+    def handle_datagram(self, data, now):
+        if self.transfer is not None and self.transfer.done:
+            self.transfer = None
+        transfer = self.transfer
+        if transfer is not None:
+            try:
+                consumed = transfer.on_datagram(data, now)
+            except OSError as e:
+                log.error(f"Transfer of {transfer.file_name} failed: {e}")
+                transfer.abort()
+                consumed = True
+            if transfer.done:
+                self.transfer = None
+            if consumed:
+                return
+        elif data.startswith(STRAY) or data[:1].isdigit():
+            return  # late datagram of a transfer that is over
+        self.handle_command(data.decode("utf-8", errors="replace"))
+
+    def transfer_socket(self):
+        """A non-blocking socket on an ephemeral port, connected to the client."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, WRITE_BUFFER_SIZE * SIZE_FOR_WRITE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MAX_BUFFER)
+            sock.bind((self.server_socket.getsockname()[0], 0))
+            sock.connect(self.client_address)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        return sock
 
     def exec_quit(self):
         self.client_is_active = False
@@ -36,87 +123,96 @@ class ServerCommander:
             self.send_msg("0")
             log.warning(f"Download request for non-existent file: {file_name}")
         else:
-            file_size = os.path.getsize(SERVER_FILES_PATH + file_name)
-
-            self.send_msg(file_size)
-            log.info(f"Sending file size: {file_size}")
-
-            file_offset, _ = self.recv_msg()
-            file_offset = int(file_offset)
-            log.info(f"Client requested offset: {file_offset}")
-            if file_offset == file_size:
-                log.info(f"File {file_name} is already downloaded")
-                return
+            sock = self.transfer_socket()
+            try:
+                self.transfer = Download(sock, SERVER_FILES_PATH + file_name, time.monotonic())
+            except OSError:
+                sock.close()
+                raise
+            self.send_msg(f"{self.transfer.file_size} {self.transfer.port}")
+            log.info(f"Sending file size: {self.transfer.file_size}, port: {self.transfer.port}")
+
+    def exec_have(self, args):
+        # HAVE <file name> <sha256 hex>: "1" if the content is now stored
+        # under that name, "0" if the client has to upload it.
+        parts = args.split()
+        try:
+            digest = bytes.fromhex(parts[-1])
+            file_name = " ".join(parts[:-1]).split("/")[-1]
+        except (IndexError, ValueError):
+            digest, file_name = b"", ""
+        if not file_name:
+            self.send_msg("0")
+            return
 
-            file = File(
-                SERVER_FILES_PATH + file_name,
-                "rb",
-                self.server_socket,
-                self.client_address,
-            )
-            send_time = file.send_file(file_offset)
+        os.makedirs(UPLOAD_PATH, exist_ok=True)
+        hasher().submit(self.copy_stored, digest, file_name)
 
-            if send_time > 0:
-                speed = (file_size - file_offset) / send_time / 1024
-                log.info(f"Download completed. Speed: {speed:.2f} KB/s")
-                console.print(
-                    Panel(
-                        f"[bold green]Download completed[/]\nSpeed: [yellow]{speed:.2f} KB/s[/]"
-                    )
-                )
+    def copy_stored(self, digest, file_name):
+        if digest_index().copy_to(digest, os.path.join(UPLOAD_PATH, file_name)):
+            digest_index().save()
+            log.info(f"Have request: {file_name} is already stored")
+            self.send_msg("1")
+        else:
+            log.info(f"Have request: {file_name} is unknown")
+            self.send_msg("0")
 
     def exec_upload(self, args):
         path_parts = " ".join(args.split()[:-1]).split("/")
         full_file_name = os.path.join(UPLOAD_PATH, path_parts[-1])
-
-        if os.path.exists(full_file_name):
-            mode = "ab"
-            file_offset = os.path.getsize(full_file_name)
-        else:
-            mode = "wb+"
-            file_offset = 0
-
         file_size = int(args.split()[-1])
+
+        os.makedirs(UPLOAD_PATH, exist_ok=True)
+        received = Upload.resume_point(full_file_name, file_size)
+        file_offset = min(received.first_missing() * BUFFER_SIZE, file_size)
         log.info(
             f"Upload request: {path_parts[-1]}, size: {file_size}, offset: {file_offset}"
         )
-        self.send_msg(file_offset)
-
-        os.makedirs(UPLOAD_PATH, exist_ok=True)
-
-        file = File(full_file_name, mode, self.server_socket, self.client_address)
-        start_time = time.time()
-        file.recv_file(file_size, file_offset)
-
-        end_time = time.time()
+        if file_offset == file_size:
+            log.info(f"File {full_file_name} is already uploaded")
+            self.send_msg(file_offset)
+            return
 
-        transfer_time = end_time - start_time
-        if transfer_time > 0:
-            speed = (file_size - file_offset) / transfer_time / 1024
-            log.info(f"Upload completed. Speed: {speed:.2f} KB/s")
-            console.print(
-                Panel(
-                    f"[bold green]Upload completed[/]\nSpeed: [yellow]{speed:.2f} KB/s[/]"
-                )
+        sock = self.transfer_socket()
+        try:
+            self.transfer = Upload(
+                sock,
+                full_file_name,
+                file_size,
+                received,
+                time.monotonic(),
+                on_complete=lambda name: hasher().submit(record_upload, name),
             )
+        except OSError:
+            sock.close()
+            raise
+        self.send_msg(f"{file_offset} {self.transfer.port}")
 
     def handle_command(self, msg):
         if len(msg) == 0:
             return
 
-        log.info(f"Request from {self.client_address}: {msg}")
+        log.info(f"Request from {self.client_address}: {msg}", extra=REQUEST)
 
         full_cmd = msg.split(maxsplit=1)
         command = full_cmd[0].strip().upper()
         arguments = "" if len(full_cmd) == 1 else full_cmd[1].strip()
 
-        console.print(
-            Panel(
-                f"[bold]Command:[/] [cyan]{command}[/]",
-                subtitle=f"From: {self.client_address[0]}:{self.client_address[1]}",
-            )
+        console.panel(
+            f"[bold]Command:[/] [cyan]{command}[/]",
+            subtitle=f"From: {self.client_address[0]}:{self.client_address[1]}",
         )
 
+        start_time = time.perf_counter()
+        try:
+            self.dispatch(msg, command, arguments)
+        finally:
+            COMMAND_LATENCY.observe(
+                time.perf_counter() - start_time,
+                command=command if command in COMMANDS else "UNKNOWN",
+            )
+
+    def dispatch(self, msg, command, arguments):
         if command == "QUIT":
             self.exec_quit()
         elif command == "TIME":
@@ -127,6 +223,8 @@ class ServerCommander:
             self.exec_download(arguments)
         elif command == "UPLOAD":
             self.exec_upload(arguments)
+        elif command == "HAVE":
+            self.exec_have(arguments)
         else:
             log.error(f"Unknown command: {command}")
             console.print("[bold red]Error:[/] Unknown command")
@@ -1,13 +1,16 @@
 """Configuration settings for the UDP server."""
 
+import logging
 import os
-from logging_setup import setup_logging
-from rich.console import Console
+from logging_setup import PACKET, REQUEST
+from terminal import Terminal
 HOST = "0.0.0.0"
 PORT = 12348
+METRICS_PORT = 9348
 
 UPLOAD_PATH = "./upload_files"
 SERVER_FILES_PATH = "./server_files/"
+DIGEST_INDEX_PATH = "digest_index.json"
 
 READ_BUFFER_SIZE = 16384
 WRITE_BUFFER_SIZE = 1024
@@ -16,8 +19,11 @@ MAX_BUFFER = 425984
 SIZE_FOR_READ = 65536
 SIZE_FOR_WRITE = 32768
 
-log = setup_logging()
-console = Console()
+# Importing config has no side effects: the server attaches the log
+# handlers with logging_setup.setup_logging() once it starts, and the
+# terminal only loads rich for an interactive session.
+log = logging.getLogger("udp_server")
+console = Terminal()
 
 def ensure_directories():
     """Create necessary directories if they don't exist."""
@@ -1,215 +1,479 @@
+"""Uploads and downloads as state machines driven by the server loop.
+
+A transfer never blocks. ``on_datagram`` handles one datagram of its
+client, ``advance`` does at most a quantum of work (a burst of packets, a
+timer that fired) and returns, so one thread moves any number of transfers
+forward side by side and still answers TIME or ECHO in between.
+
+Every transfer has a UDP socket of its own on an ephemeral port,
+connected to the client, which the DOWNLOAD or UPLOAD reply names. Its
+datagrams thus queue apart from the commands on the server port and from
+the other transfers.
+
+Packets are ``<seq>:<bytes>``; packet ``seq`` holds the BUFFER_SIZE bytes
+at ``seq * BUFFER_SIZE``.
+"""
+
 import os
 import time
-import select
-import socket
-
-from rich.progress import (
-    BarColumn,
-    DownloadColumn,
-    Progress,
-    TextColumn,
-    TimeRemainingColumn,
-    TransferSpeedColumn,
-)
-from config import BUFFER_SIZE, READ_BUFFER_SIZE, WRITE_BUFFER_SIZE, console, log
-
 
-class File:
-    def __init__(self, file_name, mode, socket, address):
+from config import BUFFER_SIZE, READ_BUFFER_SIZE, PACKET, console, log
+from metrics import (
+    BYTES_IN,
+    BYTES_OUT,
+    NACKS,
+    RETRANSMITS,
+    TRANSFERS_ABORTED,
+    TRANSFERS_COMPLETED,
+    TRANSFERS_STARTED,
+)
+from packet_trace import (
+    ABORT,
+    ACK_RECV,
+    ACK_SENT,
+    FIN_ACK_RECV,
+    FIN_ACK_SENT,
+    FIN_RECV,
+    FIN_SENT,
+    NACK_RECV,
+    NACK_SENT,
+    NULL_TRACE,
+    RECEIVING,
+    RECV,
+    RETRANSMIT,
+    SEND,
+    SENDING,
+    TIMEOUT,
+    open_trace,
+)
+from progress import ProgressRenderer
+from resume_bitmap import SUFFIX as BITMAP_SUFFIX, PacketBitmap
+
+QUANTUM = 64  # packets a download sends per loop iteration
+RECV_QUANTUM = 256  # datagrams a transfer reads from its socket per loop iteration
+OFFSET_TIMEOUT = 5.0  # a download whose client sends no offset is dropped
+FIN_TIMEOUT = 1.0  # a download ends this long after the client's last message
+RETRY_INTERVAL = 0.5  # an upload asks again for a missing packet after this long
+RETRY_ATTEMPTS = 10
+IDLE_TIMEOUT = 10.0  # an upload that receives nothing for this long is suspended
+CHECKPOINT_PACKETS = 4096  # received packets between two bitmap checkpoints
+WRITE_RUN = 64 * 1024  # consecutive upload packets are written in runs of this size
+
+progress = ProgressRenderer(console)
+
+
+class Transfer:
+    """
+    State shared by uploads and downloads.
+
+    Attributes
+    ----------
+    done : bool
+        The transfer is over, completed or not; the session drops it.
+    port : int
+        The port of the transfer's socket.
+    blocked : bool
+        The last send found the socket buffer full; ``advance`` sends
+        nothing until the server has seen the socket writable again.
+    deadline : float or None
+        ``time.monotonic()`` at which ``advance`` has a timer to handle.
+    """
+
+    direction = ""
+
+    def __init__(self, sock, file_name):
+        self.sock = sock
+        self.port = sock.getsockname()[1]
         self.file_name = file_name
-        self.mode = mode
-        self.socket = socket
-        self.address = address
-        self.file_map = None
-
-    def wait(self, socket):
-        readyToRead, _, _ = select.select([socket], [], [], 1)
-        return readyToRead
-
-    def send_file(self, offset):
-        sended_data_size = 0
-        send_time = 0
-        with open(self.file_name, self.mode) as file:
-            file.seek(int(offset), 0)
-            file_size = os.path.getsize(self.file_name)
-            total_to_send = file_size - offset
-
-            with Progress(
-                TextColumn("[bold blue]{task.description}"),
-                BarColumn(),
-                "[progress.percentage]{task.percentage:>3.1f}%",
-                "•",
-                DownloadColumn(),
-                "•",
-                TransferSpeedColumn(),
-                "•",
-                TimeRemainingColumn(),
-                console=console,
-            ) as progress:
-                task = progress.add_task(
-                    f"[green]Sending {os.path.basename(self.file_name)}",
-                    total=total_to_send,
-                )
-                seq_num = int(offset / BUFFER_SIZE)
-                log.info(
-                    f"Sending file {os.path.basename(self.file_name)} from {offset} to {total_to_send}"
-                )
-                while True:
-                    data = file.read(WRITE_BUFFER_SIZE)
-                    if not data:
-                        break
-
-                    packet = f"{seq_num}:{data.decode('utf-8')}"
-                    seq_num += 1
-
-                    start_time = time.time()
-                    self.socket.sendto(packet.encode("utf-8"), self.address)
-
-                    end_time = time.time()
-
-                    send_time += end_time - start_time
-                    sended_data_size += len(data)
-                    progress.update(task, advance=len(data))
-
-                self.socket.sendto(b"FIN", self.address)
-                log.info("FIN I SENT")
-                while True:
-                    try:
-                        self.socket.settimeout(1)
-                        log.info("Waiting for missing packets")
-                        ack, _ = self.socket.recvfrom(BUFFER_SIZE)
-                        ack = ack.decode("utf-8")
-                        if ack.startswith("RETRY"):
-                            log.info(f"Received RETRY: {ack}")
-                            seq_num = int(ack.split(":")[1])
-                            position = seq_num * BUFFER_SIZE
-                            file.seek(position, 0)
-                            data = file.read(BUFFER_SIZE)
-                            packet = f"{seq_num}:{data.decode('utf-8')}"
-                            self.socket.sendto(packet.encode("utf-8"), self.address)
-                            _ = self.socket.recvfrom(BUFFER_SIZE)
-                        elif ack.startswith("FIN_ACK"):
-                            break
-                    except socket.timeout:
-                        log.info("Timeout waiting for missing packets")
-                        break
-
-            return send_time
-
-    def check_missing_packets(self, received_packets):
-        missing_packets = []
-        for i in range(max(received_packets.keys()) + 1):
-            if i not in received_packets:
-                missing_packets.append(i)
-        return missing_packets
-
-    def retry_missing_packets(self, missing_packets, received_packets):
-        log.info(f"Retrying missing packets: {missing_packets} in recursion")
-        for seq_num in missing_packets:
-            log.info(f"Sending RETRY: {seq_num}")
-            retry_message = f"RETRY:{seq_num}"
-            self.socket.sendto(retry_message.encode("utf-8"), self.address)
-
-            data, address = self.socket.recvfrom(READ_BUFFER_SIZE)
-
-            seq_num, file_data = data.split(b":", 1)
-            seq_num = int(seq_num.decode("utf-8"))
-            log.info(f"Received RETRY: {seq_num}")
-            received_packets[seq_num] = file_data
-            self.socket.sendto(b"ACK", address)
-            log.info(f"Sent ACK: {seq_num}")
-        new_missing_packets = self.check_missing_packets(received_packets)
-        if new_missing_packets:
-            self.retry_missing_packets(new_missing_packets, received_packets)
-
-        return received_packets
-
-    def recv_file(self, file_size, offset):
-        if file_size == offset:
-            log.info(f"File {self.file_name} is already downloaded")
+        self.done = False
+        self.blocked = False
+        self.deadline = None
+        self.trace = NULL_TRACE
+        self.counter = None
+        self.started = time.time()
+
+    def send(self, data):
+        try:
+            self.sock.send(data)
+        except BlockingIOError:
+            self.blocked = True
+            return False
+        return True
+
+    def ready(self):
+        """True if ``advance`` has packets to send right away."""
+        return False
+
+    def receive(self, now):
+        """Handles the datagrams waiting on the transfer's socket, at most RECV_QUANTUM."""
+        for _ in range(RECV_QUANTUM):
+            try:
+                data = self.sock.recv(READ_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+            if self.done:
+                continue  # late datagrams until the server closes the socket
+            self.on_datagram(data, now)
+
+    def begin(self, trace_direction, file_size, total):
+        self.trace = open_trace(trace_direction, self.file_name, file_size)
+        self.counter = progress.start(
+            f"{'Sending' if trace_direction == SENDING else 'Receiving'} {os.path.basename(self.file_name)}",
+            total,
+        )
+        TRANSFERS_STARTED.inc(direction=self.direction)
+
+    def end(self, completed):
+        self.done = True
+        self.deadline = None
+        self.trace.close()
+        if self.counter is not None:
+            progress.finish(self.counter)
+        if completed:
+            TRANSFERS_COMPLETED.inc(direction=self.direction)
+        else:
+            TRANSFERS_ABORTED.inc(direction=self.direction)
+
+    def abort(self):
+        """Gives up, e.g. because the client started something else."""
+        if self.counter is None:
+            self.done = True  # nothing was sent yet
+        elif not self.done:
+            self.trace.event(ABORT)
+            self.end(False)
+
+    def report_speed(self, size):
+        transfer_time = time.time() - self.started
+        if transfer_time > 0:
+            speed = size / transfer_time / 1024
+            title = "Download" if self.direction == "download" else "Upload"
+            log.info(f"{title} completed. Speed: {speed:.2f} KB/s")
+            console.panel(f"[bold green]{title} completed[/]\nSpeed: [yellow]{speed:.2f} KB/s[/]")
+
+
+class Download(Transfer):
+    """
+    Sends a file: waits for the client's offset, streams the packets from
+    there, then serves RETRY requests until FIN_ACK or FIN_TIMEOUT of
+    silence.
+    """
+
+    direction = "download"
+
+    def __init__(self, sock, file_name, now):
+        super().__init__(sock, file_name)
+        self.file_size = os.path.getsize(file_name)
+        self.file = None
+        self.state = "offset"
+        self.deadline = now + OFFSET_TIMEOUT
+        self.offset = 0
+        self.seq_num = 0
+        self.pending = None  # the packet a full socket buffer refused
+        self.pending_size = 0
+
+    def ready(self):
+        return self.state == "sending" and not self.blocked
+
+    def on_datagram(self, data, now):
+        """
+        Handles a datagram of the client.
+
+        Returns
+        -------
+        bool
+            False if it is not part of the transfer; the transfer is then
+            aborted and the caller treats the datagram as a command.
+        """
+        if self.state == "offset":
+            try:
+                self.offset = int(data)
+            except ValueError:
+                self.done = True
+                return False
+            self.start(now)
+            return True
+
+        if data.startswith(b"RETRY"):
+            try:
+                seq_num = int(data.split(b":")[1])
+            except (IndexError, ValueError):
+                return True
+            log.info(f"Received RETRY: {seq_num}", extra=PACKET)
+            self.trace.event(NACK_RECV, seq_num)
+            NACKS.inc(direction="received")
+            self.retransmit(seq_num)
+        elif data.startswith(b"FIN_ACK"):
+            self.trace.event(FIN_ACK_RECV)
+            self.end(True)
+            self.report_speed(self.file_size - self.offset)
+            return True
+        elif data.startswith(b"ACK"):
+            self.trace.event(ACK_RECV)
+        else:
+            self.abort()
+            return False
+        if self.state == "finishing":
+            self.deadline = now + FIN_TIMEOUT
+        return True
+
+    def start(self, now):
+        log.info(f"Client requested offset: {self.offset}")
+        if self.offset >= self.file_size:
+            log.info(f"File {os.path.basename(self.file_name)} is already downloaded")
+            self.done = True
             return
 
-        recv_data_size = 0
-        with open(self.file_name, self.mode) as file:
-            file.seek(0, os.SEEK_END)
-            offset = os.path.getsize(self.file_name)
-            log.info(f"File {self.file_name} offset: {offset}")
-            total_to_receive = file_size - offset
-            log.info(f"File {self.file_name} total to receive: {total_to_receive}")
-
-            received_packets = {}
-            with Progress(
-                TextColumn("[bold blue]{task.description}"),
-                BarColumn(),
-                "[progress.percentage]{task.percentage:>3.1f}%",
-                "•",
-                DownloadColumn(),
-                "•",
-                TransferSpeedColumn(),
-                console=console,
-            ) as progress:
-                task = progress.add_task(
-                    f"[green]Receiving {os.path.basename(self.file_name)}",
-                    total=total_to_receive,
-                )
-
-                start_time = time.time()
-                while True:
-                    data, address = self.socket.recvfrom(READ_BUFFER_SIZE)
-                    recv_data_size += len(data)
-
-                    if data == b"FIN":
-                        log.info("Received FIN before missing packets")
-                        missing_packets = []
-                        for i in range(max(received_packets.keys()) + 1):
-                            if i not in received_packets:
-                                missing_packets.append(i)
-
-                        missing_packets = self.check_missing_packets(received_packets)
-                        if missing_packets:
-                            log.info(f"Missing packets: {missing_packets}")
-                            received_packets = self.retry_missing_packets(
-                                missing_packets, received_packets
-                            )
-
-                        log.info("Sending FIN_ACK")
-                        self.socket.sendto(b"FIN_ACK", address)
-                        _ = self.socket.recvfrom(BUFFER_SIZE)
-                        break
-
-                    if data == b"CTRL_C":
-                        log.info("CTRL_C received, stopping")
-
-                        curr_seq = -1
-                        for seq_num in sorted(received_packets.keys()):
-                            if seq_num - 1 != curr_seq:
-                                log.info(f"Missing packet: {seq_num}")
-                                break
-                            curr_seq = seq_num
-                            file.write(received_packets[seq_num])
-                        return
-
-                    if not data:
-                        log.info(f"File {self.file_name} received, stopping")
-                        break
-
-                    seq_num, file_data = data.split(b":", 1)
-                    seq_num = int(seq_num.decode("utf-8"))
-
-                    received_packets[seq_num] = file_data
-
-                    progress.update(task, advance=len(file_data))
-
-                end_time = time.time()
-                transfer_time = end_time - start_time
-
-                if transfer_time > 0:
-                    speed = recv_data_size / transfer_time / 1024
-                    log.info(f"Average receive speed: {speed:.2f} KB/s")
-
-                log.info(f"Writing {len(received_packets)} packets to file")
-                sorted_seq_nums = sorted(received_packets.keys())
-
-                for seq_num in sorted_seq_nums:
-                    file.write(received_packets[seq_num])
-                received_packets.clear()
+        self.file = open(self.file_name, "rb")
+        self.file.seek(self.offset)
+        self.seq_num = self.offset // BUFFER_SIZE
+        self.state = "sending"
+        self.deadline = None
+        self.begin(SENDING, self.file_size, self.file_size - self.offset)
+        log.info(
+            f"Sending file {os.path.basename(self.file_name)} from {self.offset} to {self.file_size}"
+        )
+
+    def retransmit(self, seq_num):
+        data = os.pread(self.file.fileno(), BUFFER_SIZE, seq_num * BUFFER_SIZE)
+        if self.send(b"%d:%s" % (seq_num, data)):
+            RETRANSMITS.inc()
+            BYTES_OUT.inc(len(data))
+            self.trace.event(RETRANSMIT, seq_num, len(data))
+
+    def advance(self, now):
+        if self.state == "sending":
+            if not self.blocked:
+                self.send_quantum(now)
+        elif self.deadline is not None and now >= self.deadline:
+            if self.state == "offset":
+                log.info(f"No offset for {os.path.basename(self.file_name)}, download dropped")
+                self.done = True
+            else:
+                self.trace.event(TIMEOUT)
+                log.info("Timeout waiting for missing packets")
+                self.end(False)
+
+    def send_quantum(self, now):
+        for _ in range(QUANTUM):
+            if self.pending is None:
+                data = self.file.read(BUFFER_SIZE)
+                if not data:
+                    self.pending, self.pending_size = b"FIN", 0
+                else:
+                    self.pending, self.pending_size = b"%d:%s" % (self.seq_num, data), len(data)
+            if not self.send(self.pending):
+                return
+
+            if self.pending == b"FIN":
+                self.pending = None
+                self.trace.event(FIN_SENT, self.seq_num)
+                log.info("FIN I SENT")
+                self.state = "finishing"
+                self.deadline = now + FIN_TIMEOUT
+                return
+            self.trace.event(SEND, self.seq_num, self.pending_size)
+            self.counter.done += self.pending_size
+            BYTES_OUT.inc(self.pending_size)
+            self.seq_num += 1
+            self.pending = None
+
+    def end(self, completed):
+        super().end(completed)
+        if self.file is not None:
+            self.file.close()
+
+
+class Upload(Transfer):
+    """
+    Receives a file: every packet is written at its place as it arrives
+    and marked in a PacketBitmap. After FIN the missing packets are asked
+    for one at a time with RETRY, then FIN_ACK completes the upload.
+
+    Packets that arrive in order are gathered into one write of up to
+    WRITE_RUN bytes; the run is flushed before every checkpoint, so the
+    bitmap never claims data that is not in the file.
+
+    An interrupted upload keeps its bitmap as ``<file>.bitmap``, so the
+    next UPLOAD of the same file resumes at the first missing packet.
+    """
+
+    direction = "upload"
+    running = {}  # file name -> the Upload writing it
+
+    def __init__(self, sock, file_name, file_size, received, now, on_complete=None):
+        super().__init__(sock, file_name)
+        self.file_size = file_size
+        self.received = received
+        self.bitmap_path = file_name + BITMAP_SUFFIX
+        self.on_complete = on_complete
+        self.offset = received.first_missing() * BUFFER_SIZE
+        self.retrying = None  # the packet last asked for with RETRY
+        self.attempts = 0
+        self.unsaved = 0
+        self.run = bytearray()
+        self.run_offset = 0
+        self.run_next = 0  # the packet that extends the run
+        self.deadline = now + IDLE_TIMEOUT
+
+        self.received.save(self.bitmap_path)  # before the file can have holes
+        self.fd = os.open(file_name, os.O_WRONLY | os.O_CREAT, 0o644)
+        Upload.running[file_name] = self
+        self.begin(RECEIVING, file_size, file_size - min(received.count * BUFFER_SIZE, file_size))
+        log.info(f"File {file_name} offset: {self.offset}")
+
+    @staticmethod
+    def resume_point(file_name, file_size):
+        """
+        What the server already has of an upload.
+
+        An upload of the file still running, typically for a client that
+        restarted from another port, is suspended first, so its progress
+        is in the checkpoint and it cannot overwrite the new one later.
+
+        Returns
+        -------
+        PacketBitmap
+            The saved checkpoint if there is one. Otherwise a file of the
+            announced size counts as complete and a shorter one as received
+            up to its last whole packet; the rest is received again.
+        """
+        previous = Upload.running.get(file_name)
+        if previous is not None:
+            previous.abort()
+        received = PacketBitmap.load(file_name + BITMAP_SUFFIX, file_size, BUFFER_SIZE)
+        if received is not None and os.path.exists(file_name):
+            return received
+        received = PacketBitmap(file_size, BUFFER_SIZE)
+        if os.path.exists(file_name):
+            local_size = os.path.getsize(file_name)
+            if local_size == file_size:
+                received.add_range(0, received.packets)
+            elif local_size < file_size:
+                received.add_range(0, local_size // BUFFER_SIZE)
+        return received
+
+    def on_datagram(self, data, now):
+        """
+        Handles a datagram of the client.
+
+        Returns
+        -------
+        bool
+            False if it is not part of the transfer; the upload is then
+            suspended and the caller treats the datagram as a command.
+        """
+        if not data:
+            return True
+        if data == b"FIN":
+            self.trace.event(FIN_RECV)
+            log.info("Received FIN before missing packets")
+            self.request_next(now)
+            return True
+        if data == b"CTRL_C":
+            self.trace.event(ABORT)
+            log.info("CTRL_C received, stopping")
+            self.suspend()
+            return True
+
+        seq_num, colon, payload = data.partition(b":")
+        if not colon or not seq_num.isdigit():
+            self.trace.event(ABORT)
+            self.suspend()
+            return False
+
+        seq_num = int(seq_num)
+        if seq_num < self.received.packets and self.received.add(seq_num):
+            self.store(seq_num, payload)
+            self.trace.event(RECV, seq_num, len(payload))
+            self.counter.done += len(payload)
+            self.unsaved += 1
+            if self.unsaved >= CHECKPOINT_PACKETS:
+                self.checkpoint()
+
+        if self.retrying is None:
+            self.deadline = now + IDLE_TIMEOUT
+        elif seq_num == self.retrying:
+            log.info(f"Received RETRY: {seq_num}", extra=PACKET)
+            self.send(b"ACK")
+            self.trace.event(ACK_SENT, seq_num)
+            self.request_next(now)
+        return True
+
+    def store(self, seq_num, payload):
+        if seq_num != self.run_next or len(self.run) >= WRITE_RUN:
+            self.flush()
+        if not self.run:
+            self.run_offset = seq_num * BUFFER_SIZE
+        self.run += payload
+        self.run_next = seq_num + 1
+
+    def flush(self):
+        if self.run:
+            os.pwrite(self.fd, self.run, self.run_offset)
+            BYTES_IN.inc(len(self.run))
+            self.run.clear()
+
+    def checkpoint(self):
+        self.flush()
+        self.received.save(self.bitmap_path)
+        self.unsaved = 0
+
+    def request_next(self, now):
+        """Asks for the next missing packet, or completes the upload."""
+        start = 0 if self.retrying is None else self.retrying
+        missing = next(self.received.missing(start), None)
+        if missing is None:
+            self.complete()
+            return
+        if self.retrying is None:
+            log.info(f"Missing packets: {self.received.packets - self.received.count}")
+        self.retrying = missing
+        self.attempts = 0
+        self.send_retry(now)
+
+    def send_retry(self, now):
+        log.info(f"Sending RETRY: {self.retrying}", extra=PACKET)
+        self.send(f"RETRY:{self.retrying}".encode())
+        NACKS.inc(direction="sent")
+        self.trace.event(NACK_SENT, self.retrying)
+        self.attempts += 1
+        self.deadline = now + RETRY_INTERVAL
+
+    def advance(self, now):
+        if self.deadline is None or now < self.deadline:
+            return
+        if self.retrying is not None and self.attempts < RETRY_ATTEMPTS:
+            self.send_retry(now)
+            return
+        self.trace.event(TIMEOUT)
+        log.info(f"Client stopped sending {os.path.basename(self.file_name)}, upload suspended")
+        self.suspend()
+
+    def complete(self):
+        self.flush()
+        os.ftruncate(self.fd, self.file_size)
+        os.close(self.fd)
+        log.info("Sending FIN_ACK")
+        self.send(b"FIN_ACK")
+        self.trace.event(FIN_ACK_SENT)
+        os.remove(self.bitmap_path)
+        self.end(True)
+        self.report_speed(self.file_size - self.offset)
+        if self.on_complete is not None:
+            self.on_complete(self.file_name)
+
+    def suspend(self):
+        """Stops receiving, keeping the checkpoint for the next attempt."""
+        self.checkpoint()
+        os.close(self.fd)
+        self.end(False)
+
+    def abort(self):
+        if not self.done:
+            self.trace.event(ABORT)
+            self.suspend()
+
+    def end(self, completed):
+        super().end(completed)
+        if Upload.running.get(self.file_name) is self:
+            del Upload.running[self.file_name]
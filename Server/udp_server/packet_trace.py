@@ -0,0 +1,160 @@
+"""Compact binary trace of the packets of one transfer.
+
+Tracing is off unless the NP_TRACE_DIR environment variable names a
+directory. Then every transfer writes ``<pid>-<n>-<direction>-<file>.nptrace``
+there: a header followed by one fixed-size record per event::
+
+    header  "NPTR" | version u8 | direction u8 | file size u64 | start (epoch) f64
+            | name length u16 | name
+    record  time since start, ns u64 | sequence number u32 | size u32 | event u8
+
+Records go through a 64 KiB buffered writer, so an event costs one struct
+pack and a memory copy; the file is flushed when the transfer ends.
+bench/trace_analysis.py turns traces into goodput, loss and RTT series.
+"""
+
+import itertools
+import os
+import struct
+import time
+from typing import Iterator, NamedTuple, Tuple
+
+TRACE_DIR = os.environ.get("NP_TRACE_DIR")
+MAGIC = b"NPTR"
+VERSION = 1
+HEADER = struct.Struct("<4sBBQdH")
+RECORD = struct.Struct("<QIIB")
+BUFFER_SIZE = 64 * 1024
+
+# Directions
+SENDING = 0  # the tracing side sends the file
+RECEIVING = 1
+
+# Events
+SEND = 1  # data packet sent for the first time
+RECV = 2  # data packet received
+NACK_SENT = 3  # RETRY requested for a missing packet
+NACK_RECV = 4  # RETRY received from the peer
+RETRANSMIT = 5  # data packet sent again after a RETRY
+ACK_SENT = 6  # ACK of a retransmitted packet
+ACK_RECV = 7
+FIN_SENT = 8
+FIN_RECV = 9
+FIN_ACK_SENT = 10
+FIN_ACK_RECV = 11
+TIMEOUT = 12  # waited in vain for the peer
+ABORT = 13  # the peer cancelled the transfer
+
+EVENT_NAMES = {
+    SEND: "SEND",
+    RECV: "RECV",
+    NACK_SENT: "NACK_SENT",
+    NACK_RECV: "NACK_RECV",
+    RETRANSMIT: "RETRANSMIT",
+    ACK_SENT: "ACK_SENT",
+    ACK_RECV: "ACK_RECV",
+    FIN_SENT: "FIN_SENT",
+    FIN_RECV: "FIN_RECV",
+    FIN_ACK_SENT: "FIN_ACK_SENT",
+    FIN_ACK_RECV: "FIN_ACK_RECV",
+    TIMEOUT: "TIMEOUT",
+    ABORT: "ABORT",
+}
+
+_transfers = itertools.count(1)
+
+
+class TraceHeader(NamedTuple):
+    direction: int
+    file_size: int
+    started: float  # seconds since the epoch
+    name: str
+
+
+class Record(NamedTuple):
+    time_ns: int
+    seq_num: int
+    size: int
+    event: int
+
+
+class PacketTrace:
+    """Writes the trace of one transfer; use ``open_trace`` to get one."""
+
+    def __init__(self, path: str, direction: int, file_name: str, file_size: int):
+        self.file = open(path, "wb", buffering=BUFFER_SIZE)
+        name = os.path.basename(file_name).encode()[:0xFFFF]
+        self.file.write(HEADER.pack(MAGIC, VERSION, direction, file_size, time.time(), len(name)) + name)
+        self.start = time.monotonic_ns()
+        self._write = self.file.write
+        self._pack = RECORD.pack
+
+    def event(self, event: int, seq_num: int = 0, size: int = 0) -> None:
+        self._write(self._pack(time.monotonic_ns() - self.start, seq_num, size, event))
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "PacketTrace":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class NullTrace:
+    """Stands in for PacketTrace when tracing is off."""
+
+    def event(self, event: int, seq_num: int = 0, size: int = 0) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "NullTrace":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+def open_trace(direction: int, file_name: str, file_size: int):
+    """A PacketTrace in TRACE_DIR, or NULL_TRACE when tracing is off."""
+    if not TRACE_DIR:
+        return NULL_TRACE
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    kind = "send" if direction == SENDING else "recv"
+    path = os.path.join(
+        TRACE_DIR, f"{os.getpid()}-{next(_transfers)}-{kind}-{os.path.basename(file_name)}.nptrace"
+    )
+    return PacketTrace(path, direction, file_name, file_size)
+
+
+def read_trace(path: str) -> Tuple[TraceHeader, Iterator[Record]]:
+    """
+    Opens a trace written by PacketTrace.
+
+    Returns
+    -------
+    Tuple[TraceHeader, Iterator[Record]]
+        The header and the records in the order they were written. A record
+        cut short by a crash is ignored.
+    """
+    f = open(path, "rb")
+    magic, version, direction, file_size, started, name_length = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        f.close()
+        raise ValueError(f"{path} is not a version {VERSION} packet trace")
+    header = TraceHeader(direction, file_size, started, f.read(name_length).decode(errors="replace"))
+
+    def records() -> Iterator[Record]:
+        with f:
+            while chunk := f.read(RECORD.size * 4096):
+                usable = len(chunk) - len(chunk) % RECORD.size
+                for fields in RECORD.iter_unpack(chunk[:usable]):
+                    yield Record(*fields)
+
+    return header, records()
@@ -1,13 +1,16 @@
+import argparse
 import os
-import select
+import selectors
 import socket
 import sys
-
-from rich.panel import Panel
+import time
 
 from commander import ServerCommander
+from logging_setup import dropped_records, queued_records, setup_logging
+from profiling import Profiler
+from metrics import ACTIVE_SESSIONS, QUEUE_DEPTH, start_http_server
 from config import (
-    BUFFER_SIZE,
+    READ_BUFFER_SIZE,
     UPLOAD_PATH,
     SERVER_FILES_PATH,
     SIZE_FOR_WRITE,
@@ -15,18 +18,27 @@ from config import (
     WRITE_BUFFER_SIZE,
     HOST,
     PORT,
+    METRICS_PORT,
     console,
     log,
 )
 
+RECV_BUDGET = 1024  # datagrams read from the server port per loop iteration
+IDLE_WAIT = 0.1  # longest select() wait, so that stop() is noticed
+LINGER = 2.0  # seconds a finished transfer's socket swallows late datagrams before it is closed
+
 
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, metrics_port=METRICS_PORT):
         self.host = host
         self.port = port
+        self.metrics_port = metrics_port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_running = True
         self.active_clients = {}  # Dictionary to track active clients and their state
+        self.selector = selectors.DefaultSelector()
+        self.transfers = {}  # transfer socket -> Transfer, until the socket is closed
+        self.closing = {}  # socket of a finished transfer -> when to close it
 
     def start(self):
         self.server_socket.setsockopt(
@@ -39,15 +51,20 @@ class Server:
 
         try:
             self.server_socket.bind((self.host, self.port))
+            # kill -USR2 <pid> profiles the server for a while, see profiling.py.
+            Profiler("udp_server", ("handle_datagram", "receive", "advance"), report=log.info).install()
+            if self.metrics_port:
+                start_http_server(self.metrics_port)
+                ACTIVE_SESSIONS.set_function(lambda: len(self.active_clients))
+                QUEUE_DEPTH.set_function(lambda: queued_records(log), queue="log")
             self.server_socket.setblocking(False)  # Set socket to non-blocking mode
 
-            console.print(
-                Panel.fit(
-                    f"[bold green]UDP Server started[/]\n"
-                    f"Listening on: [cyan]{self.host}:{self.port}[/]\n"
-                    f"Upload directory: [yellow]{os.path.abspath(UPLOAD_PATH)}[/]\n"
-                    f"Server files: [yellow]{os.path.abspath(SERVER_FILES_PATH)}[/]"
-                )
+            console.panel(
+                f"[bold green]UDP Server started[/]\n"
+                f"Listening on: [cyan]{self.host}:{self.port}[/]\n"
+                f"Upload directory: [yellow]{os.path.abspath(UPLOAD_PATH)}[/]\n"
+                f"Server files: [yellow]{os.path.abspath(SERVER_FILES_PATH)}[/]",
+                fit=True,
             )
 
             os.makedirs(UPLOAD_PATH, exist_ok=True)
@@ -61,49 +78,35 @@ class Server:
     def stop(self):
         self.server_running = False
         self.server_socket.close()
-        log.info("Server stopped")
+        log.info(f"Server stopped. Log records dropped: {dropped_records(log)}")
         console.print("[bold yellow]Server is shutting down. Goodbye![/]")
 
     def multiplexed_client_handler(self):
-        inputs = [self.server_socket]
+        # One thread serves every client. The server port only carries
+        # commands; every transfer runs on a connected socket of its own and
+        # is a state machine that advances a quantum per iteration, so a
+        # large upload or download never holds up the others or a TIME or
+        # ECHO.
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
 
         while self.server_running:
             try:
-                # Use select to multiplex between different clients
-                readable, _, exceptional = select.select(inputs, [], inputs, 0.1)
-
-                for sock in readable:
-                    if sock is self.server_socket:
-                        # Handle incoming data from any client
-                        try:
-                            msg, client_address = self.server_socket.recvfrom(
-                                BUFFER_SIZE
-                            )
-
-                            # Create a new commander for this client if it doesn't exist
-                            if client_address not in self.active_clients:
-                                commander = ServerCommander(self.server_socket)
-                                commander.set_client_address(client_address)
-                                self.active_clients[client_address] = commander
-                            else:
-                                commander = self.active_clients[client_address]
-
-                            # Process the command
-                            commander.handle_command(msg.decode("utf-8"))
-
-                            # Remove inactive clients
-                            if not commander.client_is_active:
-                                del self.active_clients[client_address]
-
-                        except BlockingIOError:
-                            # No data available, continue to next iteration
-                            pass
-
-                # Check for exceptional conditions
-                for sock in exceptional:
-                    log.error(f"Exception condition on socket {sock}")
-                    inputs.remove(sock)
-                    sock.close()
+                for key, mask in self.selector.select(self.wait_time(time.monotonic())):
+                    now = time.monotonic()
+                    if key.fileobj is self.server_socket:
+                        self.receive(now)
+                        continue
+                    transfer = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        transfer.blocked = False
+                    if mask & selectors.EVENT_READ:
+                        self.step(transfer, transfer.receive, now)
+
+                now = time.monotonic()
+                for transfer in list(self.transfers.values()):
+                    if not transfer.done:
+                        self.step(transfer, transfer.advance, now)
+                    self.update_interest(transfer, now)
 
             except KeyboardInterrupt:
                 self.stop()
@@ -112,13 +115,100 @@ class Server:
                 log.error(f"Error in multiplexed handler: {e}")
                 console.print(f"[bold red]ERROR:[/] {e}")
 
+        # Running uploads keep their checkpoints for the next start.
+        for sock, transfer in list(self.transfers.items()):
+            try:
+                transfer.abort()
+            except OSError:
+                pass
+            self.close_transfer(sock)
         self.server_socket.close()
 
+    def step(self, transfer, action, now):
+        """Runs one step of a transfer; an OSError ends the transfer, not the server."""
+        try:
+            action(now)
+        except OSError as e:
+            if not transfer.done:
+                log.error(f"Transfer of {transfer.file_name} failed: {e}")
+                transfer.abort()
+
+    def update_interest(self, transfer, now):
+        sock = transfer.sock
+        if transfer.done:
+            if sock not in self.closing:
+                self.closing[sock] = now + LINGER
+                self.selector.modify(sock, selectors.EVENT_READ, transfer)
+            elif now >= self.closing[sock]:
+                self.close_transfer(sock)
+            return
+
+        events = selectors.EVENT_READ
+        if transfer.blocked:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events, transfer)
+
+    def close_transfer(self, sock):
+        self.selector.unregister(sock)
+        sock.close()
+        del self.transfers[sock]
+        self.closing.pop(sock, None)
+
+    def wait_time(self, now):
+        """How long select() may sleep: until the next timer, or not at all."""
+        wait = IDLE_WAIT
+        for sock, transfer in self.transfers.items():
+            if transfer.done:
+                wait = min(wait, self.closing.get(sock, now) - now)
+            elif transfer.ready():
+                return 0
+            elif transfer.deadline is not None:
+                wait = min(wait, transfer.deadline - now)
+        return max(wait, 0)
+
+    def receive(self, now):
+        """Hands up to RECV_BUDGET waiting datagrams to the commanders of their clients."""
+        for _ in range(RECV_BUDGET):
+            try:
+                msg, client_address = self.server_socket.recvfrom(READ_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+
+            # Create a new commander for this client if it doesn't exist
+            commander = self.active_clients.get(client_address)
+            if commander is None:
+                commander = ServerCommander(self.server_socket)
+                commander.set_client_address(client_address)
+                self.active_clients[client_address] = commander
+
+            commander.handle_datagram(msg, now)
+            transfer = commander.transfer
+            if transfer is not None and transfer.sock not in self.transfers:
+                self.transfers[transfer.sock] = transfer
+                self.selector.register(transfer.sock, selectors.EVENT_READ, transfer)
+
+            # Remove inactive clients
+            if not commander.client_is_active:
+                del self.active_clients[client_address]
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP file server")
+    parser.add_argument("--host", default=HOST, help="Address to bind to")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="Serve Prometheus metrics on this local port, 0 to disable",
+    )
+    args = parser.parse_args()
+    setup_logging()
+
     try:
         console.print("[bold blue]===== UDP File Server =====")
-        server = Server(HOST, PORT)
+        server = Server(args.host, args.port, args.metrics_port)
         server.start()
     except KeyboardInterrupt:
         console.print("\n[yellow]Keyboard interrupt detected[/]")
@@ -0,0 +1,610 @@
+"""Loopback benchmark for every server of the repository.
+
+Each scenario of the matrix ``server x file size x concurrency x command
+mix`` starts a fresh server as a subprocess on a free loopback port, in a
+scratch directory holding the test file, and drives it for a fixed time
+with headless clients (one thread and one connection or UDP socket each).
+
+The results are written as JSON: throughput, per-command p50/p99 latency,
+server CPU time and peak RSS (from ``wait4`` on the server process) and the
+CPU time of the clients. A stored result can serve as the baseline of a
+later run, which then reports every metric that got worse by more than the
+threshold and exits with status 1::
+
+    python bench/bench.py run --sizes 1K,1M,64M --concurrency 1,8 -o base.json
+    python bench/bench.py run --sizes 1K,1M,64M --concurrency 1,8 --baseline base.json
+    python bench/bench.py compare base.json new.json --threshold 0.2
+
+With ``--impair`` the clients reach the server through the impairment
+proxy of impair.py (its CPU time counts as client time).
+
+Every run also records how fast each client and server starts: the
+``python -X importtime`` total of its module and the wall time of a cold
+interpreter importing it, best of a few runs. ``bench.py startup`` measures
+only that.
+
+UDP payloads travel as UTF-8 text, so the test files are ASCII.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import resource
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from drivers import DRIVERS
+from impair import PROXIES, Impairment, impairment_from_args, impairment_parser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (script, driver, transport, where downloads are served from, where uploads land)
+SERVERS = {
+    "tcp": ("Server/tcp_server/TCPServer.py", "framed", socket.SOCK_STREAM, ".", "."),
+    "lab3": ("server_lab3/server3.py", "framed", socket.SOCK_STREAM, ".", "."),
+    "udp": ("Server/udp_server/server.py", "udp", socket.SOCK_DGRAM, "server_files", "upload_files"),
+    "lab4": ("server_lab4/server.py", "udp", socket.SOCK_DGRAM, "server_files", "upload_files"),
+}
+
+# Servers benchmarked with the control mix only. server_lab4's listener
+# thread takes the datagrams of a transfer off the shared socket, so its
+# downloads and uploads time out with any client.
+CONTROL_ONLY = {"lab4"}
+
+# name: [(operation, weight)], operations are picked in a fixed weighted order.
+MIXES = {
+    "control": [("echo", 1), ("time", 1)],
+    "download": [("download", 1)],
+    "upload": [("upload", 1)],
+    "mixed": [("echo", 4), ("time", 2), ("download", 1), ("upload", 1)],
+}
+
+# name: (directory, module) of every program whose start-up is tracked
+ENTRY_POINTS = {
+    "client": ("Client", "client"),
+    "tcp-client": ("Client", "TCPClient"),
+    "udp-client": ("Client", "UDPClient"),
+    "lab3-client": ("client_lab3", "lab3-client"),
+    "lab4-client": ("client_lab4", "lab4-client"),
+    "tcp": ("Server/tcp_server", "TCPServer"),
+    "lab3": ("server_lab3", "server3"),
+    "udp": ("Server/udp_server", "server"),
+    "lab4": ("server_lab4", "server"),
+}
+STARTUP_RUNS = 5
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+FILL_BLOCK = (b"0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-_\n" * 16384)  # 1 MiB
+STARTUP_TIMEOUT = 15.0
+SHUTDOWN_TIMEOUT = 10.0
+
+# start-up metric: True when bigger is better
+STARTUP_COMPARED = {
+    "import_ms": False,
+    "startup_ms": False,
+}
+
+# metric: True when bigger is better
+COMPARED = {
+    "throughput_mib_s": True,
+    "ops_per_s": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "server_cpu_ms_per_op": False,
+    "server_peak_rss_kib": False,
+}
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().removesuffix("B")
+    unit = text[-1] if text and text[-1] in UNITS else ""
+    return int(float(text[: len(text) - len(unit)]) * UNITS[unit])
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """Nearest-rank percentile of ``values``, 0 when empty."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(fraction * len(ordered))) - 1]
+
+
+def free_port(kind: int) -> int:
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def ensure_test_file(data_dir: str, size: int) -> str:
+    """Creates (once) an ASCII file of ``size`` bytes and returns its path."""
+    path = os.path.join(data_dir, f"bench-{size}.txt")
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return path
+    with open(path + ".tmp", "wb") as f:
+        remaining = size
+        while remaining:
+            remaining -= f.write(FILL_BLOCK[: min(len(FILL_BLOCK), remaining)])
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def measure_startup(name: str, runs: int = STARTUP_RUNS) -> dict:
+    """
+    Cold-start cost of one entry point, best of ``runs``.
+
+    Returns
+    -------
+    dict
+        ``import_ms``: what ``-X importtime`` charges to the module;
+        ``startup_ms``: wall time of ``python -c "import <module>"``,
+        interpreter start included; ``modules``: modules it loaded;
+        ``rich_loaded``; ``heaviest``: the five costliest imports by
+        self time.
+    """
+    directory, module = ENTRY_POINTS[name]
+    cwd = os.path.join(ROOT, directory)
+    code = f"__import__({module!r})"  # also takes the hyphenated client names
+    env = dict(os.environ, NP_HEADLESS="1")
+
+    best_wall = best_import = float("inf")
+    lines: List[Tuple[int, int, str]] = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        best_wall = min(best_wall, time.perf_counter() - started)
+
+        traced = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=cwd, env=env,
+                                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        parsed = []
+        for line in traced.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            own, cumulative, imported = line[len("import time:"):].split("|", 2)
+            parsed.append((int(own), int(cumulative), imported.strip()))
+        total = next(cumulative for _, cumulative, imported in reversed(parsed) if imported == module)
+        if total < best_import:
+            best_import, lines = total, parsed
+
+    heaviest = sorted(lines, reverse=True)[:5]
+    return {
+        "import_ms": round(best_import / 1000, 2),
+        "startup_ms": round(best_wall * 1000, 2),
+        "modules": len(lines),
+        "rich_loaded": any(imported.split(".")[0] == "rich" for _, _, imported in lines),
+        "heaviest": [[imported, round(own / 1000, 2)] for own, _, imported in heaviest],
+    }
+
+
+def measure_all_startups(runs: int = STARTUP_RUNS) -> Dict[str, dict]:
+    results = {}
+    for name in ENTRY_POINTS:
+        results[name] = measure_startup(name, runs)
+        print(
+            f"    {name}: import {results[name]['import_ms']} ms, start {results[name]['startup_ms']} ms"
+            f"{', rich loaded' if results[name]['rich_loaded'] else ''}",
+            file=sys.stderr,
+            flush=True,
+        )
+    return results
+
+
+class ServerProcess:
+    """
+    One server started as a subprocess inside a scratch directory.
+
+    Parameters
+    ----------
+    name : str
+        Key of SERVERS.
+    workdir : str
+        Current directory of the server; relative file names resolve here.
+    log_path : str
+        Receives the server's stdout and stderr.
+    """
+
+    def __init__(self, name: str, workdir: str, log_path: str):
+        script, _, kind, _, _ = SERVERS[name]
+        self.kind = kind
+        self.port = free_port(kind)
+        self.log = open(log_path, "wb")
+        env = dict(os.environ, NP_HEADLESS="1", PYTHONUNBUFFERED="1")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, script), "--host", "127.0.0.1",
+             "--port", str(self.port), "--metrics-port", "0"],
+            cwd=workdir,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        self.rusage: Optional[resource.struct_rusage] = None
+
+    def wait_ready(self) -> None:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if os.waitid(os.P_PID, self.process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT):
+                raise RuntimeError(f"Server exited during startup, see {self.log.name}")
+            try:
+                if self.kind == socket.SOCK_STREAM:
+                    socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                else:
+                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                        sock.settimeout(0.5)
+                        sock.sendto(b"TIME", ("127.0.0.1", self.port))
+                        sock.recv(1024)
+                        sock.sendto(b"QUIT", ("127.0.0.1", self.port))
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Server did not come up on port {self.port}")
+
+    def stop(self) -> None:
+        """Interrupts the server and collects its resource usage."""
+        # Reaped with wait4 rather than Popen.wait, which would drop the rusage.
+        self.process.send_signal(signal.SIGINT)
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while True:
+            pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+            if pid:
+                self.process.returncode = os.waitstatus_to_exitcode(status)
+                self.rusage = rusage
+                break
+            if time.monotonic() > deadline:
+                self.process.kill()
+                deadline = float("inf")
+            time.sleep(0.05)
+        self.log.close()
+
+
+class Scenario:
+    def __init__(self, server: str, size: int, concurrency: int, mix: str):
+        self.server = server
+        self.size = size
+        self.concurrency = concurrency
+        self.mix = mix
+
+    @property
+    def key(self) -> Tuple[str, int, int, str]:
+        return self.server, self.size, self.concurrency, self.mix
+
+    def __str__(self) -> str:
+        return f"{self.server} size={self.size} c={self.concurrency} mix={self.mix}"
+
+
+def client_loop(
+    scenario: Scenario,
+    index: int,
+    port: int,
+    source: str,
+    upload_dir: str,
+    deadline: float,
+    max_ops: int,
+    results: Dict[str, list],
+) -> None:
+    """Runs operations of the scenario's mix until the deadline."""
+    _, driver, _, _, _ = SERVERS[scenario.server]
+    schedule = [op for op, weight in MIXES[scenario.mix] for _ in range(weight)]
+    ops = itertools.islice(itertools.cycle(schedule), index % len(schedule), None)
+    token = f"bench-{os.getpid()}-{index}"
+    remote_name = os.path.basename(source)
+
+    try:
+        client = DRIVERS[driver]("127.0.0.1", port, token)
+    except OSError as e:
+        results["errors"].append(f"connect: {e}")
+        return
+
+    done = 0
+    try:
+        for op in ops:
+            if done and (time.monotonic() >= deadline or done == max_ops):
+                break
+            done += 1
+            upload_name = f"{token}-{done}.txt"
+            started = time.perf_counter()
+            try:
+                if op == "download":
+                    moved = client.download(remote_name)
+                elif op == "upload":
+                    moved = client.upload(source, upload_name)
+                else:
+                    moved = getattr(client, op)()
+            except Exception as e:
+                results["errors"].append(f"{op}: {type(e).__name__}: {e}")
+                if isinstance(e, (ConnectionError, BrokenPipeError)):
+                    break
+                continue
+            finally:
+                if op == "upload":
+                    try:
+                        os.unlink(os.path.join(upload_dir, upload_name))
+                    except OSError:
+                        pass
+            results["latency"].append((op, time.perf_counter() - started))
+            results["bytes"].append(moved)
+    finally:
+        client.close()
+
+
+def run_scenario(
+    scenario: Scenario,
+    data_dir: str,
+    duration: float,
+    max_ops: int,
+    keep: bool,
+    impairment: Optional[Impairment] = None,
+) -> dict:
+    _, driver, kind, files_dir, upload_dir = SERVERS[scenario.server]
+    workdir = tempfile.mkdtemp(prefix=f"bench-{scenario.server}-")
+    for sub in (files_dir, upload_dir):
+        os.makedirs(os.path.join(workdir, sub), exist_ok=True)
+
+    source = ensure_test_file(data_dir, scenario.size)
+    os.symlink(source, os.path.join(workdir, files_dir, os.path.basename(source)))
+
+    server = ServerProcess(scenario.server, workdir, os.path.join(workdir, "server.log"))
+    results: Dict[str, list] = {"latency": [], "bytes": [], "errors": []}
+    proxy = None
+    try:
+        server.wait_ready()
+        port = server.port
+        if impairment:
+            proxy_class = PROXIES["udp" if kind == socket.SOCK_DGRAM else "tcp"]
+            proxy = proxy_class(("127.0.0.1", 0), ("127.0.0.1", server.port), impairment).start()
+            port = proxy.address[1]
+        client_cpu = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.perf_counter()
+        deadline = time.monotonic() + duration
+        threads = [
+            threading.Thread(
+                target=client_loop,
+                args=(scenario, i, port, source, os.path.join(workdir, upload_dir),
+                      deadline, max_ops, results),
+                daemon=True,
+            )
+            for i in range(scenario.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+        client_usage = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        if proxy:
+            proxy.stop()
+        server.stop()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies: Dict[str, List[float]] = {}
+    for op, seconds in results["latency"]:
+        latencies.setdefault(op, []).append(seconds)
+    every = [seconds for _, seconds in results["latency"]]
+    ops = len(every)
+    server_cpu = server.rusage.ru_utime + server.rusage.ru_stime
+
+    return {
+        "server": scenario.server,
+        "size": scenario.size,
+        "concurrency": scenario.concurrency,
+        "mix": scenario.mix,
+        "wall_s": round(wall, 4),
+        "ops": ops,
+        "errors": len(results["errors"]),
+        "error_samples": results["errors"][:5],
+        "bytes": sum(results["bytes"]),
+        "throughput_mib_s": round(sum(results["bytes"]) / wall / 1024 ** 2, 3),
+        "ops_per_s": round(ops / wall, 2),
+        "latency_p50_ms": round(percentile(every, 0.50) * 1000, 3),
+        "latency_p99_ms": round(percentile(every, 0.99) * 1000, 3),
+        "commands": {
+            op: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            }
+            for op, values in sorted(latencies.items())
+        },
+        "server_cpu_s": round(server_cpu, 4),
+        "server_cpu_ms_per_op": round(server_cpu * 1000 / ops, 4) if ops else 0.0,
+        "server_peak_rss_kib": server.rusage.ru_maxrss,
+        "client_cpu_s": round(
+            client_usage.ru_utime + client_usage.ru_stime - client_cpu.ru_utime - client_cpu.ru_stime, 4
+        ),
+        "server_exit_code": server.process.returncode,
+        "impairment": proxy.stats() if proxy else None,
+    }
+
+
+def scenario_key(result: dict) -> Tuple[str, int, int, str]:
+    return result["server"], result["size"], result["concurrency"], result["mix"]
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """
+    Lists the metrics of ``current`` that are worse than in ``baseline``.
+
+    Parameters
+    ----------
+    baseline, current : dict
+        Documents written by ``run``.
+    threshold : float
+        Relative change tolerated before a metric counts as a regression.
+
+    Returns
+    -------
+    List[str]
+        One line per regression; scenarios missing from either side are ignored.
+    """
+    previous = {scenario_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = previous.get(scenario_key(result))
+        if old is None:
+            continue
+        name = "{} size={} c={} mix={}".format(*scenario_key(result))
+        if result["errors"] > old["errors"]:
+            regressions.append(f"{name}: errors {old['errors']} -> {result['errors']}")
+        for metric, higher_is_better in COMPARED.items():
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append(f"{name}: {metric} {before} -> {after} ({change:+.1%})")
+
+    for name, result in current.get("startup", {}).items():
+        old = baseline.get("startup", {}).get(name)
+        if old is None:
+            continue
+        if result["rich_loaded"] and not old["rich_loaded"]:
+            regressions.append(f"startup {name}: now imports rich")
+        for metric in STARTUP_COMPARED:
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if change > threshold:
+                regressions.append(f"startup {name}: {metric} {before} -> {after} ({change:+.1%})")
+    return regressions
+
+
+def report(regressions: List[str]) -> int:
+    if not regressions:
+        print("No regressions.")
+        return 0
+    print(f"{len(regressions)} regression(s):")
+    for line in regressions:
+        print(f"  {line}")
+    return 1
+
+
+def run(args: argparse.Namespace) -> int:
+    impairment = impairment_from_args(impairment_parser().parse_args(shlex.split(args.impair)))
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(), "np-bench-data")
+    os.makedirs(data_dir, exist_ok=True)
+
+    scenarios = [
+        Scenario(server, parse_size(size), concurrency, mix)
+        for server in args.servers.split(",")
+        for size in args.sizes.split(",")
+        for concurrency in map(int, args.concurrency.split(","))
+        for mix in args.mixes.split(",")
+    ]
+    for scenario in scenarios:
+        if scenario.server not in SERVERS or scenario.mix not in MIXES:
+            sys.exit(f"Unknown server or mix in {scenario}")
+    skipped = [scenario for scenario in scenarios if scenario.server in CONTROL_ONLY and scenario.mix != "control"]
+    if skipped:
+        servers = ", ".join(sorted({scenario.server for scenario in skipped}))
+        print(f"Skipping {len(skipped)} transfer scenarios of {servers}: control mix only", file=sys.stderr)
+        scenarios = [scenario for scenario in scenarios if scenario not in skipped]
+    # Size only matters to transfers; control-only scenarios run once.
+    for scenario in scenarios:
+        if scenario.mix == "control":
+            scenario.size = 0
+    scenarios = list({scenario.key: scenario for scenario in scenarios}.values())
+
+    document = {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "duration_s": args.duration,
+            "impairment": str(impairment),
+        },
+        "results": [],
+    }
+    if not args.no_startup:
+        print("Start-up times", file=sys.stderr, flush=True)
+        document["startup"] = measure_all_startups()
+    for number, scenario in enumerate(scenarios, 1):
+        print(f"[{number}/{len(scenarios)}] {scenario}", file=sys.stderr, flush=True)
+        result = run_scenario(scenario, data_dir, args.duration, args.ops, args.keep, impairment)
+        print(
+            f"    {result['throughput_mib_s']} MiB/s, {result['ops_per_s']} ops/s, "
+            f"p50 {result['latency_p50_ms']} ms, p99 {result['latency_p99_ms']} ms, "
+            f"{result['errors']} errors",
+            file=sys.stderr,
+            flush=True,
+        )
+        document["results"].append(result)
+
+    text = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            return report(compare(json.load(f), document, args.threshold))
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the servers")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmark matrix")
+    run_parser.add_argument("--servers", default=",".join(SERVERS), help="Comma separated, from: " + ", ".join(SERVERS))
+    run_parser.add_argument("--sizes", default="1K,1M,16M", help="Comma separated file sizes, e.g. 1K,64M,4G")
+    run_parser.add_argument("--concurrency", default="1,4", help="Comma separated numbers of parallel clients")
+    run_parser.add_argument("--mixes", default=",".join(MIXES), help="Comma separated, from: " + ", ".join(MIXES))
+    run_parser.add_argument("--duration", type=float, default=3.0, help="Seconds each scenario runs (every client finishes at least one operation)")
+    run_parser.add_argument("--ops", type=int, default=0, help="Stop each client after this many operations, 0 for no limit")
+    run_parser.add_argument("--data-dir", help="Where the test files are generated and kept between runs")
+    run_parser.add_argument("--keep", action="store_true", help="Keep the scratch directories and server logs")
+    run_parser.add_argument("--impair", default="", help='Route the clients through bench/impair.py with these options, e.g. "--loss 0.01 --delay 20"')
+    run_parser.add_argument("-o", "--output", help="Write the JSON here instead of stdout")
+    run_parser.add_argument("--baseline", help="Compare against this earlier result")
+    run_parser.add_argument("--threshold", type=float, default=0.10, help="Tolerated relative change, by default 0.10")
+
+    run_parser.add_argument("--no-startup", action="store_true", help="Skip the start-up measurements")
+
+    startup_parser = commands.add_parser("startup", help="Measure only the start-up of every client and server")
+    startup_parser.add_argument("--runs", type=int, default=STARTUP_RUNS, help="Best of this many cold starts")
+    startup_parser.add_argument("-o", "--output", help="Write the JSON here instead of stdout")
+
+    compare_parser = commands.add_parser("compare", help="Compare two stored results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="Tolerated relative change, by default 0.10")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        return run(args)
+    if args.command == "startup":
+        text = json.dumps({"startup": measure_all_startups(args.runs)}, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    return report(compare(baseline, current, args.threshold))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,660 @@
+"""Headless clients the benchmark drives the servers with.
+
+Each driver speaks one wire protocol and exposes the same four operations
+(``echo``, ``time``, ``download``, ``upload``). An operation returns the
+number of file bytes it moved and raises on any protocol violation or
+timeout, so the runner can count it as an error and carry on.
+
+The blocking drivers serve bench.py (one thread per client); the asyncio
+ones serve loadgen.py, which runs thousands of clients in one thread.
+"""
+
+import asyncio
+import os
+import re
+import select
+import socket
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from protocol import (
+    DOWNLOAD_REPLY,
+    HEADER,
+    MAX_PAYLOAD,
+    OP_CLOSE,
+    OP_DONE,
+    OP_DOWNLOAD,
+    OP_ECHO,
+    OP_HELLO,
+    OP_NAMES,
+    OP_OK,
+    OP_TIME,
+    OP_UPLOAD,
+    TRANSFER,
+    Frame,
+    ProtocolError,
+    encode_frame,
+    pack_transfer,
+    pack_upload,
+    recv_frame,
+    send_frame,
+)
+
+TIMEOUT = 10.0  # seconds without progress before an operation fails
+RECV_CHUNK = 256 * 1024
+ECHO_PAYLOAD = "benchmark-echo-" + "x" * 49  # 64 bytes
+
+UDP_TIMEOUT = 2.0  # seconds before a command that got no reply is sent again
+UDP_ATTEMPTS = 5  # sends of one request, or starts of one transfer, before giving up
+UDP_RETRY_TIMEOUT = 0.25  # seconds before a RETRY is sent again, well below the servers' FIN timeout
+UDP_STREAM_IDLE = 0.5  # a download stream silent this long has lost its FIN
+UDP_FIN_TIMEOUT = 1.0  # an upload's FIN is sent again after this long without a RETRY or FIN_ACK
+UDP_PACKET_SIZE = 1024  # file bytes per datagram, fixed by the UDP servers
+UDP_RECV_SIZE = 16384
+UDP_SNDBUF = 1024 * 32768
+UDP_RCVBUF = 425984
+
+
+TRANSFER_REPLY = re.compile(rb"\d+( \d+)?")  # "<size or offset>[ <transfer port>]"
+TIME_REPLY = re.compile(rb"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+
+
+class BenchError(Exception):
+    """An operation did not complete the way the protocol says it should."""
+
+
+def _packet(data: bytes) -> Optional[Tuple[int, int]]:
+    """Sequence number and payload length of a ``<seq>:<bytes>`` datagram, None for anything else."""
+    seq_num, colon, payload = data.partition(b":")
+    if not colon or not seq_num.isdigit():
+        return None
+    return int(seq_num), len(payload)
+
+
+def _first_missing(received: Dict[int, int], packets: int) -> int:
+    return next((seq_num for seq_num in range(packets) if seq_num not in received), packets)
+
+
+class FramedClient:
+    """
+    Client for the framed protocol of TCPServer and server3.
+
+    Parameters
+    ----------
+    host : str
+        Server address.
+    port : int
+        Server port.
+    token : str
+        Sent with HELLO so resume state never leaks between bench clients.
+    """
+
+    def __init__(self, host: str, port: int, token: str):
+        self.sock = socket.create_connection((host, port), timeout=TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray(RECV_CHUNK)
+        self.request_id = 0
+        self.request(OP_HELLO, token.encode())
+
+    def _next_id(self) -> int:
+        self.request_id += 1
+        return self.request_id
+
+    def _expect(self, request_id: int, opcode: int) -> bytes:
+        frame = recv_frame(self.sock)
+        if frame.request_id != request_id or frame.opcode != opcode:
+            raise BenchError(
+                f"Expected {OP_NAMES[opcode]} #{request_id}, got "
+                f"{OP_NAMES.get(frame.opcode, frame.opcode)} #{frame.request_id}: {frame.payload[:80]!r}"
+            )
+        return frame.payload
+
+    def request(self, opcode: int, payload: bytes = b"") -> bytes:
+        request_id = self._next_id()
+        send_frame(self.sock, request_id, opcode, payload)
+        return self._expect(request_id, OP_OK)
+
+    def echo(self) -> int:
+        if self.request(OP_ECHO, ECHO_PAYLOAD.encode()) != ECHO_PAYLOAD.encode():
+            raise BenchError("ECHO reply does not match the request")
+        return 0
+
+    def time(self) -> int:
+        self.request(OP_TIME)
+        return 0
+
+    def download(self, name: str) -> int:
+        request_id = self._next_id()
+        send_frame(self.sock, request_id, OP_DOWNLOAD, pack_transfer(0, name))
+        starts_from, size = DOWNLOAD_REPLY.unpack(self._expect(request_id, OP_OK))
+
+        remaining = size - starts_from
+        while remaining:
+            n = self.sock.recv_into(self.buffer, min(RECV_CHUNK, remaining))
+            if not n:
+                raise ConnectionError("Connection closed during download")
+            remaining -= n
+        self._expect(request_id, OP_DONE)
+        return size - starts_from
+
+    def upload(self, path: str, name: str) -> int:
+        size = os.path.getsize(path)
+        request_id = self._next_id()
+        send_frame(self.sock, request_id, OP_UPLOAD, pack_upload(size, os.stat(path).st_mtime_ns, name))
+        (offset,) = TRANSFER.unpack(self._expect(request_id, OP_OK))
+
+        with open(path, "rb") as f:
+            if size > offset:
+                self.sock.sendfile(f, offset, size - offset)
+        self._expect(request_id, OP_DONE)
+        return size - offset
+
+    def close(self) -> None:
+        try:
+            send_frame(self.sock, self._next_id(), OP_CLOSE)
+            recv_frame(self.sock)
+        except OSError:
+            pass
+        finally:
+            self.sock.close()
+
+
+class UDPClient:
+    """
+    Client for the text protocol of the two UDP servers.
+
+    Mirrors the exchange of Client/UDPClient.py, including RETRY handling,
+    but keeps nothing on disk and never prints. Any datagram may be lost:
+    requests are sent again until their reply arrives, replies are told
+    apart by their content, and a transfer whose server side gave up is
+    started again from what already arrived.
+    """
+
+    def __init__(self, host: str, port: int, token: str):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SNDBUF)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+        self.sock.connect(self.address)
+
+    def _send(self, data: bytes) -> None:
+        self.sock.send(data)
+
+    def _recv(self, timeout: float = UDP_TIMEOUT) -> bytes:
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        if not ready:
+            raise TimeoutError("No reply from the UDP server")
+        return self.sock.recv(UDP_RECV_SIZE)
+
+    def _ask(self, request: bytes, accept: Callable[[bytes], object], timeout: float = UDP_TIMEOUT) -> bytes:
+        """Sends ``request`` until a datagram ``accept`` is true for arrives, and returns it."""
+        for _ in range(UDP_ATTEMPTS):
+            self._send(request)
+            deadline = time.monotonic() + timeout
+            while (left := deadline - time.monotonic()) > 0:
+                try:
+                    data = self._recv(left)
+                except TimeoutError:
+                    break
+                if accept(data):
+                    return data
+        raise TimeoutError(f"No reply to {request[:32]!r} from the UDP server")
+
+    def _drain(self) -> None:
+        """Drops datagrams left over from a failed operation."""
+        while select.select([self.sock], [], [], 0)[0]:
+            self.sock.recv(UDP_RECV_SIZE)
+
+    def _transfer(self, reply: bytes) -> int:
+        """
+        The number in a DOWNLOAD or UPLOAD reply.
+
+        ``Server/udp_server`` appends the port of the transfer's own socket;
+        the socket is connected there until ``_release``.
+        """
+        value, _, port = reply.partition(b" ")
+        if port:
+            self.sock.connect((self.address[0], int(port)))
+        return int(value)
+
+    def _release(self) -> None:
+        self.sock.connect(self.address)
+
+    def echo(self) -> int:
+        self._drain()
+        # A late or duplicated reply to an earlier request may come first.
+        self._ask(f"ECHO {ECHO_PAYLOAD}".encode(), lambda data: data == ECHO_PAYLOAD.encode())
+        return 0
+
+    def time(self) -> int:
+        self._drain()
+        self._ask(b"TIME", TIME_REPLY.fullmatch)
+        return 0
+
+    def download(self, name: str) -> int:
+        self._drain()
+        received: Dict[int, int] = {}
+        for _ in range(UDP_ATTEMPTS):
+            size = self._transfer(self._ask(f"DOWNLOAD {name}".encode(), TRANSFER_REPLY.fullmatch))
+            if not size:
+                self._release()
+                raise BenchError(f"{name} not found on the server")
+            try:
+                if self._receive(size, received):
+                    break
+            finally:
+                self._release()
+        else:
+            raise TimeoutError(f"Download of {name} did not complete")
+
+        moved = sum(received.values())
+        if moved != size:
+            raise BenchError(f"Downloaded {moved} of {size} bytes")
+        return moved
+
+    def _receive(self, size: int, received: Dict[int, int]) -> bool:
+        """
+        Receives the packets of a download not in ``received`` yet.
+
+        Returns
+        -------
+        bool
+            False if the server stopped answering first.
+        """
+        packets = -(-size // UDP_PACKET_SIZE)
+        # The first packet answers the offset. A second offset would end a
+        # running download, so it is sent again only after a long silence.
+        try:
+            data = self._ask(
+                b"%d" % (_first_missing(received, packets) * UDP_PACKET_SIZE),
+                lambda data: data == b"FIN" or _packet(data),
+            )
+        except TimeoutError:
+            return False
+        while data != b"FIN":
+            packet = _packet(data)
+            if packet:
+                received[packet[0]] = packet[1]
+            try:
+                data = self._recv(UDP_STREAM_IDLE)
+            except TimeoutError:
+                break
+
+        # Unlike the interactive client, also ask for lost packets at the tail.
+        for seq_num in range(packets):
+            if seq_num in received:
+                continue
+            try:
+                data = self._ask(
+                    b"RETRY:%d" % seq_num,
+                    lambda data: (_packet(data) or (None,))[0] == seq_num,
+                    UDP_RETRY_TIMEOUT,
+                )
+            except TimeoutError:
+                return False
+            received[seq_num] = _packet(data)[1]
+            self._send(b"ACK:%d" % seq_num)
+        self._send(b"FIN_ACK")
+        return True
+
+    def upload(self, path: str, name: str) -> int:
+        self._drain()
+        size = os.path.getsize(path)
+        moved = None
+        with open(path, "rb") as f:
+            for _ in range(UDP_ATTEMPTS):
+                offset = self._transfer(self._ask(f"UPLOAD {name} {size}".encode(), TRANSFER_REPLY.fullmatch))
+                if moved is None:
+                    moved = size - offset
+                try:
+                    if offset >= size or self._send_file(f, offset):
+                        return moved
+                finally:
+                    self._release()
+        raise TimeoutError(f"Upload of {name} did not complete")
+
+    def _send_file(self, f, offset: int) -> bool:
+        """
+        Sends a file from ``offset``, then the packets the server asks for.
+
+        Returns
+        -------
+        bool
+            True after FIN_ACK; False if the server stopped answering, for
+            instance because FIN_ACK was lost. The next UPLOAD then tells
+            how far it got.
+        """
+        f.seek(offset)
+        seq_num = offset // UDP_PACKET_SIZE
+        while data := f.read(UDP_PACKET_SIZE):
+            self._send(b"%d:%s" % (seq_num, data))
+            seq_num += 1
+
+        silent = 0
+        while silent < UDP_ATTEMPTS:
+            self._send(b"FIN")
+            try:
+                reply = self._recv(UDP_FIN_TIMEOUT)
+            except TimeoutError:
+                silent += 1
+                continue
+            while True:
+                if reply.startswith(b"RETRY"):
+                    seq_num = int(reply.split(b":")[1])
+                    f.seek(seq_num * UDP_PACKET_SIZE)
+                    self._send(b"%d:%s" % (seq_num, f.read(UDP_PACKET_SIZE)))
+                elif reply.startswith(b"FIN_ACK"):
+                    # server_lab4 reads one more datagram after FIN_ACK before it writes the file.
+                    self._send(b"CTRL_C")
+                    return True
+                # An ACK is only a courtesy; the next RETRY or FIN_ACK follows.
+                try:
+                    reply = self._recv(UDP_FIN_TIMEOUT)
+                except TimeoutError:
+                    silent = 1
+                    break
+        return False
+
+    def close(self) -> None:
+        try:
+            self._send(b"QUIT")
+        except OSError:
+            pass
+        finally:
+            self.sock.close()
+
+
+DRIVERS = {"framed": FramedClient, "udp": UDPClient}
+
+
+class AsyncFramedClient:
+    """FramedClient for asyncio; create it with ``await AsyncFramedClient.connect(...)``."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.request_id = 0
+
+    @classmethod
+    async def connect(cls, host: str, port: int, token: str) -> "AsyncFramedClient":
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = cls(reader, writer)
+        await client.request(OP_HELLO, token.encode())
+        return client
+
+    def _next_id(self) -> int:
+        self.request_id += 1
+        return self.request_id
+
+    async def _send(self, request_id: int, opcode: int, payload: bytes = b"") -> None:
+        self.writer.write(encode_frame(request_id, opcode, payload))
+        await self.writer.drain()
+
+    async def _recv_frame(self) -> Frame:
+        length, request_id, opcode = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Payload too large: {length} bytes")
+        payload = await self.reader.readexactly(length) if length else b""
+        return Frame(request_id, opcode, payload)
+
+    async def _expect(self, request_id: int, opcode: int) -> bytes:
+        frame = await self._recv_frame()
+        if frame.request_id != request_id or frame.opcode != opcode:
+            raise BenchError(
+                f"Expected {OP_NAMES[opcode]} #{request_id}, got "
+                f"{OP_NAMES.get(frame.opcode, frame.opcode)} #{frame.request_id}: {frame.payload[:80]!r}"
+            )
+        return frame.payload
+
+    async def request(self, opcode: int, payload: bytes = b"") -> bytes:
+        request_id = self._next_id()
+        await self._send(request_id, opcode, payload)
+        return await self._expect(request_id, OP_OK)
+
+    async def echo(self) -> int:
+        if await self.request(OP_ECHO, ECHO_PAYLOAD.encode()) != ECHO_PAYLOAD.encode():
+            raise BenchError("ECHO reply does not match the request")
+        return 0
+
+    async def time(self) -> int:
+        await self.request(OP_TIME)
+        return 0
+
+    async def download(self, name: str) -> int:
+        request_id = self._next_id()
+        await self._send(request_id, OP_DOWNLOAD, pack_transfer(0, name))
+        starts_from, size = DOWNLOAD_REPLY.unpack(await self._expect(request_id, OP_OK))
+
+        remaining = size - starts_from
+        while remaining:
+            data = await self.reader.read(min(RECV_CHUNK, remaining))
+            if not data:
+                raise ConnectionError("Connection closed during download")
+            remaining -= len(data)
+        await self._expect(request_id, OP_DONE)
+        return size - starts_from
+
+    async def upload(self, path: str, name: str) -> int:
+        size = os.path.getsize(path)
+        request_id = self._next_id()
+        await self._send(request_id, OP_UPLOAD, pack_upload(size, os.stat(path).st_mtime_ns, name))
+        (offset,) = TRANSFER.unpack(await self._expect(request_id, OP_OK))
+
+        with open(path, "rb") as f:
+            if size > offset:
+                await asyncio.get_running_loop().sendfile(self.writer.transport, f, offset, size - offset)
+        await self._expect(request_id, OP_DONE)
+        return size - offset
+
+    async def close(self) -> None:
+        try:
+            await self._send(self._next_id(), OP_CLOSE)
+            await asyncio.wait_for(self._recv_frame(), TIMEOUT)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.writer.close()
+
+
+class _DatagramQueue(asyncio.DatagramProtocol):
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.error: Optional[Exception] = None
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.queue.put_nowait(data)
+
+    def error_received(self, exc: Exception) -> None:
+        self.error = exc
+
+
+class AsyncUDPClient:
+    """UDPClient for asyncio; create it with ``await AsyncUDPClient.connect(...)``."""
+
+    def __init__(self, transport: asyncio.DatagramTransport, protocol: _DatagramQueue, address):
+        self.transport = transport
+        self.protocol = protocol
+        self.address = address
+        # Where datagrams go: the server port, or the port of a running transfer.
+        self.peer = address
+
+    @classmethod
+    async def connect(cls, host: str, port: int, token: str) -> "AsyncUDPClient":
+        # Not connected: a transfer of Server/udp_server runs on a port of its own.
+        transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            _DatagramQueue, local_addr=("0.0.0.0", 0)
+        )
+        sock = transport.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SNDBUF)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+        return cls(transport, protocol, (host, port))
+
+    def _send(self, data: bytes) -> None:
+        if self.protocol.error:
+            error, self.protocol.error = self.protocol.error, None
+            raise error
+        self.transport.sendto(data, self.peer)
+
+    def _transfer(self, reply: bytes) -> int:
+        """The number in a DOWNLOAD or UPLOAD reply; sends go to the port it names until ``_release``."""
+        value, _, port = reply.partition(b" ")
+        if port:
+            self.peer = (self.address[0], int(port))
+        return int(value)
+
+    def _release(self) -> None:
+        self.peer = self.address
+
+    async def _recv(self, timeout: float = UDP_TIMEOUT) -> bytes:
+        try:
+            return await asyncio.wait_for(self.protocol.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("No reply from the UDP server") from None
+
+    async def _ask(self, request: bytes, accept: Callable[[bytes], object], timeout: float = UDP_TIMEOUT) -> bytes:
+        """Sends ``request`` until a datagram ``accept`` is true for arrives, and returns it."""
+        loop = asyncio.get_running_loop()
+        for _ in range(UDP_ATTEMPTS):
+            self._send(request)
+            deadline = loop.time() + timeout
+            while (left := deadline - loop.time()) > 0:
+                try:
+                    data = await self._recv(left)
+                except TimeoutError:
+                    break
+                if accept(data):
+                    return data
+        raise TimeoutError(f"No reply to {request[:32]!r} from the UDP server")
+
+    def _drain(self) -> None:
+        """Drops datagrams left over from a failed operation."""
+        while not self.protocol.queue.empty():
+            self.protocol.queue.get_nowait()
+
+    async def echo(self) -> int:
+        self._drain()
+        await self._ask(f"ECHO {ECHO_PAYLOAD}".encode(), lambda data: data == ECHO_PAYLOAD.encode())
+        return 0
+
+    async def time(self) -> int:
+        self._drain()
+        await self._ask(b"TIME", TIME_REPLY.fullmatch)
+        return 0
+
+    async def download(self, name: str) -> int:
+        self._drain()
+        received: Dict[int, int] = {}
+        for _ in range(UDP_ATTEMPTS):
+            size = self._transfer(await self._ask(f"DOWNLOAD {name}".encode(), TRANSFER_REPLY.fullmatch))
+            if not size:
+                self._release()
+                raise BenchError(f"{name} not found on the server")
+            try:
+                if await self._receive(size, received):
+                    break
+            finally:
+                self._release()
+        else:
+            raise TimeoutError(f"Download of {name} did not complete")
+
+        moved = sum(received.values())
+        if moved != size:
+            raise BenchError(f"Downloaded {moved} of {size} bytes")
+        return moved
+
+    async def _receive(self, size: int, received: Dict[int, int]) -> bool:
+        """Like ``UDPClient._receive``."""
+        packets = -(-size // UDP_PACKET_SIZE)
+        try:
+            data = await self._ask(
+                b"%d" % (_first_missing(received, packets) * UDP_PACKET_SIZE),
+                lambda data: data == b"FIN" or _packet(data),
+            )
+        except TimeoutError:
+            return False
+        while data != b"FIN":
+            packet = _packet(data)
+            if packet:
+                received[packet[0]] = packet[1]
+            try:
+                data = await self._recv(UDP_STREAM_IDLE)
+            except TimeoutError:
+                break
+
+        for seq_num in range(packets):
+            if seq_num in received:
+                continue
+            try:
+                data = await self._ask(
+                    b"RETRY:%d" % seq_num,
+                    lambda data: (_packet(data) or (None,))[0] == seq_num,
+                    UDP_RETRY_TIMEOUT,
+                )
+            except TimeoutError:
+                return False
+            received[seq_num] = _packet(data)[1]
+            self._send(b"ACK:%d" % seq_num)
+        self._send(b"FIN_ACK")
+        return True
+
+    async def upload(self, path: str, name: str) -> int:
+        self._drain()
+        size = os.path.getsize(path)
+        moved = None
+        with open(path, "rb") as f:
+            for _ in range(UDP_ATTEMPTS):
+                offset = self._transfer(await self._ask(f"UPLOAD {name} {size}".encode(), TRANSFER_REPLY.fullmatch))
+                if moved is None:
+                    moved = size - offset
+                try:
+                    if offset >= size or await self._send_file(f, offset):
+                        return moved
+                finally:
+                    self._release()
+        raise TimeoutError(f"Upload of {name} did not complete")
+
+    async def _send_file(self, f, offset: int) -> bool:
+        """Like ``UDPClient._send_file``."""
+        f.seek(offset)
+        seq_num = offset // UDP_PACKET_SIZE
+        while data := f.read(UDP_PACKET_SIZE):
+            self._send(b"%d:%s" % (seq_num, data))
+            seq_num += 1
+            # Give the receive side a turn, or a large file floods the socket buffer at once.
+            if seq_num % 64 == 0:
+                await asyncio.sleep(0)
+
+        silent = 0
+        while silent < UDP_ATTEMPTS:
+            self._send(b"FIN")
+            try:
+                reply = await self._recv(UDP_FIN_TIMEOUT)
+            except TimeoutError:
+                silent += 1
+                continue
+            while True:
+                if reply.startswith(b"RETRY"):
+                    seq_num = int(reply.split(b":")[1])
+                    f.seek(seq_num * UDP_PACKET_SIZE)
+                    self._send(b"%d:%s" % (seq_num, f.read(UDP_PACKET_SIZE)))
+                elif reply.startswith(b"FIN_ACK"):
+                    self._send(b"CTRL_C")
+                    return True
+                try:
+                    reply = await self._recv(UDP_FIN_TIMEOUT)
+                except TimeoutError:
+                    silent = 1
+                    break
+        return False
+
+    async def close(self) -> None:
+        try:
+            self._send(b"QUIT")
+        except OSError:
+            pass
+        finally:
+            self.transport.close()
+
+
+ASYNC_DRIVERS = {"framed": AsyncFramedClient, "udp": AsyncUDPClient}
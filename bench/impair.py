@@ -0,0 +1,521 @@
+"""Loopback proxy that impairs traffic like a WAN link.
+
+The proxy listens on a local port and forwards to a server. Every
+datagram (UDP) or chunk (TCP) passing through a direction of a flow goes
+through a Link, which decides, from a seeded RNG, whether it is lost,
+duplicated, delayed or held back long enough to be overtaken::
+
+    python bench/impair.py udp --listen 127.0.0.1:22348 --target 127.0.0.1:12348 \\
+        --loss 0.02 --burst 0.01:0.25 --reorder 0.05 --delay 20 --jitter 5 --rate 2M
+
+Loss, burst loss, duplication and reordering apply to UDP only. A TCP
+proxy sits above the kernel's retransmissions, so it can only delay the
+stream and cap its bandwidth.
+
+The RNG of each link is seeded with the seed, the flow number (flows are
+numbered in the order they first send) and the direction. A run with the
+same seed and the same packet sequence therefore makes the same
+decisions.
+"""
+
+import argparse
+import heapq
+import queue
+import random
+import re
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+Address = Tuple[str, int]
+
+UDP_RECV_SIZE = 65535
+TCP_CHUNK = 65536
+TCP_QUEUE_CHUNKS = 64  # chunks buffered per direction before the reader blocks
+STAT_FIELDS = ("packets", "bytes", "lost", "burst_lost", "overflow", "duplicated", "reordered")
+# "<size or offset> <port>": Server/udp_server runs the transfer on that port.
+TRANSFER_REPLY = re.compile(rb"(\d+) (\d+)")
+
+
+class Impairment:
+    """
+    Parameters of a link, shared by all flows of a proxy.
+
+    Parameters
+    ----------
+    loss : float
+        Probability that a packet is dropped.
+    burst : tuple of float, optional
+        ``(enter, leave)`` probabilities of a Gilbert-Elliott model: with
+        probability ``enter`` the link turns bad, and every packet is lost
+        until it recovers with probability ``leave`` per packet.
+    duplicate : float
+        Probability that a packet is delivered twice.
+    reorder : float
+        Probability that a packet is held back for ``reorder_delay``
+        seconds more, so that the following packets overtake it.
+    delay, jitter : float
+        One-way latency in seconds and the bound of a uniform variation.
+    rate : float
+        Bandwidth cap in bytes per second, 0 for none.
+    queue_delay : float
+        Longest queueing a capped link allows before it drops (UDP) packets.
+    seed : int
+        Seed of every link's RNG.
+    direction : str
+        Impair "up" (client to server), "down" or "both" directions.
+    """
+
+    def __init__(
+        self,
+        loss: float = 0.0,
+        burst: Optional[Tuple[float, float]] = None,
+        duplicate: float = 0.0,
+        reorder: float = 0.0,
+        reorder_delay: float = 0.01,
+        delay: float = 0.0,
+        jitter: float = 0.0,
+        rate: float = 0.0,
+        queue_delay: float = 0.1,
+        seed: int = 1,
+        direction: str = "both",
+    ):
+        self.loss = loss
+        self.burst = burst
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.delay = delay
+        self.jitter = jitter
+        self.rate = rate
+        self.queue_delay = queue_delay
+        self.seed = seed
+        self.direction = direction
+
+    def link(self, flow: int, direction: str) -> "Link":
+        if self.direction not in ("both", direction):
+            return Link(Impairment(), f"{self.seed}:{flow}:{direction}")
+        return Link(self, f"{self.seed}:{flow}:{direction}")
+
+    def __str__(self) -> str:
+        active = {
+            "loss": self.loss,
+            "burst": self.burst and "{}:{}".format(*self.burst),
+            "duplicate": self.duplicate,
+            "reorder": self.reorder,
+            "delay": self.delay,
+            "jitter": self.jitter,
+            "rate": self.rate,
+        }
+        text = " ".join(f"{name}={value}" for name, value in active.items() if value)
+        return text and f"{text} direction={self.direction} seed={self.seed}"
+
+
+class Link:
+    """One direction of one flow."""
+
+    def __init__(self, impairment: Impairment, seed: str):
+        self.impairment = impairment
+        self.rng = random.Random(seed)
+        self.bad = False
+        self.free_at = 0.0  # when the capped link has sent everything queued so far
+        self.stats = dict.fromkeys(STAT_FIELDS, 0)
+
+    def _transmitted(self, size: int, now: float) -> Optional[float]:
+        """Time the last byte leaves a capped link, None if its queue is full."""
+        rate = self.impairment.rate
+        if not rate:
+            return now
+        start = max(now, self.free_at)
+        if start - now > self.impairment.queue_delay:
+            return None
+        self.free_at = start + size / rate
+        return self.free_at
+
+    def _latency(self) -> float:
+        impairment = self.impairment
+        latency = impairment.delay
+        if impairment.jitter:
+            latency += self.rng.uniform(-impairment.jitter, impairment.jitter)
+        return max(0.0, latency)
+
+    def datagram(self, size: int, now: float) -> List[float]:
+        """
+        Decides the fate of a datagram.
+
+        Returns
+        -------
+        List[float]
+            Delivery times: none if it is lost, two if it is duplicated.
+        """
+        impairment = self.impairment
+        rng = self.rng
+        self.stats["packets"] += 1
+        self.stats["bytes"] += size
+
+        if impairment.burst:
+            enter, leave = impairment.burst
+            self.bad = rng.random() >= leave if self.bad else rng.random() < enter
+            if self.bad:
+                self.stats["burst_lost"] += 1
+                return []
+        if impairment.loss and rng.random() < impairment.loss:
+            self.stats["lost"] += 1
+            return []
+
+        sent = self._transmitted(size, now)
+        if sent is None:
+            self.stats["overflow"] += 1
+            return []
+
+        deliver = sent + self._latency()
+        if impairment.reorder and rng.random() < impairment.reorder:
+            self.stats["reordered"] += 1
+            deliver += impairment.reorder_delay
+        times = [deliver]
+        if impairment.duplicate and rng.random() < impairment.duplicate:
+            self.stats["duplicated"] += 1
+            times.append(deliver + self._latency() * rng.random())
+        return times
+
+    def chunk(self, size: int, now: float) -> float:
+        """Delivery time of a piece of a stream; streams only see delay and rate."""
+        self.stats["packets"] += 1
+        self.stats["bytes"] += size
+        rate = self.impairment.rate
+        sent = max(now, self.free_at) + size / rate if rate else now
+        self.free_at = sent
+        return sent + self._latency()
+
+
+class Scheduler:
+    """Runs callbacks at given monotonic times on one background thread."""
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, Callable, tuple]] = []
+        self.counter = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="impair-scheduler", daemon=True)
+        self.thread.start()
+
+    def at(self, when: float, function: Callable, *args) -> None:
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.heap, (when, self.counter, function, args))
+            if self.heap[0][1] == self.counter:
+                self.condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    self.condition.wait(timeout)
+                if not self.running:
+                    return
+                _, _, function, args = heapq.heappop(self.heap)
+            try:
+                function(*args)
+            except OSError:
+                pass  # the peer went away; a lossy link does not care
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+class UDPProxy:
+    """
+    Forwards datagrams between clients and a UDP server.
+
+    Each client address gets its own upstream socket, so the server still
+    sees one address per client. When the server moves a transfer to a
+    port of its own, the proxy opens a port for it as well and names that
+    one in the reply, so the transfer passes through the same links.
+    """
+
+    def __init__(self, listen: Address, target: Address, impairment: Impairment):
+        self.target = target
+        self.impairment = impairment
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(listen)
+        self.address = self.sock.getsockname()
+        self.scheduler = Scheduler()
+        # {client address: (upstream socket, up link, down link)}
+        self.flows: Dict[Address, Tuple[socket.socket, Link, Link]] = {}
+        self.clients: Dict[socket.socket, Address] = {}
+        # A client's running transfer: {proxy side socket: (client, server transfer address)}
+        self.sides: Dict[socket.socket, Tuple[Address, Address]] = {}
+        self.side_of: Dict[Address, socket.socket] = {}  # client address -> its side socket
+        self.requested: set = set()  # clients waiting for the reply to DOWNLOAD or UPLOAD
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="impair-udp", daemon=True)
+
+    def start(self) -> "UDPProxy":
+        self.thread.start()
+        return self
+
+    def _flow(self, client: Address) -> Tuple[socket.socket, Link, Link]:
+        flow = self.flows.get(client)
+        if flow is None:
+            # Not connected: transfers come from other ports of the server.
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            number = len(self.flows)
+            flow = (upstream, self.impairment.link(number, "up"), self.impairment.link(number, "down"))
+            self.flows[client] = flow
+            self.clients[upstream] = client
+        return flow
+
+    def _side(self, client: Address, server: Address) -> int:
+        """Opens the proxy end of a transfer and returns its port; a client runs one at a time."""
+        old = self.side_of.pop(client, None)
+        if old is not None:
+            del self.sides[old]
+            old.close()
+        side = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        side.bind((self.address[0], 0))
+        self.sides[side] = (client, server)
+        self.side_of[client] = side
+        return side.getsockname()[1]
+
+    def _up(self, client: Address, data: bytes, server: Address, now: float) -> None:
+        upstream, up, _ = self._flow(client)
+        for when in up.datagram(len(data), now):
+            self.scheduler.at(when, upstream.sendto, data, server)
+
+    def _down(self, sock: socket.socket, now: float) -> None:
+        data, server = sock.recvfrom(UDP_RECV_SIZE)
+        client = self.clients[sock]
+        out = self.sock
+        if server[1] != self.target[1]:
+            out = self.side_of.get(client)
+            if out is None or self.sides[out][1] != server:
+                return  # a transfer the client has left
+        elif client in self.requested:
+            self.requested.discard(client)
+            reply = TRANSFER_REPLY.fullmatch(data)
+            if reply:
+                port = self._side(client, (server[0], int(reply[2])))
+                data = b"%s %d" % (reply[1], port)
+        for when in self.flows[client][2].datagram(len(data), now):
+            self.scheduler.at(when, out.sendto, data, client)
+
+    def _run(self) -> None:
+        while self.running:
+            readable, _, _ = select.select([self.sock, *self.clients, *self.sides], [], [], 0.2)
+            now = time.monotonic()
+            for sock in readable:
+                try:
+                    if sock is self.sock:
+                        data, client = sock.recvfrom(UDP_RECV_SIZE)
+                        if data.startswith((b"DOWNLOAD ", b"UPLOAD ")):
+                            self.requested.add(client)
+                        self._up(client, data, self.target, now)
+                    elif sock in self.sides:
+                        data = sock.recv(UDP_RECV_SIZE)
+                        client, server = self.sides[sock]
+                        self._up(client, data, server, now)
+                    elif sock in self.clients:
+                        self._down(sock, now)
+                except OSError:
+                    continue  # ICMP port unreachable from a peer that is gone
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        totals = {"up": dict.fromkeys(STAT_FIELDS, 0), "down": dict.fromkeys(STAT_FIELDS, 0)}
+        for _, up, down in list(self.flows.values()):
+            for direction, link in (("up", up), ("down", down)):
+                for field, value in link.stats.items():
+                    totals[direction][field] += value
+        return totals
+
+    def stop(self) -> None:
+        self.running = False
+        self.thread.join()
+        self.scheduler.stop()
+        for upstream, _, _ in self.flows.values():
+            upstream.close()
+        for side in self.sides:
+            side.close()
+        self.sock.close()
+
+
+class TCPProxy:
+    """Forwards TCP connections to a server, delaying and throttling both directions."""
+
+    def __init__(self, listen: Address, target: Address, impairment: Impairment):
+        self.target = target
+        self.impairment = impairment
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(listen)
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.links: List[Tuple[Link, Link]] = []
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self._accept, name="impair-tcp", daemon=True)
+
+    def start(self) -> "TCPProxy":
+        self.thread.start()
+        return self
+
+    def _accept(self) -> None:
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+                upstream = socket.create_connection(self.target)
+            except OSError:
+                if self.running:
+                    continue
+                return
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                number = len(self.links)
+                up, down = self.impairment.link(number, "up"), self.impairment.link(number, "down")
+                self.links.append((up, down))
+            self._pipe(client, upstream, up)
+            self._pipe(upstream, client, down)
+
+    def _pipe(self, source: socket.socket, sink: socket.socket, link: Link) -> None:
+        chunks: queue.Queue = queue.Queue(TCP_QUEUE_CHUNKS)
+
+        def read() -> None:
+            try:
+                while data := source.recv(TCP_CHUNK):
+                    chunks.put((link.chunk(len(data), time.monotonic()), data))
+            except OSError:
+                pass
+            chunks.put((0.0, b""))
+
+        def write() -> None:
+            try:
+                while True:
+                    when, data = chunks.get()
+                    if not data:
+                        sink.shutdown(socket.SHUT_WR)
+                        break
+                    pause = when - time.monotonic()
+                    if pause > 0:
+                        time.sleep(pause)
+                    sink.sendall(data)
+            except OSError:
+                source.close()
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        totals = {"up": dict.fromkeys(STAT_FIELDS, 0), "down": dict.fromkeys(STAT_FIELDS, 0)}
+        with self.lock:
+            links = list(self.links)
+        for up, down in links:
+            for direction, link in (("up", up), ("down", down)):
+                for field, value in link.stats.items():
+                    totals[direction][field] += value
+        return totals
+
+    def stop(self) -> None:
+        self.running = False
+        self.sock.close()
+
+
+PROXIES = {"udp": UDPProxy, "tcp": TCPProxy}
+
+
+def parse_address(text: str) -> Address:
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def parse_rate(text: str) -> float:
+    """Bytes per second, with an optional K, M or G suffix (powers of 1024)."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def parse_burst(text: str) -> Tuple[float, float]:
+    enter, leave = text.split(":")
+    return float(enter), float(leave)
+
+
+def add_impairment_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--loss", type=float, default=0.0, help="Random loss probability (UDP)")
+    parser.add_argument("--burst", type=parse_burst, help="Bursty loss as ENTER:LEAVE probabilities (UDP)")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="Duplication probability (UDP)")
+    parser.add_argument("--reorder", type=float, default=0.0, help="Probability a datagram is overtaken (UDP)")
+    parser.add_argument("--reorder-delay", type=float, default=10.0, help="Extra delay of a reordered datagram, ms")
+    parser.add_argument("--delay", type=float, default=0.0, help="One-way latency, ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latency variation, +/- ms")
+    parser.add_argument("--rate", type=parse_rate, default=0.0, help="Bandwidth cap, bytes/s (K, M, G suffixes)")
+    parser.add_argument("--queue", type=float, default=100.0, help="Queueing a capped link allows before dropping, ms (UDP)")
+    parser.add_argument("--direction", choices=("both", "up", "down"), default="both", help="Directions to impair")
+    parser.add_argument("--seed", type=int, default=1, help="RNG seed")
+
+
+def impairment_from_args(args: argparse.Namespace) -> Impairment:
+    return Impairment(
+        loss=args.loss,
+        burst=args.burst,
+        duplicate=args.duplicate,
+        reorder=args.reorder,
+        reorder_delay=args.reorder_delay / 1000,
+        delay=args.delay / 1000,
+        jitter=args.jitter / 1000,
+        rate=args.rate,
+        queue_delay=args.queue / 1000,
+        seed=args.seed,
+        direction=args.direction,
+    )
+
+
+def impairment_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    add_impairment_arguments(parser)
+    return parser
+
+
+def format_stats(stats: Dict[str, Dict[str, int]]) -> str:
+    return "\n".join(
+        f"{direction:>4}: " + ", ".join(f"{field} {value}" for field, value in fields.items())
+        for direction, fields in stats.items()
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Loopback proxy that injects loss, reordering, delay and bandwidth limits")
+    parser.add_argument("protocol", choices=PROXIES)
+    parser.add_argument("--listen", type=parse_address, required=True, help="HOST:PORT to accept clients on")
+    parser.add_argument("--target", type=parse_address, required=True, help="HOST:PORT of the server")
+    add_impairment_arguments(parser)
+    args = parser.parse_args()
+
+    impairment = impairment_from_args(args)
+    proxy = PROXIES[args.protocol](args.listen, args.target, impairment).start()
+    print(
+        f"{args.protocol.upper()} proxy {proxy.address[0]}:{proxy.address[1]} -> "
+        f"{args.target[0]}:{args.target[1]} ({impairment or 'no impairment'})",
+        file=sys.stderr,
+    )
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    proxy.stop()
+    print(format_stats(proxy.stats()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
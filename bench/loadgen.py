@@ -0,0 +1,491 @@
+"""Synthetic load from thousands of concurrent clients.
+
+Every simulated client is a coroutine with its own connection (or UDP
+socket) that runs a weighted mix of ECHO/TIME/DOWNLOAD/UPLOAD against one
+server. Two ways of pacing the load:
+
+* ``--mode closed``: each client sends its next command as soon as the
+  previous one is answered (plus ``--think``). The load adapts to the
+  server, so a stall also stops the clients from sending what they would
+  have sent meanwhile: coordinated omission. The corrected percentiles add
+  the missing samples afterwards, HdrHistogram style: a latency L longer
+  than the expected interval I between two commands of a client also
+  counts as L - I, L - 2I, ... The interval defaults to the think time plus
+  the mean service time, i.e. the pace each client actually kept.
+* ``--mode open``: commands arrive at ``--rate`` per second (evenly spaced,
+  or as a Poisson process with ``--poisson``) no matter how the server
+  copes, and any idle client picks up the next one. The corrected latency
+  is measured from the arrival it was scheduled for, so time spent queued
+  behind a slow server counts. Arrivals still queued at the end are
+  reported as unserved and counted with the time they waited.
+
+Both the raw service time (send to answer) and the corrected latency are
+reported, per command and overall, as JSON::
+
+    python bench/loadgen.py --spawn --server tcp --clients 2000 --duration 10
+    python bench/loadgen.py --server lab3 --port 12345 --mode open --rate 5000 --mix echo=4,time=1
+
+``--spawn`` starts the server in a scratch directory holding a test file
+of ``--size`` bytes, as bench.py does; otherwise the target must already
+serve a file called ``--file`` for downloads.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from bench import MIXES, SERVERS, ServerProcess, ensure_test_file, parse_size
+from drivers import ASYNC_DRIVERS, TIMEOUT
+
+# Where the servers listen when started without --port
+DEFAULT_PORTS = {"tcp": 12346, "lab3": 12345, "udp": 12348, "lab4": 12348}
+OPERATIONS = ("echo", "time", "download", "upload")
+HISTOGRAM_STEP = math.log(1.01)  # buckets about 1% wide
+PERCENTILES = (0.50, 0.90, 0.99, 0.999)
+
+
+class Histogram:
+    """Latency histogram with log-spaced buckets, values in seconds."""
+
+    def __init__(self) -> None:
+        self.buckets: Counter = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _bucket(seconds: float) -> int:
+        return int(math.log(max(seconds * 1e6, 1.0)) / HISTOGRAM_STEP)
+
+    @staticmethod
+    def _value(bucket: int) -> float:
+        return math.exp((bucket + 1) * HISTOGRAM_STEP) / 1e6
+
+    def record(self, seconds: float, count: int = 1) -> None:
+        self.buckets[self._bucket(seconds)] += count
+        self.count += count
+        self.total += seconds * count
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "Histogram") -> None:
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction: float) -> float:
+        """Nearest-rank percentile, rounded up to the bucket edge."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self._value(bucket), self.max)
+        return self.max
+
+    def corrected(self, interval: float) -> "Histogram":
+        """
+        A copy with the samples a stalled closed-loop client never sent.
+
+        Parameters
+        ----------
+        interval : float
+            Expected time between two commands of one client, in seconds.
+
+        Returns
+        -------
+        Histogram
+            Every recorded latency L > interval is also counted as
+            L - interval, L - 2 * interval, ... down to interval.
+        """
+        result = Histogram()
+        result.merge(self)
+        if interval <= 0:
+            return result
+        for bucket, count in self.buckets.items():
+            missing = min(self._value(bucket), self.max) - interval
+            while missing >= interval:
+                result.record(missing, count)
+                missing -= interval
+        return result
+
+    def summary(self) -> Dict[str, float]:
+        stats = {"count": self.count, "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0}
+        for fraction in PERCENTILES:
+            stats[f"p{fraction * 100:g}_ms"] = round(self.percentile(fraction) * 1000, 3)
+        stats["max_ms"] = round(self.max * 1000, 3)
+        return stats
+
+
+def parse_mix(text: str) -> List[Tuple[str, int]]:
+    """A MIXES name or ``op=weight,...``, e.g. ``echo=4,time=1,download=1``."""
+    if text in MIXES:
+        return MIXES[text]
+    mix = []
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown command {op!r}, expected one of {', '.join(OPERATIONS)}")
+        mix.append((op, int(weight or 1)))
+    return mix
+
+
+class Target:
+    """Where the clients connect and what they transfer."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.name = args.server
+        self.host = args.host
+        self.port = args.port or DEFAULT_PORTS[args.server]
+        self.source = ensure_test_file(args.data_dir, args.size)
+        self.remote_name = args.file or os.path.basename(self.source)
+        self.upload_dir: Optional[str] = None
+        self.server: Optional[ServerProcess] = None
+        self.workdir: Optional[str] = None
+        if args.spawn:
+            self._spawn()
+
+    def _spawn(self) -> None:
+        _, _, _, files_dir, upload_dir = SERVERS[self.name]
+        self.workdir = tempfile.mkdtemp(prefix=f"loadgen-{self.name}-")
+        for sub in (files_dir, upload_dir):
+            os.makedirs(os.path.join(self.workdir, sub), exist_ok=True)
+        os.symlink(self.source, os.path.join(self.workdir, files_dir, self.remote_name))
+        self.upload_dir = os.path.join(self.workdir, upload_dir)
+        self.server = ServerProcess(self.name, self.workdir, os.path.join(self.workdir, "server.log"))
+        self.server.wait_ready()
+        self.host, self.port = "127.0.0.1", self.server.port
+
+    def uploaded(self, name: str) -> None:
+        """Deletes an uploaded file of a spawned server so long runs do not fill the disk."""
+        if self.upload_dir:
+            try:
+                os.unlink(os.path.join(self.upload_dir, name))
+            except OSError:
+                pass
+
+    def stop(self, keep: bool) -> Optional[dict]:
+        if not self.server:
+            return None
+        self.server.stop()
+        usage = self.server.rusage
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        return {
+            "cpu_s": round(usage.ru_utime + usage.ru_stime, 4),
+            "peak_rss_kib": usage.ru_maxrss,
+            "exit_code": self.server.process.returncode,
+            "log": os.path.join(self.workdir, "server.log") if keep else None,
+        }
+
+
+class LoadGenerator:
+    """
+    Runs the simulated clients and collects their latencies.
+
+    Parameters
+    ----------
+    target : Target
+        Server to load.
+    args : argparse.Namespace
+        Parsed command line, see ``main``.
+    """
+
+    def __init__(self, target: Target, args: argparse.Namespace):
+        self.target = target
+        self.args = args
+        self.driver = ASYNC_DRIVERS[SERVERS[target.name][1]]
+        self.mix = parse_mix(args.mix)
+        self.service: Dict[str, Histogram] = {op: Histogram() for op, _ in self.mix}
+        self.latency: Dict[str, Histogram] = {op: Histogram() for op, _ in self.mix}  # open loop only
+        self.errors: Counter = Counter()
+        self.error_samples: List[str] = []
+        self.bytes = 0
+        self.connected = 0
+        self.unserved = 0
+        self.max_lag = 0.0
+        self.deadline = 0.0
+        self.arrivals: asyncio.Queue = asyncio.Queue()
+
+    def pick(self, rng: random.Random) -> str:
+        return rng.choices([op for op, _ in self.mix], [weight for _, weight in self.mix])[0]
+
+    async def connect(self, index: int):
+        token = f"loadgen-{os.getpid()}-{index}"
+        return await asyncio.wait_for(
+            self.driver.connect(self.target.host, self.target.port, token), TIMEOUT
+        )
+
+    async def execute(self, client, index: int, number: int, op: str) -> Tuple[int, float]:
+        """Runs one command and returns (bytes moved, service time)."""
+        upload_name = f"loadgen-{os.getpid()}-{index}-{number}.txt"
+        started = time.perf_counter()
+        try:
+            if op == "download":
+                moved = await asyncio.wait_for(client.download(self.target.remote_name), TIMEOUT)
+            elif op == "upload":
+                moved = await asyncio.wait_for(client.upload(self.target.source, upload_name), TIMEOUT)
+            else:
+                moved = await asyncio.wait_for(getattr(client, op)(), TIMEOUT)
+        finally:
+            if op == "upload":
+                self.target.uploaded(upload_name)
+        return moved, time.perf_counter() - started
+
+    def failed(self, op: str, error: Exception) -> None:
+        self.errors[op] += 1
+        if len(self.error_samples) < 10:
+            self.error_samples.append(f"{op}: {type(error).__name__}: {error}")
+
+    async def client(self, index: int) -> None:
+        # Spread the connects over the ramp so the accept queue is not flooded at once.
+        await asyncio.sleep(self.args.ramp * index / self.args.clients)
+        rng = random.Random(f"{self.args.seed}:{index}")
+        client = None
+        try:
+            client = await self.connect(index)
+            self.connected += 1
+        except Exception as e:
+            self.failed("connect", e)
+
+        for number in itertools.count(1):
+            if self.args.mode == "open":
+                intended, op = await self.arrivals.get()
+                if intended is None:
+                    break  # the generator is done
+            else:
+                if time.perf_counter() >= self.deadline:
+                    break
+                intended, op = None, self.pick(rng)
+
+            try:
+                if client is None:
+                    client = await self.connect(index)
+                moved, service = await self.execute(client, index, number, op)
+            except Exception as e:
+                self.failed(op, e)
+                # The state of the exchange is unknown; start over on a new connection.
+                if client is not None:
+                    await self._close(client)
+                    client = None
+                continue
+            finished = time.perf_counter()
+            self.bytes += moved
+            self.service[op].record(service)
+            if intended is not None:
+                self.latency[op].record(finished - intended)
+            if self.args.think:
+                await asyncio.sleep(self.args.think / 1000)
+        if client is not None:
+            await self._close(client)
+
+    @staticmethod
+    async def _close(client) -> None:
+        try:
+            await asyncio.wait_for(client.close(), TIMEOUT)
+        except Exception:
+            pass
+
+    async def generate(self, started: float) -> None:
+        """Open loop: enqueues (intended start, command) at the target rate."""
+        rng = random.Random(f"{self.args.seed}:arrivals")
+        interval = 1.0 / self.args.rate
+        next_arrival = started
+        while next_arrival < self.deadline:
+            now = time.perf_counter()
+            while next_arrival <= now and next_arrival < self.deadline:
+                self.arrivals.put_nowait((next_arrival, self.pick(rng)))
+                self.max_lag = max(self.max_lag, now - next_arrival)
+                next_arrival += rng.expovariate(self.args.rate) if self.args.poisson else interval
+            await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+
+    async def run(self) -> float:
+        started = time.perf_counter()
+        self.deadline = started + self.args.ramp + self.args.duration
+        clients = [asyncio.create_task(self.client(i)) for i in range(self.args.clients)]
+        if self.args.mode == "open":
+            await asyncio.sleep(self.args.ramp)
+            await self.generate(time.perf_counter())
+            # Whatever is still queued never got a client: count it with the time it waited.
+            now = time.perf_counter()
+            while not self.arrivals.empty():
+                intended, op = self.arrivals.get_nowait()
+                self.latency[op].record(now - intended)
+                self.unserved += 1
+            for _ in clients:
+                self.arrivals.put_nowait((None, None))
+        await asyncio.gather(*clients)
+        return time.perf_counter() - started - self.args.ramp
+
+    def results(self, wall: float) -> dict:
+        service_all = Histogram()
+        for histogram in self.service.values():
+            service_all.merge(histogram)
+
+        latency_all = Histogram()
+        if self.args.mode == "closed":
+            # The pace a client kept between two commands, see the module docstring.
+            mean = service_all.total / service_all.count if service_all.count else 0.0
+            interval = self.args.expected_interval / 1000 if self.args.expected_interval else self.args.think / 1000 + mean
+            latency_all = service_all.corrected(interval)
+        else:
+            interval = 1.0 / self.args.rate
+            for histogram in self.latency.values():
+                latency_all.merge(histogram)
+
+        ops = service_all.count
+        return {
+            "ops": ops,
+            "errors": sum(self.errors.values()),
+            "error_samples": self.error_samples,
+            "unserved": self.unserved,
+            "connected_clients": self.connected,
+            "wall_s": round(wall, 4),
+            "ops_per_s": round(ops / wall, 2) if wall > 0 else 0.0,
+            "throughput_mib_s": round(self.bytes / wall / 1024 ** 2, 3) if wall > 0 else 0.0,
+            "correction_interval_ms": round(interval * 1000, 3),
+            "max_schedule_lag_ms": round(self.max_lag * 1000, 3),
+            "service": service_all.summary(),
+            "corrected": latency_all.summary(),
+            "commands": {
+                op: {
+                    "errors": self.errors[op],
+                    "service": self.service[op].summary(),
+                    # Closed loop corrects per client, across commands; per command it would mislead.
+                    "corrected": self.latency[op].summary() if self.args.mode == "open" else None,
+                }
+                for op in sorted(self.service)
+            },
+        }
+
+
+def raise_file_limit(clients: int) -> None:
+    """Every client holds a socket; lift the soft descriptor limit as far as allowed."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = clients + 256
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        if limit < wanted:
+            print(f"Warning: only {limit} file descriptors for {clients} clients", file=sys.stderr)
+
+
+def print_report(result: dict) -> None:
+    print(
+        f"{result['ops']} ops in {result['wall_s']}s: {result['ops_per_s']} ops/s, "
+        f"{result['throughput_mib_s']} MiB/s, {result['errors']} errors, {result['unserved']} unserved",
+        file=sys.stderr,
+    )
+    columns = ["p50_ms", "p90_ms", "p99_ms", "p99.9_ms", "max_ms"]
+    print(f"{'':>20}" + "".join(f"{column:>12}" for column in columns), file=sys.stderr)
+    rows: List[Tuple[str, dict]] = []
+    for op, stats in result["commands"].items():
+        rows.append((f"{op} service", stats["service"]))
+        if stats["corrected"]:
+            rows.append((f"{op} corrected", stats["corrected"]))
+    rows += [("all service", result["service"]), ("all corrected", result["corrected"])]
+    for name, stats in rows:
+        print(f"{name:>20}" + "".join(f"{stats[column]:>12}" for column in columns), file=sys.stderr)
+    if result["client_cpu_s"] > 0.9 * result["wall_s"]:
+        print(
+            f"Warning: the generator used {result['client_cpu_s']}s of CPU in {result['wall_s']}s; "
+            "it may be the bottleneck (arrivals ran up to "
+            f"{result['max_schedule_lag_ms']} ms late)",
+            file=sys.stderr,
+        )
+
+
+def run(args: argparse.Namespace) -> int:
+    raise_file_limit(args.clients)
+    os.makedirs(args.data_dir, exist_ok=True)
+    target = Target(args)
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        generator = LoadGenerator(target, args)
+        wall = asyncio.run(generator.run())
+    finally:
+        server = target.stop(args.keep)
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    result = generator.results(wall)
+    client_cpu = cpu_after.ru_utime + cpu_after.ru_stime - cpu_before.ru_utime - cpu_before.ru_stime
+    result["client_cpu_s"] = round(client_cpu, 4)
+    result["server"] = server
+    print_report(result)
+    document = {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "target": f"{args.server} {target.host}:{target.port}",
+            "mode": args.mode,
+            "rate": args.rate,
+            "poisson": args.poisson,
+            "clients": args.clients,
+            "mix": args.mix,
+            "size": args.size,
+            "think_ms": args.think,
+            "duration_s": args.duration,
+            "seed": args.seed,
+        },
+        "result": result,
+    }
+
+    text = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Concurrent synthetic load for the command protocols")
+    parser.add_argument("--server", choices=SERVERS, default="tcp", help="Which protocol to speak (and what --spawn starts)")
+    parser.add_argument("--spawn", action="store_true", help="Start the server on a free loopback port for the run")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="By default the server's own default port")
+    parser.add_argument("--clients", type=int, default=100, help="Simulated clients, each with its own connection")
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--rate", type=float, help="Open loop: commands per second over all clients")
+    parser.add_argument("--poisson", action="store_true", help="Open loop: exponential gaps between arrivals instead of even ones")
+    parser.add_argument("--think", type=float, default=0.0, help="Closed loop: ms a client waits between commands")
+    parser.add_argument("--expected-interval", type=float, help="Closed loop: ms between commands of a client used for the correction (default: think + mean service time)")
+    parser.add_argument("--mix", default="control", help="A bench.py mix (" + ", ".join(MIXES) + ") or op=weight,...")
+    parser.add_argument("--size", type=parse_size, default=parse_size("1K"), help="Size of the file uploaded (and downloaded with --spawn)")
+    parser.add_argument("--file", help="Name of the file to download, by default the generated test file")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load after the ramp")
+    parser.add_argument("--ramp", type=float, default=1.0, help="Seconds over which the clients connect")
+    parser.add_argument("--seed", type=int, default=1, help="Seeds the command choice and the arrivals")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "np-bench-data"), help="Where the test files are kept")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory and log of a spawned server")
+    parser.add_argument("-o", "--output", help="Write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.mode == "open" and not args.rate:
+        parser.error("--mode open needs --rate")
+    try:
+        parse_mix(args.mix)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""Turns .nptrace packet traces of the UDP servers into readable series.
+
+For every trace given it prints a summary and, on request, writes three
+CSV series and a chart:
+
+* goodput over time: first-time data bytes per time bin (on the
+  receiving side, duplicates are excluded), next to retransmitted bytes;
+* loss clustering: the sequence numbers that had to be requested again,
+  grouped into runs of consecutive packets, with a histogram of run
+  lengths;
+* RTT: time from a RETRY to the retransmitted packet (receiving side),
+  or from a retransmission to its ACK (sending side).
+
+Usage::
+
+    NP_TRACE_DIR=traces python Server/udp_server/server.py
+    python bench/trace_analysis.py traces/*.nptrace --bin 50 --csv out/ --plot out/
+"""
+
+import argparse
+import csv
+import math
+import os
+import sys
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+
+from packet_trace import (
+    ACK_RECV,
+    EVENT_NAMES,
+    NACK_RECV,
+    NACK_SENT,
+    RECEIVING,
+    RECV,
+    RETRANSMIT,
+    SEND,
+    TraceHeader,
+    Record,
+    read_trace,
+)
+
+
+class Analysis:
+    def __init__(self, header: TraceHeader, records: List[Record], bin_ns: int):
+        self.header = header
+        self.records = records
+        self.bin_ns = bin_ns
+        self.receiving = header.direction == RECEIVING
+        self.events = Counter(record.event for record in records)
+        self.duration_ns = records[-1].time_ns if records else 0
+
+    def goodput(self) -> List[Tuple[float, float, float]]:
+        """[(bin start in s, new data MiB/s, retransmitted MiB/s)]"""
+        bins = max(1, math.ceil((self.duration_ns + 1) / self.bin_ns))
+        fresh = [0] * bins
+        again = [0] * bins
+        seen = set()
+        for record in self.records:
+            index = record.time_ns // self.bin_ns
+            if record.event == RECV:
+                target = again if record.seq_num in seen else fresh
+                seen.add(record.seq_num)
+                target[index] += record.size
+            elif record.event == SEND:
+                fresh[index] += record.size
+            elif record.event == RETRANSMIT:
+                again[index] += record.size
+        scale = 1e9 / self.bin_ns / 1024 ** 2
+        return [(i * self.bin_ns / 1e9, fresh[i] * scale, again[i] * scale) for i in range(bins)]
+
+    def losses(self) -> List[int]:
+        """Sequence numbers requested again, in the order of the first request."""
+        nack = NACK_SENT if self.receiving else NACK_RECV
+        seen: Dict[int, None] = {}
+        for record in self.records:
+            if record.event == nack:
+                seen.setdefault(record.seq_num, None)
+        return list(seen)
+
+    def loss_runs(self) -> List[Tuple[int, int]]:
+        """[(first sequence number, length)] of runs of consecutive losses."""
+        runs: List[Tuple[int, int]] = []
+        for seq_num in sorted(self.losses()):
+            if runs and runs[-1][0] + runs[-1][1] == seq_num:
+                runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+            else:
+                runs.append((seq_num, 1))
+        return runs
+
+    def rtt(self) -> List[Tuple[float, float]]:
+        """[(time in s, RTT in ms)] from the RETRY exchanges."""
+        start, end = (NACK_SENT, RECV) if self.receiving else (RETRANSMIT, ACK_RECV)
+        pending: Dict[int, int] = {}
+        samples = []
+        for record in self.records:
+            if record.event == start:
+                pending[record.seq_num] = record.time_ns
+            elif record.event == end and record.seq_num in pending:
+                sent = pending.pop(record.seq_num)
+                samples.append((sent / 1e9, (record.time_ns - sent) / 1e6))
+        return samples
+
+    def summary(self) -> str:
+        data = RECV if self.receiving else SEND
+        packets = len({r.seq_num for r in self.records if r.event == data})
+        losses = self.losses()
+        runs = self.loss_runs()
+        rtts = sorted(rtt for _, rtt in self.rtt())
+        goodput = sum(fresh for _, fresh, _ in self.goodput()) * self.bin_ns / 1e9
+        seconds = self.duration_ns / 1e9
+
+        lines = [
+            f"{self.header.name}: {'received' if self.receiving else 'sent'} "
+            f"{self.header.file_size} bytes in {seconds:.3f}s "
+            f"({goodput / seconds if seconds else 0:.2f} MiB/s goodput)",
+            "  events: " + ", ".join(f"{EVENT_NAMES.get(e, e)} {n}" for e, n in sorted(self.events.items())),
+            f"  lost: {len(losses)} of {packets} packets"
+            f" in {len(runs)} runs, longest {max((n for _, n in runs), default=0)}",
+        ]
+        if runs:
+            histogram = Counter(n for _, n in runs)
+            lines.append("  run lengths: " + ", ".join(f"{n}x{count}" for n, count in sorted(histogram.items())))
+        if rtts:
+            lines.append(
+                f"  RTT over {len(rtts)} retries: p50 {rtts[len(rtts) // 2]:.2f} ms, "
+                f"p90 {rtts[int(len(rtts) * 0.9)]:.2f} ms, max {rtts[-1]:.2f} ms"
+            )
+        return "\n".join(lines)
+
+
+def write_csv(path: str, header: Sequence[str], rows) -> None:
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def plot(analysis: Analysis, path: str) -> None:
+    try:
+        import matplotlib
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        sys.exit("--plot needs matplotlib (pip install matplotlib)")
+
+    figure, (top, middle, bottom) = plt.subplots(3, 1, figsize=(10, 9))
+    series = analysis.goodput()
+    top.plot([t for t, _, _ in series], [v for _, v, _ in series], label="new data")
+    top.plot([t for t, _, _ in series], [v for _, _, v in series], label="retransmitted")
+    top.set(xlabel="s", ylabel="MiB/s", title=f"{analysis.header.name}: goodput")
+    top.legend()
+
+    losses = analysis.losses()
+    middle.hist(losses, bins=min(200, max(1, len(losses))))
+    middle.set(xlabel="sequence number", ylabel="lost packets", title="loss positions")
+
+    rtt = analysis.rtt()
+    bottom.plot([t for t, _ in rtt], [v for _, v in rtt], ".", markersize=3)
+    bottom.set(xlabel="s", ylabel="ms", title="RTT of retries")
+
+    figure.tight_layout()
+    figure.savefig(path)
+    plt.close(figure)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Analyse .nptrace packet traces")
+    parser.add_argument("traces", nargs="+")
+    parser.add_argument("--bin", type=float, default=100.0, help="Goodput bin width, ms")
+    parser.add_argument("--csv", metavar="DIR", help="Write goodput, loss and RTT series here")
+    parser.add_argument("--plot", metavar="DIR", help="Write a PNG chart per trace here (needs matplotlib)")
+    args = parser.parse_args()
+
+    for path in args.traces:
+        header, records = read_trace(path)
+        analysis = Analysis(header, list(records), int(args.bin * 1e6))
+        print(f"{path}\n{analysis.summary()}\n")
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if args.csv:
+            os.makedirs(args.csv, exist_ok=True)
+            base = os.path.join(args.csv, stem)
+            write_csv(f"{base}.goodput.csv", ("time_s", "new_mib_s", "retransmitted_mib_s"), analysis.goodput())
+            write_csv(f"{base}.losses.csv", ("first_seq", "run_length"), analysis.loss_runs())
+            write_csv(f"{base}.rtt.csv", ("time_s", "rtt_ms"), analysis.rtt())
+        if args.plot:
+            os.makedirs(args.plot, exist_ok=True)
+            plot(analysis, os.path.join(args.plot, f"{stem}.png"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,53 @@
+import errno
 import socket
 import os
 import time
-from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, TransferSpeedColumn
-from rich.console import Console
-from rich.prompt import Prompt
-from rich.panel import Panel
-
-console = Console()
+import datetime
+
+from protocol import (
+    DOWNLOAD_REPLY,
+    OP_CLOSE,
+    OP_DOWNLOAD,
+    OP_ECHO,
+    OP_ERROR,
+    OP_STAT,
+    OP_TIME,
+    OP_UPLOAD,
+    STAT_REPLY,
+    TIME_REPLY,
+    TRANSFER,
+    ProtocolError,
+    encode_frame,
+    pack_transfer,
+    pack_upload,
+    recv_frame,
+)
+from progress import ProgressRenderer
+from terminal import Terminal
+
+console = Terminal()
+progress = ProgressRenderer(console, wait_on_finish=True)
 
 SERVER_ADDRESS = "192.168.1.107"
 SERVER_PORT = 12345
 OPT_INTERVAL = 10
 OPT_COUNT = 3
-BUF_SIZE = 1024
+SENDFILE_SLICE = 8 * 1024 * 1024  # bytes per sendfile call, so progress keeps moving
+MIN_RECV_CHUNK = 256 * 1024
+MAX_RECV_CHUNK = 4 * 1024 * 1024
+RECONNECT_ATTEMPTS = 6
+RECONNECT_DELAY = 1  # seconds before the first attempt, doubled after every failure
+RECONNECT_MAX_DELAY = 30
 
 exitFlag = False
+lastRequestId = 0
+
+COMMAND_OPCODES = {
+    "echo": OP_ECHO,
+    "time": OP_TIME,
+    "stat": OP_STAT,
+    "exit": OP_CLOSE,
+}
 
 def format_size(size):
     """Formats file size dynamically (B, KB, MB, GB)"""
@@ -40,45 +73,71 @@ def connect(clientSocket):
     clientSocket.connect((SERVER_ADDRESS, SERVER_PORT))
     return clientSocket
 
-def reconnectPrompt():
-    console.print(Panel.fit("[red]Connection lost.[/red]", title="Error"))
-    return Prompt.ask("Do you want to try reconnecting?", choices=["y", "n"]) == "y"
+def reconnect():
+    # Keepalive and TCP_USER_TIMEOUT (setOptions) turn a dead link into an
+    # error; then back off 1, 2, 4... seconds between attempts.
+    console.panel("[red]Connection lost.[/red]", title="Error", fit=True)
+    delay = RECONNECT_DELAY
+    for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+        console.print(f"[yellow]Reconnecting in {delay} s (attempt {attempt}/{RECONNECT_ATTEMPTS})...[/yellow]")
+        time.sleep(delay)
+        newSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            return connect(newSocket)
+        except socket.error:
+            newSocket.close()
+            delay = min(RECONNECT_MAX_DELAY, delay * 2)
+    return None
+
+def connectionLost(error):
+    if isinstance(error, (ConnectionError, TimeoutError, ProtocolError)):
+        return True
+    return error.errno in (errno.ENETDOWN, errno.ENETUNREACH, errno.EHOSTDOWN, errno.EHOSTUNREACH)
+
+def nextRequestId():
+    global lastRequestId
+    lastRequestId = (lastRequestId + 1) & 0xFFFFFFFF
+    return lastRequestId
+
+def sendRequest(opcode, payload=b""):
+    requestId = nextRequestId()
+    clientSocket.sendall(encode_frame(requestId, opcode, payload))
+    return requestId
 
 def upload(filePath):
     if not os.path.exists(filePath):
-        clientSocket.send("0".encode())
-        clientSocket.send(f"File \"{filePath}\" not found.".encode())
-        return clientSocket.recv(BUF_SIZE).decode()
+        return f"File \"{filePath}\" not found."
 
-    clientSocket.send("1".encode())
-    offset, fileSize = uploadFile(filePath)
-    return clientSocket.recv(BUF_SIZE).decode()
+    st = os.stat(filePath)
+    fileSize = st.st_size
+    sendRequest(OP_UPLOAD, pack_upload(fileSize, st.st_mtime_ns, filePath))
+    reply = recv_frame(clientSocket)
+    if reply.opcode == OP_ERROR:
+        return reply.payload.decode()
 
-def uploadFile(filePath):
-    with open(filePath, 'rb') as file:
-        fileSize = os.path.getsize(filePath)
-        clientSocket.send(str(fileSize).encode())
-        offset = int(clientSocket.recv(BUF_SIZE).decode())
-        file.seek(offset, 0)
+    (offset,) = TRANSFER.unpack(reply.payload)
+    uploadFile(filePath, offset, fileSize)
+    return recv_frame(clientSocket).payload.decode()
+
+def recvChunkSize():
+    # Follow the kernel receive buffer so one recv_into drains what arrived.
+    size = clientSocket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    return max(MIN_RECV_CHUNK, min(MAX_RECV_CHUNK, size))
 
-        console.print(Panel.fit(f"[cyan]Uploading file:[/cyan] [bold]{filePath}[/bold] ([green]{format_size(fileSize)}[/green])", title="Upload"))
+def uploadFile(filePath, offset, fileSize):
+    with open(filePath, 'rb') as file:
+        console.panel(f"[cyan]Uploading file:[/cyan] [bold]{filePath}[/bold] ([green]{format_size(fileSize)}[/green])", title="Upload", fit=True)
 
         start_time = time.time()
 
-        with Progress(
-            TextColumn("[bold blue]Uploading[/bold blue]"),
-            BarColumn(),
-            TransferSpeedColumn(),
-            TimeElapsedColumn(),
-            console=console
-        ) as progress:
-            task = progress.add_task("upload", total=fileSize, completed=offset)
+        with progress.track("Uploading", fileSize, offset) as counter:
 
             while offset < fileSize:
-                data = file.read(BUF_SIZE)
-                clientSocket.send(data)
-                offset += len(data)
-                progress.update(task, completed=offset)
+                sent = clientSocket.sendfile(file, offset, min(SENDFILE_SLICE, fileSize - offset))
+                if not sent:
+                    raise ValueError(f"File \"{filePath}\" shrank during upload")
+                offset += sent
+                counter.done = offset
 
         total_time = time.time() - start_time
         speed = fileSize / total_time / 1024  # KB/s
@@ -88,40 +147,37 @@ def uploadFile(filePath):
     return offset, fileSize
 
 def download(filePath):
-    serverHasFile = clientSocket.recv(1).decode()
-    if serverHasFile == "0":
-        return clientSocket.recv(BUF_SIZE).decode()
-    
-    offset, fileSize = downloadFile(filePath)
-    return clientSocket.recv(BUF_SIZE).decode()
-    
-def downloadFile(fileName):
-    mode = 'ab' if os.path.exists(fileName) else 'wb+'
+    offset = os.path.getsize(filePath) if os.path.exists(filePath) else 0
+    sendRequest(OP_DOWNLOAD, pack_transfer(offset, filePath))
+    reply = recv_frame(clientSocket)
+    if reply.opcode == OP_ERROR:
+        return reply.payload.decode()
+
+    offset, fileSize = DOWNLOAD_REPLY.unpack(reply.payload)
+    downloadFile(filePath, offset, fileSize)
+    return recv_frame(clientSocket).payload.decode()
+
+def downloadFile(fileName, offset, fileSize):
+    mode = 'r+b' if offset else 'wb+'
 
     with open(fileName, mode) as file:
-        offset = os.path.getsize(fileName)
-        clientSocket.send(str(offset).encode())
-        fileSize = int(clientSocket.recv(BUF_SIZE).decode())
-        file.seek(0, os.SEEK_END)
+        file.truncate(offset)
+        file.seek(offset, 0)
 
-        console.print(Panel.fit(f"[cyan]Downloading file:[/cyan] [bold]{fileName}[/bold] ([green]{format_size(fileSize)}[/green])", title="Download"))
+        console.panel(f"[cyan]Downloading file:[/cyan] [bold]{fileName}[/bold] ([green]{format_size(fileSize)}[/green])", title="Download", fit=True)
 
         start_time = time.time()
+        buffer = memoryview(bytearray(recvChunkSize()))
 
-        with Progress(
-            TextColumn("[bold yellow]Downloading[/bold yellow]"),
-            BarColumn(),
-            TransferSpeedColumn(),
-            TimeElapsedColumn(),
-            console=console
-        ) as progress:
-            task = progress.add_task("download", total=fileSize, completed=offset)
+        with progress.track("Downloading", fileSize, offset) as counter:
 
             while fileSize > offset:
-                data = clientSocket.recv(min(BUF_SIZE, fileSize - offset))
-                file.write(data)
-                offset += len(data)
-                progress.update(task, completed=offset)
+                received = clientSocket.recv_into(buffer, min(len(buffer), fileSize - offset))
+                if not received:
+                    raise ConnectionResetError("Connection closed during download")
+                file.write(buffer[:received])
+                offset += received
+                counter.done = offset
 
         total_time = time.time() - start_time
         speed = fileSize / total_time / 1024  # KB/s
@@ -134,8 +190,36 @@ def exit():
     global exitFlag
     exitFlag = True
 
-def otherCommand(userInput):
-    return clientSocket.recv(BUF_SIZE).decode()
+def formatResponse(opcode, reply):
+    if reply.opcode == OP_ERROR:
+        return reply.payload.decode()
+    if opcode == OP_TIME:
+        (timestamp,) = TIME_REPLY.unpack(reply.payload)
+        return "Server time: " + time.asctime(time.localtime(timestamp))
+    if opcode == OP_STAT:
+        size, mtime = STAT_REPLY.unpack(reply.payload)
+        return f"{format_size(size)}, modified {datetime.datetime.fromtimestamp(mtime):%Y-%m-%d %H:%M:%S}"
+    return reply.payload.decode()
+
+def otherCommands(userInputs):
+    # Small requests are pipelined: all of them go out before the first reply is read.
+    pending = {}
+    batch = bytearray()
+    for userInput in userInputs:
+        command, argument = userInput.partition(" ")[::2]
+        opcode = COMMAND_OPCODES.get(command.lower())
+        if opcode is None:
+            return "Command not found!"
+        requestId = nextRequestId()
+        pending[requestId] = opcode
+        batch += encode_frame(requestId, opcode, argument.encode())
+
+    clientSocket.sendall(batch)
+    responses = {}
+    while len(responses) < len(pending):
+        reply = recv_frame(clientSocket)
+        responses[reply.request_id] = formatResponse(pending[reply.request_id], reply)
+    return "\n".join(responses[requestId] for requestId in pending)
 
 def handleCommand(userInput):
     command, argument = userInput.partition(" ")[::2]
@@ -146,7 +230,7 @@ def handleCommand(userInput):
         case "download":
             response = download(argument)
         case _:
-            response = otherCommand(userInput)
+            response = otherCommands([c.strip() for c in userInput.split(";") if c.strip()])
 
     if userInput.lower() == "exit":
         exit()
@@ -155,37 +239,62 @@ def handleCommand(userInput):
 
 #------------
 
-try:
-    clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    clientSocket = connect(clientSocket)
-    console.print(Panel.fit("[green]Connection established.[/green]", title="Status"))
+def main():
+    global clientSocket, exitFlag
 
-    while not exitFlag:
-        try:
-            userInput = Prompt.ask("[bold blue]>[/bold blue]").strip()
-            while not userInput:
-                userInput = Prompt.ask("[bold blue]>[/bold blue]").strip()
-            clientSocket.send(userInput.encode())
-            response = handleCommand(userInput)
-            console.print(Panel.fit(response, title="Server Response", border_style="green"))
- 
-        except socket.error:
-            clientSocket.close()
+    try:
+        clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        clientSocket = connect(clientSocket)
+        console.panel("[green]Connection established.[/green]", title="Status", fit=True)
+
+        userInput = None
+        while not exitFlag:
             try:
-                if reconnectPrompt():
-                    clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    clientSocket = connect(clientSocket)
-                    console.print(Panel.fit("[green]Connection restored.[/green]", title="Status"))
-                else:
+                # A command cut off by a lost connection runs again after the
+                # reconnect; transfers resume, the server continuing uploads
+                # from its file size and downloads from ours.
+                if userInput is None:
+                    userInput = console.prompt("[bold blue]>[/bold blue]").strip()
+                    while not userInput:
+                        userInput = console.prompt("[bold blue]>[/bold blue]").strip()
+                response = handleCommand(userInput)
+                userInput = None
+                console.panel(response, title="Server Response", style="green", fit=True)
+
+            except (socket.error, ProtocolError) as e:
+                if not connectionLost(e):
+                    message = f"{e.strerror}: {e.filename}" if e.filename else e.strerror or str(e)
+                    console.panel(f"[red]{message}[/red]", title="Error", fit=True)
+                    userInput = None
+                    continue
+                clientSocket.close()
+                if userInput is not None and userInput.lower() == "exit":
+                    exitFlag = True
+                    continue
+                newSocket = reconnect()
+                if newSocket is None:
+                    console.panel("[red]Failed to reconnect.[/red]", title="Error", fit=True)
                     exitFlag = True
-            except socket.error:
-                console.print(Panel.fit("[red]Failed to reconnect.[/red]", title="Error"))
-                exitFlag = True
-
-except socket.error:
-    console.print(Panel.fit("[red]Server unavailable.[/red]", title="Error"))
-except KeyboardInterrupt:
-    console.print(Panel.fit("[red]Exiting program.[/red]", title="Exit"))
-    
-finally:
-    clientSocket.close()
+                else:
+                    clientSocket = newSocket
+                    console.panel("[green]Connection restored.[/green]", title="Status", fit=True)
+
+            except ValueError as e:
+                # The file shrank mid-upload: the server still waits for the
+                # missing bytes, so only a new connection gets back in step.
+                console.panel(f"[red]{e}[/red]", title="Error", fit=True)
+                userInput = None
+                clientSocket.close()
+                clientSocket = connect(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+
+    except socket.error:
+        console.panel("[red]Server unavailable.[/red]", title="Error", fit=True)
+    except KeyboardInterrupt:
+        console.panel("[red]Exiting program.[/red]", title="Exit", fit=True)
+
+    finally:
+        clientSocket.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Length-prefixed binary control protocol shared by the TCP servers and clients.
+
+Every control message is a frame::
+
+    +----------------+----------------+--------+-----------------+
+    | length (u32)   | request id u32 | op u8  | payload[length] |
+    +----------------+----------------+--------+-----------------+
+
+Responses carry the request id of the request they answer, so a client may
+pipeline many ECHO/TIME/STAT requests and match the replies by id. Bulk file
+data is not framed: after an OK reply to DOWNLOAD (or after the client gets
+OK for UPLOAD) exactly the announced number of raw bytes follows, and the
+transfer is closed with a DONE frame carrying the same request id.
+MANIFEST is answered with any number of OK frames of packed entries, also
+closed with DONE. CHUNKS is an UPLOAD split into CHUNK_SIZE pieces: the OK
+reply lists the chunks the server lacks, and only those follow, in order.
+"""
+
+import struct
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+HEADER = struct.Struct("!IIB")
+MAX_PAYLOAD = 1024 * 1024
+CHUNK_SIZE = 1024 * 1024  # bytes per chunk of a CHUNKS upload, the last one may be shorter
+
+# Requests
+OP_ECHO = 0x01  # payload: utf-8 text -> OK: the same text
+OP_TIME = 0x02  # payload: empty -> OK: TIME_REPLY
+OP_STAT = 0x03  # payload: file name -> OK: STAT_REPLY
+OP_UPLOAD = 0x04  # payload: UPLOAD_REQUEST + file name -> OK: TRANSFER(offset)
+OP_DOWNLOAD = 0x05  # payload: TRANSFER(offset) + file name -> OK: DOWNLOAD_REPLY
+OP_CLOSE = 0x06  # payload: empty -> OK: utf-8 text, then the server hangs up
+OP_HELLO = 0x07  # payload: client token -> OK
+OP_MANIFEST = 0x08  # payload: directory -> OK: MANIFEST_ENTRY records..., then DONE
+OP_HAVE = 0x09  # payload: sha256 + file name -> OK if the server stored that content under the name
+OP_CHUNKS = 0x0A  # payload: CHUNKED_UPLOAD + sha256 of every chunk + file name -> OK: u32 indexes of missing chunks
+
+# Responses
+OP_OK = 0x80
+OP_DONE = 0x81  # end of an upload/download, payload: utf-8 text
+OP_ERROR = 0x82  # payload: utf-8 text
+
+OP_NAMES = {
+    OP_ECHO: "ECHO",
+    OP_TIME: "TIME",
+    OP_STAT: "STAT",
+    OP_UPLOAD: "UPLOAD",
+    OP_DOWNLOAD: "DOWNLOAD",
+    OP_CLOSE: "CLOSE",
+    OP_HELLO: "HELLO",
+    OP_MANIFEST: "MANIFEST",
+    OP_HAVE: "HAVE",
+    OP_CHUNKS: "CHUNKS",
+    OP_OK: "OK",
+    OP_DONE: "DONE",
+    OP_ERROR: "ERROR",
+}
+
+# Binary payload fields
+TRANSFER = struct.Struct("!Q")  # offset or size, followed by the file name
+UPLOAD_REQUEST = struct.Struct("!Qq")  # size, source mtime in ns, followed by the file name
+TIME_REPLY = struct.Struct("!d")  # seconds since the epoch
+STAT_REPLY = struct.Struct("!Qd")  # size, mtime
+DOWNLOAD_REPLY = struct.Struct("!QQ")  # first byte sent, total file size
+HAVE_REQUEST = struct.Struct("!32s")  # sha256 of the content, followed by the file name
+MANIFEST_ENTRY = struct.Struct("!Qq32sH")  # size, mtime in ns, sha256, name length, followed by the name
+CHUNKED_UPLOAD = struct.Struct("!QqI")  # size, source mtime in ns, chunk count, followed by digests and name
+MAX_CHUNKS = (MAX_PAYLOAD - CHUNKED_UPLOAD.size - 4096) // 32  # leaves room for a 4 KiB name
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a malformed or oversized frame."""
+
+
+class Frame(NamedTuple):
+    request_id: int
+    opcode: int
+    payload: bytes
+
+
+def encode_frame(request_id: int, opcode: int, payload: bytes = b"") -> bytes:
+    """
+    Serializes a frame.
+
+    Parameters
+    ----------
+    request_id : int
+        Identifier chosen by the client and echoed back in the response.
+    opcode : int
+        One of the OP_* constants.
+    payload : bytes, optional
+        Frame body, by default empty.
+
+    Returns
+    -------
+    bytes
+        Header and payload ready to be written to the socket.
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload), request_id, opcode) + payload
+
+
+def send_frame(sock, request_id: int, opcode: int, payload: bytes = b"") -> None:
+    """Writes a single frame to a blocking socket."""
+    sock.sendall(encode_frame(request_id, opcode, payload))
+
+
+def recv_exact(sock, size: int) -> bytes:
+    """
+    Reads exactly ``size`` bytes from a blocking socket.
+
+    Raises
+    ------
+    ConnectionError
+        If the peer closes the connection first.
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            raise ConnectionError("Connection closed by peer")
+        received += n
+    return bytes(data)
+
+
+def recv_frame(sock) -> Frame:
+    """Reads a single frame from a blocking socket."""
+    length, request_id, opcode = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload too large: {length} bytes")
+    payload = recv_exact(sock, length) if length else b""
+    return Frame(request_id, opcode, payload)
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for non-blocking sockets.
+
+    Bytes are appended with ``feed`` as they arrive; complete frames are
+    taken out with ``next_frame``. Raw transfer data that follows a frame is
+    taken out with ``take``.
+    """
+
+    __slots__ = ("buffer",)
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+
+    def next_frame(self) -> Optional[Frame]:
+        if len(self.buffer) < HEADER.size:
+            return None
+        length, request_id, opcode = HEADER.unpack_from(self.buffer)
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Payload too large: {length} bytes")
+        end = HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        payload = bytes(self.buffer[HEADER.size:end])
+        del self.buffer[:end]
+        return Frame(request_id, opcode, payload)
+
+    def take(self, size: int) -> bytes:
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def pack_transfer(value: int, name: str) -> bytes:
+    return TRANSFER.pack(value) + name.encode()
+
+
+def unpack_transfer(payload: bytes) -> Tuple[int, str]:
+    if len(payload) < TRANSFER.size:
+        raise ProtocolError("Truncated transfer request")
+    (value,) = TRANSFER.unpack_from(payload)
+    return value, payload[TRANSFER.size:].decode()
+
+
+def pack_upload(size: int, mtime_ns: int, name: str) -> bytes:
+    return UPLOAD_REQUEST.pack(size, mtime_ns) + name.encode()
+
+
+def unpack_upload(payload: bytes) -> Tuple[int, int, str]:
+    if len(payload) < UPLOAD_REQUEST.size:
+        raise ProtocolError("Truncated upload request")
+    size, mtime_ns = UPLOAD_REQUEST.unpack_from(payload)
+    return size, mtime_ns, payload[UPLOAD_REQUEST.size:].decode()
+
+
+def pack_have(digest: bytes, name: str) -> bytes:
+    return HAVE_REQUEST.pack(digest) + name.encode()
+
+
+def unpack_have(payload: bytes) -> Tuple[bytes, str]:
+    if len(payload) < HAVE_REQUEST.size:
+        raise ProtocolError("Truncated have request")
+    (digest,) = HAVE_REQUEST.unpack_from(payload)
+    return digest, payload[HAVE_REQUEST.size:].decode()
+
+
+def pack_chunked_upload(size: int, mtime_ns: int, digests: List[bytes], name: str) -> bytes:
+    return CHUNKED_UPLOAD.pack(size, mtime_ns, len(digests)) + b"".join(digests) + name.encode()
+
+
+def unpack_chunked_upload(payload: bytes) -> Tuple[int, int, List[bytes], str]:
+    if len(payload) < CHUNKED_UPLOAD.size:
+        raise ProtocolError("Truncated chunked upload request")
+    size, mtime_ns, count = CHUNKED_UPLOAD.unpack_from(payload)
+    end = CHUNKED_UPLOAD.size + 32 * count
+    if len(payload) < end:
+        raise ProtocolError("Truncated chunked upload request")
+    digests = [payload[i:i + 32] for i in range(CHUNKED_UPLOAD.size, end, 32)]
+    return size, mtime_ns, digests, payload[end:].decode()
+
+
+def pack_indexes(indexes: List[int]) -> bytes:
+    return struct.pack(f"!{len(indexes)}I", *indexes)
+
+
+def unpack_indexes(payload: bytes) -> List[int]:
+    if len(payload) % 4:
+        raise ProtocolError("Truncated index list")
+    return list(struct.unpack(f"!{len(payload) // 4}I", payload))
+
+
+def pack_manifest(entries: Iterable[Tuple[str, int, int, bytes]]) -> Iterator[bytes]:
+    """Packs (name, size, mtime_ns, digest) entries into payloads of at most MAX_PAYLOAD bytes."""
+    payload = bytearray()
+    for name, size, mtime_ns, digest in entries:
+        encoded = name.encode()
+        record = MANIFEST_ENTRY.pack(size, mtime_ns, digest, len(encoded)) + encoded
+        if len(payload) + len(record) > MAX_PAYLOAD:
+            yield bytes(payload)
+            payload.clear()
+        payload += record
+    if payload:
+        yield bytes(payload)
+
+
+def unpack_manifest(payload: bytes) -> Iterator[Tuple[str, int, int, bytes]]:
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < MANIFEST_ENTRY.size:
+            raise ProtocolError("Truncated manifest entry")
+        size, mtime_ns, digest, length = MANIFEST_ENTRY.unpack_from(payload, offset)
+        offset += MANIFEST_ENTRY.size
+        if len(payload) - offset < length:
+            raise ProtocolError("Truncated manifest entry")
+        yield payload[offset:offset + length].decode(), size, mtime_ns, digest
+        offset += length
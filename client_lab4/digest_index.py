@@ -0,0 +1,285 @@
+"""Content digests of directory trees, cached across runs."""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+DIGEST_ALGORITHM = "sha256"
+DIGEST_SIZE = 32
+RACY_WINDOW_NS = 2 * 10 ** 9  # files modified this recently are not cached
+SAVE_INTERVAL = 5.0  # seconds between writes of a busy cache
+
+
+class Entry(NamedTuple):
+    size: int
+    mtime_ns: int
+    digest: bytes
+
+
+def file_digest(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, DIGEST_ALGORITHM).digest()
+
+
+def validator(st: os.stat_result) -> List[int]:
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class DigestIndex:
+    """
+    Remembers the SHA-256 digest of every file it has hashed.
+
+    A cached digest is reused as long as the file keeps its size, mtime and
+    inode number, so scanning an unchanged tree costs one stat per file and
+    no reads. Files modified within the last couple of seconds are hashed
+    but not cached: a second write within the same mtime tick would go
+    unnoticed otherwise. Servers ``record`` the files they have just
+    written themselves, and find stored content again with ``lookup``.
+
+    The cache is a JSON file rewritten atomically by ``save``. Several
+    processes may share it: a lookup that misses first merges what the
+    others saved, and the last writer wins, which at worst costs some
+    rehashing.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Loads the cache from ``path``.
+
+        Parameters
+        ----------
+        path : str, optional
+            Cache file location; without one nothing is persisted.
+        """
+        self.path = path
+        # absolute path -> [size, mtime_ns, inode, hex digest]
+        self.entries: Dict[str, List] = {}
+        self.by_digest: Dict[str, str] = {}  # hex digest -> absolute path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.saved_at = 0.0
+        self.loaded_mtime_ns = 0
+
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """
+        Merges entries other processes saved since the last load.
+
+        Returns
+        -------
+        bool
+            True if the cache file changed.
+        """
+        if not self.path:
+            return False
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+            if mtime_ns == self.loaded_mtime_ns:
+                return False
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(data, dict):
+            return False
+
+        with self.lock:
+            self.loaded_mtime_ns = mtime_ns
+            for key, value in data.items():
+                if key not in self.entries and isinstance(value, list) and len(value) == 4:
+                    self.entries[key] = value
+                    self.by_digest.setdefault(value[3], key)
+        return True
+
+    def _remember(self, key: str, st: os.stat_result, digest: bytes) -> None:
+        with self.lock:
+            self.entries[key] = validator(st) + [digest.hex()]
+            self.by_digest[digest.hex()] = key
+            self.dirty = True
+
+    def _forget(self, key: str) -> None:
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if self.by_digest.get(entry[3]) == key:
+                    del self.by_digest[entry[3]]
+                self.dirty = True
+
+    def digest(self, path: str, st: Optional[os.stat_result] = None) -> bytes:
+        """
+        Returns the digest of ``path``, hashing it only if it changed.
+
+        Parameters
+        ----------
+        path : str
+            The file to hash.
+        st : os.stat_result, optional
+            A fresh stat of the file, if the caller already has one.
+        """
+        key = os.path.abspath(path)
+        if st is None:
+            st = os.stat(path)
+        with self.lock:
+            cached = self.entries.get(key)
+        if cached is not None and cached[:3] == validator(st):
+            return bytes.fromhex(cached[3])
+
+        digest = file_digest(path)
+        after = os.stat(path)
+        if (
+            validator(after) == validator(st)
+            and time.time_ns() - st.st_mtime_ns >= RACY_WINDOW_NS
+        ):
+            self._remember(key, st, digest)
+        return digest
+
+    def record(self, path: str, digest: Optional[bytes] = None) -> bytes:
+        """
+        Caches the digest of a file the caller has just finished writing.
+
+        Unlike ``digest`` this trusts a fresh mtime, since no one else
+        writes the file. Without ``digest`` the file is hashed.
+        """
+        st = os.stat(path)
+        if digest is None:
+            digest = file_digest(path)
+        self._remember(os.path.abspath(path), st, digest)
+        return digest
+
+    def lookup(self, digest: bytes) -> Optional[str]:
+        """
+        Finds a file with the given content.
+
+        Returns
+        -------
+        Optional[str]
+            The absolute path of a file that still has the cached size,
+            mtime and inode, or None.
+        """
+        key = digest.hex()
+        with self.lock:
+            path = self.by_digest.get(key)
+        if path is None and self.refresh():
+            with self.lock:
+                path = self.by_digest.get(key)
+        if path is None:
+            return None
+
+        with self.lock:
+            cached = self.entries.get(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if cached is None or st is None or cached[:3] != validator(st):
+            self._forget(path)
+            return None
+        return path
+
+    def copy_to(self, digest: bytes, target: str) -> bool:
+        """
+        Makes ``target`` a copy of stored content with the given digest.
+
+        The copy is written next to ``target`` and renamed over it, so
+        readers never see a partial file.
+
+        Returns
+        -------
+        bool
+            False if no file with that content is known.
+        """
+        source = self.lookup(digest)
+        if source is None:
+            return False
+        if source == os.path.abspath(target):
+            return True
+
+        tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(source, tmp)
+            os.replace(tmp, target)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        self.record(target, digest)
+        return True
+
+    def manifest(self, root: str) -> Dict[str, Entry]:
+        """
+        Lists every regular file under ``root`` with its size, mtime and digest.
+
+        Symlinks to files are followed, symlinks to directories are not.
+        Cached digests of files that are gone are dropped.
+
+        Returns
+        -------
+        Dict[str, Entry]
+            Keyed by the path relative to ``root``, with "/" separators.
+        """
+        own = os.path.abspath(self.path) if self.path else None
+        files: Dict[str, Entry] = {}
+        seen = set()
+        pending: List[Tuple[str, str]] = [(root, "")]
+        while pending:
+            directory, relative = pending.pop()
+            try:
+                with os.scandir(directory) as it:
+                    items = list(it)
+            except OSError:
+                continue
+            for item in items:
+                name = relative + item.name
+                try:
+                    if item.is_dir(follow_symlinks=False):
+                        pending.append((item.path, name + "/"))
+                        continue
+                    if not item.is_file():
+                        continue
+                    path = os.path.abspath(item.path)
+                    if own and path.startswith(own):
+                        continue
+                    st = item.stat()
+                    files[name] = Entry(st.st_size, st.st_mtime_ns, self.digest(path, st))
+                except OSError:
+                    continue  # vanished or unreadable
+                seen.add(path)
+
+        prefix = os.path.join(os.path.abspath(root), "")
+        with self.lock:
+            stale = [key for key in self.entries if key.startswith(prefix) and key not in seen]
+        for key in stale:
+            self._forget(key)
+        return files
+
+    def save(self, min_interval: float = 0.0) -> None:
+        """
+        Writes the cache out if it changed since the last save.
+
+        Parameters
+        ----------
+        min_interval : float, optional
+            Skip the write if the last one is more recent than this many seconds.
+        """
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty or time.monotonic() - self.saved_at < min_interval:
+                return
+            data = json.dumps(self.entries, separators=(",", ":"))
+            self.dirty = False
+            self.saved_at = time.monotonic()
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+            self.loaded_mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            with self.lock:
+                self.dirty = True
@@ -0,0 +1,258 @@
+"""In-process metrics registry exposed in the Prometheus text format.
+
+Every server imports the shared metric objects defined at the bottom of this
+module, updates them from its transfer and command paths, and calls
+``start_http_server`` to serve ``GET /metrics`` on a local port, e.g.::
+
+    curl -s http://127.0.0.1:9346/metrics
+
+Metric values are updated under a per-metric lock, so the threaded servers
+can share them; callbacks registered with ``set_function`` are evaluated at
+scrape time and cost nothing on the hot path.
+"""
+
+import bisect
+import math
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values: Dict[LabelValues, float] = {}
+        self.functions: Dict[LabelValues, Callable[[], float]] = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        """Reports ``function()`` at scrape time instead of a stored value."""
+        self.functions[self._key(labels)] = function
+
+    def samples(self) -> List[Tuple[str, LabelValues, float]]:
+        with self.lock:
+            samples = [(self.name, key, value) for key, value in self.values.items()]
+        for key, function in self.functions.items():
+            try:
+                samples.append((self.name, key, function()))
+            except Exception:
+                continue
+        return samples
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing value, e.g. bytes sent."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down, e.g. active sessions."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, e.g. latencies."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # {labels: [count per bucket..., count above the last bucket, sum]}
+        self.series: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self) -> List[Tuple[str, LabelValues, float]]:
+        samples = []
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for key, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", key + (_format_value(bound),), cumulative))
+            samples.append((f"{self.name}_count", key, cumulative))
+            samples.append((f"{self.name}_sum", key, values[-1]))
+        return samples
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            names = self.label_names + ("le",) if name.endswith("_bucket") else self.label_names
+            lines.append(f"{name}{_format_labels(names, key)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def start_http_server(
+    port: int, host: str = "127.0.0.1", registry: Optional[Registry] = None
+) -> "ThreadingHTTPServer":
+    """
+    Serves ``registry`` (by default REGISTRY) on ``http://host:port/metrics``
+    from a daemon thread.
+
+    Parameters
+    ----------
+    port : int
+        The port to listen on.
+    host : str, optional
+        The address to bind to, by default only the loopback interface.
+    registry : Registry, optional
+        The registry to expose, by default REGISTRY.
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The running server; call ``shutdown()`` to stop it.
+    """
+    # Imported here: http.server pulls in half the standard library, and a
+    # process that never serves metrics should not pay for it at start-up.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    registry = registry or REGISTRY
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes are not worth a log line each
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+REGISTRY = Registry()
+
+BYTES_IN = REGISTRY.counter("np_bytes_received_total", "File data bytes received from clients")
+BYTES_OUT = REGISTRY.counter("np_bytes_sent_total", "File data bytes sent to clients")
+ACTIVE_SESSIONS = REGISTRY.gauge("np_active_sessions", "Connected clients (TCP) or known client addresses (UDP)")
+TRANSFERS_STARTED = REGISTRY.counter("np_transfers_started_total", "File transfers started", ("direction",))
+TRANSFERS_COMPLETED = REGISTRY.counter("np_transfers_completed_total", "File transfers completed", ("direction",))
+TRANSFERS_ABORTED = REGISTRY.counter("np_transfers_aborted_total", "File transfers interrupted before the end", ("direction",))
+RETRANSMITS = REGISTRY.counter("np_retransmits_total", "Datagrams sent again after a RETRY request")
+NACKS = REGISTRY.counter("np_nacks_total", "RETRY requests for missing datagrams", ("direction",))
+COMMAND_LATENCY = REGISTRY.histogram("np_command_duration_seconds", "Time to handle a command, transfers included", ("command",))
+QUEUE_DEPTH = REGISTRY.gauge("np_queue_depth", "Items waiting in internal queues", ("queue",))
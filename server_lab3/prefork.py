@@ -0,0 +1,282 @@
+"""Pre-fork supervisor for the TCP servers.
+
+The supervisor forks a fixed number of workers. Each worker opens its own
+listening socket on the same address with SO_REUSEPORT, so the kernel spreads
+incoming connections across the workers and every worker runs its unchanged
+accept loop in its own interpreter (and under its own GIL).
+
+Workers report counters through a shared anonymous mmap with one slot per
+worker. Each worker only writes its own slot, and the supervisor only reads,
+so the hot paths never contend across processes. Send SIGUSR1 to the
+supervisor to print the aggregated view.
+"""
+
+import mmap
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, List
+
+STAT_FIELDS = ("accepted", "active", "requests", "bytes_in", "bytes_out")
+SLOT = struct.Struct("=" + "q" * len(STAT_FIELDS))
+COUNTER = struct.Struct("=q")
+FIELD_OFFSETS = {name: i * COUNTER.size for i, name in enumerate(STAT_FIELDS)}
+
+MIN_UPTIME = 1.0  # a worker dying sooner than this is respawned with a delay
+MAX_RESPAWN_DELAY = 30.0
+
+
+def reuseport_listener(host: str, port: int, backlog: int = 128) -> socket.socket:
+    """
+    Creates a listening socket that other processes may bind to as well.
+
+    Parameters
+    ----------
+    host : str
+        The IP address to bind to.
+    port : int
+        The port number to listen on.
+    backlog : int, optional
+        The listen backlog, by default 128
+
+    Returns
+    -------
+    socket.socket
+        A bound, listening socket.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class WorkerStats:
+    """Counters of one worker, living in its slot of a SharedStats map."""
+
+    __slots__ = ("buf", "base", "lock")
+
+    def __init__(self, buf: mmap.mmap, base: int):
+        self.buf = buf
+        self.base = base
+        self.lock = threading.Lock()  # threads of one worker share the slot
+
+    def add(self, field: str, amount: int = 1) -> None:
+        offset = self.base + FIELD_OFFSETS[field]
+        with self.lock:
+            (value,) = COUNTER.unpack_from(self.buf, offset)
+            COUNTER.pack_into(self.buf, offset, value + amount)
+
+    def reset(self, field: str) -> None:
+        with self.lock:
+            COUNTER.pack_into(self.buf, self.base + FIELD_OFFSETS[field], 0)
+
+
+class SharedStats:
+    """
+    Per-worker counters in memory shared across fork().
+
+    Must be created before the workers are forked. A single-process server
+    simply uses slot 0.
+    """
+
+    def __init__(self, slots: int = 1):
+        self.slots = slots
+        self.buf = mmap.mmap(-1, SLOT.size * slots)
+
+    def worker(self, index: int) -> WorkerStats:
+        """
+        Returns the counters of worker ``index``.
+
+        Connections of a previous incarnation of the worker died with it, so
+        its ``active`` count starts over; the totals are kept.
+        """
+        stats = WorkerStats(self.buf, index * SLOT.size)
+        stats.reset("active")
+        return stats
+
+    def snapshot(self) -> List[Dict[str, int]]:
+        return [
+            dict(zip(STAT_FIELDS, SLOT.unpack_from(self.buf, i * SLOT.size)))
+            for i in range(self.slots)
+        ]
+
+    def format(self, pids: Dict[int, int], restarts: List[int]) -> str:
+        """Renders one row per worker and a total row."""
+        header = f"{'worker':>6} {'pid':>7} {'restarts':>8} " + " ".join(
+            f"{name:>12}" for name in STAT_FIELDS
+        )
+        rows = [header]
+        totals = dict.fromkeys(STAT_FIELDS, 0)
+        slot_pids = {index: pid for pid, index in pids.items()}
+
+        for index, counters in enumerate(self.snapshot()):
+            for name in STAT_FIELDS:
+                totals[name] += counters[name]
+            rows.append(
+                f"{index:>6} {slot_pids.get(index, '-'):>7} {restarts[index]:>8} "
+                + " ".join(f"{counters[name]:>12}" for name in STAT_FIELDS)
+            )
+
+        rows.append(
+            f"{'total':>6} {'':>7} {sum(restarts):>8} "
+            + " ".join(f"{totals[name]:>12}" for name in STAT_FIELDS)
+        )
+        return "\n".join(rows)
+
+
+class Supervisor:
+    """
+    Forks ``workers`` processes running ``target(index, stats)`` and keeps
+    them alive.
+
+    * A worker that exits unexpectedly is respawned in the same slot; one
+      that keeps dying right after start is respawned with exponential
+      backoff instead of in a tight fork loop.
+    * SIGTERM or SIGINT starts a graceful shutdown: every worker gets SIGTERM
+      and ``grace`` seconds to finish its in-flight transfers before it is
+      killed.
+    * SIGUSR1 prints the aggregated statistics.
+
+    Workers ignore SIGINT and SIGUSR1 (a Ctrl-C in the terminal reaches the
+    whole process group; the supervisor decides what happens). ``target``
+    is called with SIGTERM at its default action and may install its own
+    handler to drain connections; it should return once it is done.
+    """
+
+    def __init__(
+        self,
+        target: Callable[[int, WorkerStats], None],
+        workers: int,
+        grace: float = 30.0,
+    ):
+        self.target = target
+        self.workers = workers
+        self.grace = grace
+        self.stats = SharedStats(workers)
+        self.pids: Dict[int, int] = {}  # {pid: slot}
+        self.restarts = [0] * workers
+        self.started = [0.0] * workers
+        self.respawn_at: Dict[int, float] = {}  # {slot: monotonic time}
+        self.stopping = False
+        self.report = False
+        self.profile = False
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGUSR1, self._on_report)
+        signal.signal(signal.SIGUSR2, self._on_profile)
+
+        for index in range(self.workers):
+            self._spawn(index)
+        print(f"Supervisor {os.getpid()} started {self.workers} workers", flush=True)
+
+        while not self.stopping:
+            self._reap()
+            now = time.monotonic()
+            for index, due in list(self.respawn_at.items()):
+                if now >= due:
+                    del self.respawn_at[index]
+                    self._spawn(index)
+            if self.report:
+                self.report = False
+                print(self.stats.format(self.pids, self.restarts), flush=True)
+            if self.profile:
+                self.profile = False
+                for pid in self.pids:
+                    os.kill(pid, signal.SIGUSR2)
+            time.sleep(0.2)
+
+        self._shutdown()
+        print(self.stats.format(self.pids, self.restarts), flush=True)
+
+    def _on_stop(self, signum, frame) -> None:
+        self.stopping = True
+
+    def _on_report(self, signum, frame) -> None:
+        self.report = True
+
+    def _on_profile(self, signum, frame) -> None:
+        self.profile = True  # forwarded to every worker
+
+    def _spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = index
+            self.started[index] = time.monotonic()
+            return
+
+        # Child: never return into the supervisor loop.
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)  # until the server installs its profiler
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.target(index, self.stats.worker(index))
+            # Let connection threads finish before the process goes away;
+            # daemon threads (metrics, progress) never do and are not waited for.
+            for thread in threading.enumerate():
+                if thread is not threading.main_thread() and not thread.daemon:
+                    thread.join()
+        except KeyboardInterrupt:
+            pass
+        except BaseException as e:
+            print(f"Worker {index} failed: {e!r}", flush=True)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _reap(self) -> None:
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+
+            index = self.pids.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+
+            self.restarts[index] += 1
+            uptime = time.monotonic() - self.started[index]
+            delay = 0.0
+            if uptime < MIN_UPTIME:
+                delay = min(2 ** min(self.restarts[index], 5) * 0.1, MAX_RESPAWN_DELAY)
+            print(
+                f"Worker {index} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}, "
+                f"respawning in {delay:.1f}s",
+                flush=True,
+            )
+            self.respawn_at[index] = time.monotonic() + delay
+
+    def _shutdown(self) -> None:
+        print(f"Stopping {len(self.pids)} workers...", flush=True)
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + self.grace
+        while self.pids and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self.pids.pop(pid, None)
+            else:
+                time.sleep(0.1)
+
+        for pid in self.pids:
+            print(f"Killing worker pid {pid} after {self.grace:.0f}s grace period", flush=True)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
@@ -0,0 +1,178 @@
+"""On-demand cProfile and tracemalloc capture for a running server.
+
+A server installs a Profiler at start-up. Nothing is traced until the
+process receives SIGUSR2::
+
+    kill -USR2 <pid>     # start capturing for PROFILE_WINDOW seconds
+    kill -USR2 <pid>     # (optional) stop early
+
+When the window ends, the profiler writes three files to ``logs/``:
+
+* ``<name>_<pid>_<time>.pstats``: the raw cProfile data, for
+  ``python -m pstats`` or snakeviz;
+* ``<name>_<pid>_<time>.txt``: the hottest functions overall and what the
+  server's command dispatch and transfer loops spend their time in;
+* ``<name>_<pid>_<time>.alloc.txt``: the top allocation sites that
+  tracemalloc saw during the window.
+
+Since Python 3.12, cProfile hooks into sys.monitoring, which covers every
+thread, so the client threads of the threaded servers are profiled too.
+
+cProfile, pstats and tracemalloc are only imported by the first capture,
+so installing the profiler adds nothing to start-up.
+"""
+
+import io
+import os
+import signal
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional, Sequence
+
+if TYPE_CHECKING:
+    import cProfile
+    import pstats
+    import tracemalloc
+
+PROFILE_SIGNAL = signal.SIGUSR2
+PROFILE_WINDOW = 30.0  # seconds
+PROFILE_DIR = "logs"
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_FRAMES = 10
+
+
+class Profiler:
+    """
+    Toggles profiling on a signal and writes the results when it ends.
+
+    Parameters
+    ----------
+    name : str
+        Prefix of the files written.
+    focus : Sequence[str]
+        Names of the functions the report breaks down, typically the
+        command dispatcher and the transfer loops.
+    report : Callable[[str], None], optional
+        Receives a one-line summary per capture, by default print.
+    window : float, optional
+        Seconds a capture lasts unless stopped early, by default PROFILE_WINDOW
+    log_dir : str, optional
+        Where the files go, by default PROFILE_DIR
+    """
+
+    def __init__(
+        self,
+        name: str,
+        focus: Sequence[str] = (),
+        report: Callable[[str], None] = print,
+        window: float = PROFILE_WINDOW,
+        log_dir: str = PROFILE_DIR,
+    ):
+        self.name = name
+        self.focus = tuple(focus)
+        self.report = report
+        self.window = window
+        self.log_dir = log_dir
+        self.profile: Optional["cProfile.Profile"] = None
+        self.timer: Optional[threading.Timer] = None
+        self.started = 0.0
+        self.lock = threading.Lock()
+
+    def install(self) -> "Profiler":
+        """Makes PROFILE_SIGNAL toggle a capture; costs nothing until then."""
+        signal.signal(PROFILE_SIGNAL, self._on_signal)
+        return self
+
+    def _on_signal(self, signum, frame) -> None:
+        # Writing the results takes a while; never do it inside the handler.
+        if self.profile is None:
+            self.start()
+        else:
+            threading.Thread(target=self.stop, name="profiler", daemon=True).start()
+
+    def start(self) -> None:
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.profile is not None:
+                return
+            import cProfile
+            import tracemalloc
+
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:  # another profiler is already active
+                self.report(f"Profiling not started: {e}")
+                return
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.profile = profile
+            self.started = time.monotonic()
+            self.timer = threading.Timer(self.window, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+        finally:
+            self.lock.release()
+        self.report(f"Profiling for {self.window:.0f}s (send SIGUSR2 again to stop early)")
+
+    def stop(self) -> None:
+        import pstats
+        import tracemalloc
+
+        with self.lock:
+            profile, self.profile = self.profile, None
+            if profile is None:
+                return
+            profile.disable()
+            self.timer.cancel()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            elapsed = time.monotonic() - self.started
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        stamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+        base = os.path.join(self.log_dir, f"{self.name}_{os.getpid()}_{stamp}")
+
+        profile.dump_stats(base + ".pstats")
+        stats = pstats.Stats(profile)
+        with open(base + ".txt", "w") as f:
+            f.write(self._format_functions(stats, elapsed))
+        with open(base + ".alloc.txt", "w") as f:
+            f.write(self._format_allocations(snapshot))
+
+        hottest = ", ".join(
+            pstats.func_std_string(func)
+            for func, _ in sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:3]
+        )
+        self.report(f"Profile of {elapsed:.1f}s written to {base}.* (hottest: {hottest})")
+
+    def _format_functions(self, stats: "pstats.Stats", elapsed: float) -> str:
+        import pstats
+
+        out = io.StringIO()
+        out.write(f"Profile of {self.name} (pid {os.getpid()}) over {elapsed:.1f}s\n\n")
+        stats.stream = out
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(TOP_FUNCTIONS)
+        for function in self.focus:
+            out.write(f"\n===== Inside {function} =====\n")
+            stats.sort_stats(pstats.SortKey.TIME).print_callees(rf"\({function}\)$")
+        return out.getvalue()
+
+    def _format_allocations(self, snapshot: "tracemalloc.Snapshot") -> str:
+        import tracemalloc
+
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        out = io.StringIO()
+        out.write(f"Live allocations of {self.name} (pid {os.getpid()}) made while profiling\n\n")
+        for number, stat in enumerate(snapshot.statistics("lineno")[:TOP_ALLOCATIONS], 1):
+            out.write(f"#{number}: {stat}\n")
+
+        out.write("\nLargest allocation sites with their call stacks:\n")
+        for stat in snapshot.statistics("traceback")[:5]:
+            out.write(f"\n{stat.count} blocks, {stat.size / 1024:.1f} KiB\n")
+            out.write("\n".join(stat.traceback.format()) + "\n")
+        return out.getvalue()
@@ -0,0 +1,179 @@
+"""Transfer progress that stays out of the transfer loops.
+
+A transfer loop only bumps an integer on its TransferCounter
+(``counter.done += len(chunk)``). A background thread samples all live
+counters a few times per second and draws them with rich, so the cost of
+rendering no longer grows with the number of chunks.
+
+In headless mode (see terminal.headless_default) nothing is drawn and
+rich is never imported.
+"""
+
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from terminal import headless_default
+
+REFRESH_INTERVAL = 0.25  # seconds between two renders
+
+
+class TransferCounter:
+    """
+    Progress of one transfer.
+
+    Only the transferring thread writes ``done``; the renderer only reads
+    it. An attribute store is atomic under the GIL, so no lock is needed.
+    """
+
+    __slots__ = ("description", "total", "done", "finished", "rendered")
+
+    def __init__(self, description: str, total: int, done: int = 0):
+        self.description = description
+        self.total = total
+        self.done = done
+        self.finished = False
+        self.rendered = threading.Event()
+
+
+class ProgressRenderer:
+    """
+    Draws every tracked TransferCounter on one rich progress display.
+
+    The render thread starts with the first transfer and stops when the
+    last one has finished, so an idle server has no extra thread. Several
+    concurrent transfers (threads of one server) share the display.
+    """
+
+    def __init__(
+        self,
+        console=None,
+        interval: float = REFRESH_INTERVAL,
+        headless: Optional[bool] = None,
+        wait_on_finish: bool = False,
+    ):
+        """
+        Parameters
+        ----------
+        console : terminal.Terminal or rich.console.Console, optional
+            Console to draw on, so progress and log output do not interleave.
+        interval : float, optional
+            Seconds between two renders, by default REFRESH_INTERVAL
+        headless : bool, optional
+            Skip rendering entirely, by default headless_default()
+        wait_on_finish : bool, optional
+            Block the end of ``track`` until the final state of the transfer
+            has been drawn. Interactive clients want this so the finished
+            bar appears before their next prompt; servers do not.
+        """
+        self.console = console
+        self.interval = interval
+        self.headless = headless_default() if headless is None else headless
+        self.wait_on_finish = wait_on_finish
+        self.counters: Dict[TransferCounter, Optional[int]] = {}  # {counter: task id}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    @contextmanager
+    def track(self, description: str, total: int, done: int = 0) -> Iterator[TransferCounter]:
+        """
+        Registers a transfer for the duration of a with block.
+
+        Parameters
+        ----------
+        description : str
+            Label shown next to the bar.
+        total : int
+            Size of the transfer in bytes.
+        done : int, optional
+            Bytes already transferred (resumed transfers), by default 0
+
+        Yields
+        ------
+        TransferCounter
+            The counter the transfer loop advances.
+        """
+        counter = self.start(description, total, done)
+        try:
+            yield counter
+        finally:
+            self.finish(counter)
+
+    def start(self, description: str, total: int, done: int = 0) -> TransferCounter:
+        """Registers a transfer; for callers that cannot use ``track``."""
+        counter = TransferCounter(description, total, done)
+        if self.headless:
+            return counter
+
+        with self.lock:
+            self.counters[counter] = None
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="progress", daemon=True)
+                self.thread.start()
+        return counter
+
+    def finish(self, counter: TransferCounter) -> None:
+        """Marks a transfer as over; its final state is drawn on the next render."""
+        if self.headless or counter.finished:
+            return
+        counter.finished = True
+        self.wakeup.set()
+        if self.wait_on_finish:
+            counter.rendered.wait(2 * self.interval + 1)
+
+    def _run(self) -> None:
+        from rich.progress import (
+            BarColumn,
+            DownloadColumn,
+            Progress,
+            TextColumn,
+            TimeElapsedColumn,
+            TransferSpeedColumn,
+        )
+
+        progress = Progress(
+            TextColumn("[bold blue]{task.description}"),
+            BarColumn(),
+            "[progress.percentage]{task.percentage:>3.1f}%",
+            "•",
+            DownloadColumn(),
+            "•",
+            TransferSpeedColumn(),
+            "•",
+            TimeElapsedColumn(),
+            console=getattr(self.console, "rich", self.console),
+            auto_refresh=False,
+        )
+        finished = []
+        with progress:
+            while True:
+                self.wakeup.wait(self.interval)
+                self.wakeup.clear()
+
+                with self.lock:
+                    counters = list(self.counters.items())
+                for counter, task in counters:
+                    # Checked before reading ``done`` so the last value is drawn.
+                    if counter.finished:
+                        finished.append(counter)
+                    if task is None:
+                        task = progress.add_task(counter.description, total=counter.total)
+                        with self.lock:
+                            self.counters[counter] = task
+                    progress.update(task, completed=counter.done)
+                progress.refresh()
+
+                # Finished bars stay on screen until the display goes idle.
+                with self.lock:
+                    for counter in finished:
+                        del self.counters[counter]
+                    if not self.counters:
+                        self.thread = None
+                        break
+                for counter in finished:
+                    counter.rendered.set()
+                finished.clear()
+
+        for counter in finished:
+            counter.rendered.set()
@@ -0,0 +1,129 @@
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` bytes per second, bursts up to ``capacity``."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate // 10, 1)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+    def available(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+        return int(self.tokens)
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+    def delay(self, amount, now):
+        """Seconds until ``amount`` tokens will be available."""
+        missing = min(amount, self.capacity) - self.available(now)
+        return max(missing, 0) / self.rate
+
+
+class FairScheduler:
+    """
+    Deficit round robin over the connections that have bulk data to send.
+
+    Every round each flow earns ``quantum`` bytes of credit and may send up
+    to that much, further limited by an optional global token bucket and a
+    per-client (per IP) token bucket. Control replies never pass through
+    here: the reactor answers commands first and runs one scheduling round
+    per loop iteration, so a large download cannot delay an ECHO by more
+    than one round.
+
+    The flow objects are expected to have ``addr``, ``deficit`` and
+    ``bucket`` attributes and a ``blocked`` property that is true while
+    their socket cannot take more data.
+    """
+
+    def __init__(self, quantum, globalRate=0, clientRate=0):
+        self.quantum = quantum
+        self.globalBucket = TokenBucket(globalRate) if globalRate else None
+        self.clientRate = clientRate
+        self.clientBuckets = {}  # {ip: [TokenBucket, flow count]}
+        self.flows = deque()
+
+    def __len__(self):
+        return len(self.flows)
+
+    def add(self, flow):
+        flow.deficit = 0
+        if self.clientRate:
+            entry = self.clientBuckets.setdefault(flow.addr[0], [TokenBucket(self.clientRate), 0])
+            entry[1] += 1
+            flow.bucket = entry[0]
+        self.flows.append(flow)
+
+    def remove(self, flow):
+        if flow not in self.flows:
+            return
+        self.flows.remove(flow)
+        if flow.bucket is not None:
+            entry = self.clientBuckets[flow.addr[0]]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.clientBuckets[flow.addr[0]]
+            flow.bucket = None
+
+    def allowance(self, flow, now):
+        allowance = flow.deficit
+        if self.globalBucket is not None:
+            allowance = min(allowance, self.globalBucket.available(now))
+        if flow.bucket is not None:
+            allowance = min(allowance, flow.bucket.available(now))
+        return allowance
+
+    def runRound(self, send):
+        """
+        Gives every unblocked flow one quantum.
+
+        ``send(flow, budget)`` must queue at most ``budget`` bytes of the
+        flow's data and return how many it queued.
+        """
+        now = time.monotonic()
+        for flow in list(self.flows):
+            if flow.blocked:
+                continue
+
+            # Credit is capped so a rate-limited flow cannot hoard a burst.
+            flow.deficit = min(flow.deficit + self.quantum, 2 * self.quantum)
+            budget = self.allowance(flow, now)
+            if budget <= 0:
+                continue
+
+            sent = send(flow, budget)
+            flow.deficit -= sent
+            if self.globalBucket is not None:
+                self.globalBucket.consume(sent)
+            if flow.bucket is not None:
+                flow.bucket.consume(sent)
+
+        # Start the next round with the next flow so that shared buckets
+        # are not always drained by the same connection first.
+        if self.flows:
+            self.flows.rotate(-1)
+
+    def timeout(self):
+        """How long the reactor may block in select() without starving a flow."""
+        now = time.monotonic()
+        delay = None
+        for flow in self.flows:
+            if flow.blocked:
+                continue
+            wait = 0.0
+            if self.globalBucket is not None:
+                wait = max(wait, self.globalBucket.delay(self.quantum, now))
+            if flow.bucket is not None:
+                wait = max(wait, flow.bucket.delay(self.quantum, now))
+            delay = wait if delay is None else min(delay, wait)
+            if not delay:
+                break
+        return delay
@@ -1,20 +1,60 @@
 import socket
 import time
 import os
-import select
-from rich.console import Console
+import selectors
+import signal
+import argparse
+
+from protocol import (
+    DOWNLOAD_REPLY,
+    OP_CLOSE,
+    OP_DONE,
+    OP_DOWNLOAD,
+    OP_ECHO,
+    OP_ERROR,
+    OP_HELLO,
+    OP_NAMES,
+    OP_OK,
+    OP_STAT,
+    OP_TIME,
+    OP_UPLOAD,
+    STAT_REPLY,
+    TIME_REPLY,
+    TRANSFER,
+    FrameDecoder,
+    ProtocolError,
+    encode_frame,
+    unpack_transfer,
+    unpack_upload,
+)
+from scheduler import FairScheduler
+from prefork import SharedStats, Supervisor, reuseport_listener
+from progress import ProgressRenderer
+from terminal import Terminal
+from profiling import Profiler
+from metrics import (
+    ACTIVE_SESSIONS,
+    BYTES_IN,
+    BYTES_OUT,
+    COMMAND_LATENCY,
+    QUEUE_DEPTH,
+    TRANSFERS_ABORTED,
+    TRANSFERS_COMPLETED,
+    TRANSFERS_STARTED,
+    start_http_server,
+)
 
 BIND_ADDRESS = "0.0.0.0"
 BIND_PORT = 12345
+METRICS_PORT = 9345
 OPT_INTERVAL = 10
 OPT_COUNT = 3
 FRAME_SIZE = 8192
+OUTPUT_BUFFER_SIZE = 4 * FRAME_SIZE
+QUANTUM = OUTPUT_BUFFER_SIZE  # bytes a download may send per scheduling round
 
-console = Console()
-
-# Track transfer progress
-transfer_progress = {}  # {fileno: (total_size, transferred, filename, is_upload, last_update_time)}
-PROGRESS_UPDATE_INTERVAL = 1.0  # seconds between progress updates
+console = Terminal()
+progress = ProgressRenderer(console)
 
 def setOptions(clientSocket):
     clientSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -26,284 +66,554 @@ def setOptions(clientSocket):
 
     return clientSocket
 
-def downloadStart(conn, fileName, commandText):
-    if not os.path.exists(fileName):
-        conn.send("0".encode())
-        return (False, f"File \"{fileName}\" not found.")
-    
-    conn.send("1".encode())
-    
-    file = open(fileName, 'rb')
-    fileSize = os.path.getsize(fileName)
-    offset = int(conn.recv(FRAME_SIZE).decode())
-    conn.send(str(fileSize).encode())
-    file.seek(offset, 0)
-
-    socketsToWrite.append(conn)
-    setFileProperties(conn, True, file, fileSize, offset, commandText)
-    printStartFileLoading(conn, fileName, False)
-    
-    # Initialize progress tracking
-    fileno = conn.fileno()
-    transfer_progress[fileno] = (fileSize, offset, fileName, False, time.time())
-    
-    return (True, None)
-
-def downloadFile(conn):
-    data = properties[conn.fileno()][2].read(FRAME_SIZE)
-
-    if data:
-        conn.send(data)
-        
-        # Update progress
-        fileno = conn.fileno()
-        if fileno in transfer_progress:
-            total, transferred, filename, is_upload, last_update = transfer_progress[fileno]
-            transferred += len(data)
-            current_time = time.time()
-            
-            # Print progress update if enough time has passed
-            if current_time - last_update >= PROGRESS_UPDATE_INTERVAL:
-                percent = (transferred / total) * 100
-                console.print(f"[blue]Sending {filename}: {transferred}/{total} bytes ({percent:.1f}%)")
-                last_update = current_time
-                
-            transfer_progress[fileno] = (total, transferred, filename, is_upload, last_update)
-            
-        return False
-    else:
-        # Complete progress
-        fileno = conn.fileno()
-        if fileno in transfer_progress:
-            total, transferred, filename, is_upload, _ = transfer_progress[fileno]
-            percent = (transferred / total) * 100
-            console.print(f"[green]Completed sending {filename}: {transferred}/{total} bytes ({percent:.1f}%)")
-            del transfer_progress[fileno]
-        return True
-
-def downloadEnd(conn):
-    properties[conn.fileno()][2].close()
-    socketsToWrite.remove(conn)
-    command = properties[sock.fileno()][5]
-    setFileProperties(conn, False, None, None, None, "")
-    return command, "File transferred successfully."
-
-def uploadStart(conn, fileName, commandText):
-    clientHasFile = conn.recv(1).decode()
-    if clientHasFile == "0":
-        return (False, conn.recv(FRAME_SIZE).decode())
-
-    mode = 'ab' if os.path.exists(fileName) else 'wb+'
-
-    file = open(fileName, mode)
-    fileSize = int(conn.recv(FRAME_SIZE).decode())
-    conn.send(str(os.path.getsize(fileName)).encode())
-    offset = os.path.getsize(fileName)
-    file.seek(0, os.SEEK_END)
-
-    setFileProperties(conn, True, file, fileSize, offset, commandText)
-    printStartFileLoading(conn, fileName, True)
-    
-    # Initialize progress tracking
-    fileno = conn.fileno()
-    remaining = fileSize - offset
-    transfer_progress[fileno] = (fileSize, offset, fileName, True, time.time())
-    
-    return (True, None)
-
-def uploadFile(conn):
-    fileno = conn.fileno()
-    if properties[fileno][3] > properties[fileno][4]:
-        data = conn.recv(min(FRAME_SIZE, properties[fileno][3]))
-        properties[fileno][3] -= len(data)
-        properties[fileno][2].write(data)
-        
-        # Update progress
-        if fileno in transfer_progress:
-            total, transferred, filename, is_upload, last_update = transfer_progress[fileno]
-            transferred += len(data)
-            current_time = time.time()
-            
-            # Print progress update if enough time has passed
-            if current_time - last_update >= PROGRESS_UPDATE_INTERVAL:
-                percent = (transferred / total) * 100
-                console.print(f"[green]Receiving {filename}: {transferred}/{total} bytes ({percent:.1f}%)")
-                last_update = current_time
-                
-            transfer_progress[fileno] = (total, transferred, filename, is_upload, last_update)
-
-    if properties[fileno][3] > properties[fileno][4]:
-        return False
-    else:
-        # Complete progress
-        if fileno in transfer_progress:
-            total, transferred, filename, is_upload, _ = transfer_progress[fileno]
-            percent = (transferred / total) * 100
-            console.print(f"[blue]Completed receiving {filename}: {transferred}/{total} bytes ({percent:.1f}%)")
-            del transfer_progress[fileno]
-        return True
-
-def uploadEnd(conn):
-    properties[conn.fileno()][2].close()
-    command = properties[sock.fileno()][5]
-    setFileProperties(conn, False, None, None, None, "")
-    return command, "File uploaded successfully."
-
 def echo(data):
-    return data 
+    return data
 
 def _time():
-    currentTime = time.asctime(time.localtime())
-    return "Server time: " + currentTime
+    return TIME_REPLY.pack(time.time())
+
+def stat(fileName):
+    if not os.path.isfile(fileName):
+        return OP_ERROR, f"File \"{fileName}\" not found.".encode()
+    st = os.stat(fileName)
+    return OP_OK, STAT_REPLY.pack(st.st_size, st.st_mtime)
 
 def exit():
     return "Disconnecting from server..."
 
-def handleCommand(conn, clientInput):
-    command, argument = clientInput.partition(" ")[::2]
-
-    match (command.lower()):
-        case "echo":
-            response = echo(argument)
-
-        case "time":
-            response = _time()
-
-        case "download":
-            response = downloadStart(conn, argument, clientInput)
-
-        case "upload":
-            response = uploadStart(conn, argument, clientInput)
-
-        case "exit":
-            response = exit()
-
-        case _:
-            response = "Command not found!"
-
-    return command, response
-
 def printLog(clientInput, response, addr):
     print(f"User command from {addr}")
     print(f"Content: {clientInput}")
     print(f"Response: {response}\n")
 
-def printStartFileLoading(conn, fileName, dir):
-    if dir:
-        print(f"\nStarted receiving file {fileName}\n"
-              f"Sender: {properties[conn.fileno()][0][0]}\n")
-    else:
-        print(f"\nStarted sending file {fileName}\n"
-              f"Recipient: {properties[conn.fileno()][0][0]}\n")
-
-def unregClient(conn):
-    # Clean up progress tracking if client disconnects during transfer
-    fileno = conn.fileno()
-    if fileno in transfer_progress:
-        del transfer_progress[fileno]
-    
-    del properties[conn.fileno()]
-    connections.remove(conn)
-    conn.close()
-    print("Total connected:", len(connections) - 1, '\n')
-
-def regClient(conn, addr):
-    connections.append(conn)
-    properties[conn.fileno()] = [addr, False, None, None, None, ""]
-    print("Total connected:", len(connections) - 1, '\n')
-
-def setFileProperties(conn, loading, fd, bytesRemaining, offset, commandText):
-    properties[conn.fileno()] = [properties[conn.fileno()][0], loading, fd, bytesRemaining, offset, commandText]
+
+# Transfer phases of a connection
+IDLE = 0
+UPLOADING = 1
+DOWNLOADING = 2
+CLOSING = 3  # flush pending output, then disconnect
+
+
+class OutputBuffer:
+    """
+    Fixed-capacity byte buffer drained into a non-blocking socket.
+
+    Data lives in buf[start:end]; a memoryview over the bytearray lets file
+    reads land in place and partial sends advance the cursor without copying.
+    """
+
+    __slots__ = ("buf", "view", "start", "end")
+
+    def __init__(self, capacity=OUTPUT_BUFFER_SIZE):
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def free(self):
+        self.compact()
+        return len(self.buf) - self.end
+
+    def compact(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start:
+            pending = self.end - self.start
+            self.buf[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+
+    def write(self, data):
+        if len(data) > self.free():
+            # Control replies must never be dropped, so grow past capacity.
+            self.view.release()
+            self.buf.extend(bytes(len(data) - (len(self.buf) - self.end)))
+            self.view = memoryview(self.buf)
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def fillFrom(self, file, limit):
+        size = min(self.free(), limit)
+        if size <= 0:
+            return 0
+        read = file.readinto(self.view[self.end:self.end + size]) or 0
+        self.end += read
+        return read
+
+    def drain(self, sock):
+        if self.start == self.end:
+            return 0
+        try:
+            sent = sock.send(self.view[self.start:self.end])
+        except BlockingIOError:
+            return 0
+        self.start += sent
+        if self.start == self.end:
+            self.start = self.end = 0
+        return sent
+
+
+class Connection:
+    """Per-client state kept by the reactor, one instance per accepted socket."""
+
+    __slots__ = (
+        "sock",
+        "addr",
+        "phase",
+        "events",
+        "decoder",
+        "outbuf",
+        "requestId",
+        "file",
+        "fileName",
+        "fileSize",
+        "transferred",
+        "counter",
+        "deficit",
+        "bucket",
+    )
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.phase = IDLE
+        self.events = selectors.EVENT_READ
+        self.decoder = FrameDecoder()
+        self.outbuf = OutputBuffer()
+        self.requestId = 0
+        self.file = None
+        self.fileName = ""
+        self.fileSize = 0
+        self.transferred = 0
+        self.counter = None
+        self.deficit = 0
+        self.bucket = None
+
+    @property
+    def blocked(self):
+        # Unsent bytes mean the socket is full; wait for it to become writable.
+        return len(self.outbuf) > 0
+
+    def startTransfer(self, phase, requestId, file, fileName, fileSize, offset):
+        self.phase = phase
+        self.requestId = requestId
+        self.file = file
+        self.fileName = fileName
+        self.fileSize = fileSize
+        self.transferred = offset
+        action = "Receiving" if phase == UPLOADING else "Sending"
+        self.counter = progress.start(f"{action} {fileName}", fileSize, offset)
+
+    def endTransfer(self):
+        if self.file is not None:
+            self.file.close()
+        if self.counter is not None:
+            progress.finish(self.counter)
+            self.counter = None
+        self.phase = IDLE
+        self.file = None
+        self.fileName = ""
+
+    def queue(self, requestId, opcode, payload=b""):
+        self.outbuf.write(encode_frame(requestId, opcode, payload))
+
+
+class Server:
+    """
+    Single-threaded reactor on top of selectors.DefaultSelector (epoll on Linux).
+
+    All client sockets are non-blocking. Incoming bytes are split into
+    control frames by the connection's FrameDecoder, so pipelined requests
+    are answered in order; replies and file data are queued in the
+    connection's OutputBuffer and flushed when the socket is writable.
+    The interest set of each socket follows its transfer phase and backlog,
+    so each loop iteration only touches the sockets that are actually ready.
+
+    Download data is not sent from the event handlers: after all events of
+    an iteration have been handled, the FairScheduler hands every active
+    download its share of bytes for that round.
+
+    When run as a pre-fork worker (``stats`` given) the listening socket uses
+    SO_REUSEPORT, and SIGTERM makes the server stop accepting and exit once
+    the connected clients are done.
+    """
+
+    def __init__(self, address=BIND_ADDRESS, port=BIND_PORT, globalRate=0, clientRate=0, stats=None, metricsPort=0):
+        self.address = address
+        self.port = port
+        self.metricsPort = metricsPort
+        self.prefork = stats is not None
+        self.stats = stats if stats is not None else SharedStats().worker(0)
+        self.draining = False
+        self.wakeupSockets = ()
+        self.scheduler = FairScheduler(QUANTUM, globalRate, clientRate)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}  # {fileno: Connection}
+        self.serverSocket = None
+        self.recvBuffer = bytearray(FRAME_SIZE)
+        self.recvView = memoryview(self.recvBuffer)
+
+    def start(self):
+        if self.prefork:
+            self.serverSocket = setOptions(reuseport_listener(self.address, self.port))
+            self.watchSignals()
+        else:
+            self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.serverSocket = setOptions(self.serverSocket)
+            self.serverSocket.bind((self.address, self.port))
+            self.serverSocket.listen()
+        self.serverSocket.setblocking(False)
+        self.selector.register(self.serverSocket, selectors.EVENT_READ)
+
+        print(f"Server {os.getpid()} started.\n")
+        # kill -USR2 <pid> profiles the event loop for a while, see profiling.py.
+        Profiler("server3", ("handleCommand", "sendBulk", "uploadFile", "uploadChunk")).install()
+        if self.metricsPort:
+            self.startMetrics()
+
+        try:
+            while not self.draining or self.connections:
+                for key, mask in self.selector.select(self.scheduler.timeout()):
+                    if key.fileobj is self.serverSocket:
+                        self.acceptClient()
+                        continue
+                    if key.data is None:
+                        self.onSignal(key.fileobj)
+                        continue
+
+                    conn = key.data
+                    try:
+                        if mask & selectors.EVENT_READ:
+                            self.onReadable(conn)
+                        if mask & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                            self.onWritable(conn)
+                        if conn.sock.fileno() != -1:
+                            self.updateInterest(conn)
+                    except (socket.error, ProtocolError, ValueError):
+                        print('\nConnection error with', conn.addr)
+                        self.unregClient(conn)
+
+                self.scheduler.runRound(self.sendBulk)
+        finally:
+            self.stop()
+
+    def startMetrics(self):
+        # Sampled at scrape time from the metrics thread; reading sizes is safe under the GIL.
+        ACTIVE_SESSIONS.set_function(lambda: len(self.connections))
+        QUEUE_DEPTH.set_function(lambda: len(self.scheduler), queue="scheduled_downloads")
+        QUEUE_DEPTH.set_function(
+            lambda: sum(len(conn.outbuf) for conn in list(self.connections.values())),
+            queue="output_bytes",
+        )
+        start_http_server(self.metricsPort)
+        print(f"Metrics on http://127.0.0.1:{self.metricsPort}/metrics\n")
+
+    def stop(self):
+        for conn in list(self.connections.values()):
+            self.unregClient(conn)
+        self.closeListener()
+        for sock in self.wakeupSockets:
+            sock.close()
+        self.selector.close()
+
+    def closeListener(self):
+        if self.serverSocket is not None:
+            self.selector.unregister(self.serverSocket)
+            self.serverSocket.close()
+            self.serverSocket = None
+
+    def watchSignals(self):
+        # Signals interrupt select() through a socketpair registered in the
+        # selector, so shutdown is handled between events like anything else.
+        wakeupRead, wakeupWrite = socket.socketpair()
+        wakeupRead.setblocking(False)
+        wakeupWrite.setblocking(False)
+        self.wakeupSockets = (wakeupRead, wakeupWrite)
+        signal.set_wakeup_fd(wakeupWrite.fileno())
+        signal.signal(signal.SIGTERM, lambda signum, frame: None)
+        self.selector.register(wakeupRead, selectors.EVENT_READ, None)
+
+    def onSignal(self, wakeupRead):
+        try:
+            signums = wakeupRead.recv(64)
+        except BlockingIOError:
+            return
+        if signal.SIGTERM in signums and not self.draining:
+            print(f"Draining {len(self.connections)} connections before exit.\n")
+            self.draining = True
+            self.closeListener()
+
+    def acceptClient(self):
+        try:
+            clientConn, clientAddr = self.serverSocket.accept()
+        except BlockingIOError:
+            return
+        print("New connection detected\n" + "Address:", clientAddr[0])
+        self.stats.add("accepted")
+        self.stats.add("active")
+        self.regClient(clientConn, clientAddr)
+
+    def regClient(self, sock, addr):
+        sock.setblocking(False)
+        # A reply ends with a small frame after the raw bytes; Nagle would
+        # hold it back until the client's delayed ACK.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock, addr)
+        self.connections[sock.fileno()] = conn
+        self.selector.register(sock, conn.events, conn)
+        print("Total connected:", len(self.connections), '\n')
+
+    def unregClient(self, conn):
+        fileno = conn.sock.fileno()
+        if fileno in self.connections:
+            del self.connections[fileno]
+            self.stats.add("active", -1)
+            if conn.events:
+                self.selector.unregister(conn.sock)
+        if conn.phase == UPLOADING:
+            TRANSFERS_ABORTED.inc(direction="upload")
+        elif conn.phase == DOWNLOADING:
+            TRANSFERS_ABORTED.inc(direction="download")
+        self.scheduler.remove(conn)
+        conn.endTransfer()
+        conn.sock.close()
+        print("Total connected:", len(self.connections), '\n')
+
+    def updateInterest(self, conn):
+        events = 0
+        pending = len(conn.outbuf)
+        if conn.phase == CLOSING:
+            if not pending:
+                self.unregClient(conn)
+                return
+        elif conn.phase != DOWNLOADING and pending < OUTPUT_BUFFER_SIZE:
+            # Stop reading new commands while replies are backing up.
+            events |= selectors.EVENT_READ
+        if pending or conn.phase == CLOSING:
+            events |= selectors.EVENT_WRITE
+
+        if events == conn.events:
+            return
+        # A download that is waiting for its next round needs no events at all.
+        if not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        elif not events:
+            self.selector.unregister(conn.sock)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def onReadable(self, conn):
+        if conn.phase == UPLOADING:
+            self.uploadFile(conn)
+            self.processFrames(conn)
+            return
+
+        try:
+            data = conn.sock.recv(FRAME_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            print('Connection lost with', conn.addr)
+            self.unregClient(conn)
+            return
+
+        conn.decoder.feed(data)
+        self.processFrames(conn)
+        # Replies go out right away instead of waiting for the next writable event.
+        conn.outbuf.drain(conn.sock)
+
+    def processFrames(self, conn):
+        # Frames pipelined behind a transfer wait until the transfer is over.
+        while conn.phase == IDLE:
+            frame = conn.decoder.next_frame()
+            if frame is None:
+                return
+            self.handleCommand(conn, frame)
+            if conn.phase == UPLOADING and len(conn.decoder):
+                self.uploadBuffered(conn)
+
+    def onWritable(self, conn):
+        conn.outbuf.drain(conn.sock)
+
+    def reply(self, conn, requestId, opcode, payload, command, response):
+        conn.queue(requestId, opcode, payload)
+        printLog(command, response, conn.addr)
+
+    def handleCommand(self, conn, frame):
+        self.stats.add("requests")
+        started = time.perf_counter()
+        command = OP_NAMES.get(frame.opcode, str(frame.opcode))
+        opcode = OP_OK
+
+        if frame.opcode == OP_ECHO:
+            response = echo(frame.payload)
+
+        elif frame.opcode == OP_TIME:
+            response = _time()
+
+        elif frame.opcode == OP_STAT:
+            opcode, response = stat(frame.payload.decode())
+
+        elif frame.opcode == OP_DOWNLOAD:
+            offset, fileName = unpack_transfer(frame.payload)
+            command = f"{command} {fileName}"
+            opcode, response = self.downloadStart(conn, frame.request_id, fileName, offset)
+
+        elif frame.opcode == OP_UPLOAD:
+            fileSize, _, fileName = unpack_upload(frame.payload)
+            command = f"{command} {fileName}"
+            opcode, response = self.uploadStart(conn, frame.request_id, fileName, fileSize)
+
+        elif frame.opcode == OP_CLOSE:
+            response = exit().encode()
+
+        elif frame.opcode == OP_HELLO:
+            response = b""
+
+        else:
+            opcode, response = OP_ERROR, b"Command not found!"
+
+        self.reply(conn, frame.request_id, opcode, response, command, OP_NAMES[opcode])
+        COMMAND_LATENCY.observe(time.perf_counter() - started, command=OP_NAMES.get(frame.opcode, "UNKNOWN"))
+
+        if frame.opcode == OP_CLOSE:
+            print('Client', conn.addr, 'disconnected.')
+            conn.phase = CLOSING
+        elif conn.phase == UPLOADING and conn.transferred >= conn.fileSize:
+            # Nothing left to receive, the server already has the whole file.
+            self.finishTransfer(conn, "File uploaded successfully.")
+
+    def downloadStart(self, conn, requestId, fileName, offset):
+        if not os.path.isfile(fileName):
+            return OP_ERROR, f"File \"{fileName}\" not found.".encode()
+
+        try:
+            file = open(fileName, 'rb', buffering=0)
+        except OSError as e:
+            return OP_ERROR, f"Cannot open \"{fileName}\": {e.strerror}".encode()
+        fileSize = os.fstat(file.fileno()).st_size
+        offset = min(offset, fileSize)
+        file.seek(offset, 0)
+
+        conn.startTransfer(DOWNLOADING, requestId, file, fileName, fileSize, offset)
+        TRANSFERS_STARTED.inc(direction="download")
+        self.scheduler.add(conn)
+        self.printStartFileLoading(conn, False)
+
+        return OP_OK, DOWNLOAD_REPLY.pack(offset, fileSize)
+
+    def sendBulk(self, conn, budget):
+        wanted = min(budget, conn.fileSize - conn.transferred, conn.outbuf.free())
+        read = conn.outbuf.fillFrom(conn.file, wanted)
+        if wanted > 0 and read == 0:
+            # The file shrank after DOWNLOAD_REPLY announced its size. The
+            # client counts on the missing bytes and would take any frame
+            # for file data, so the connection is dropped.
+            print(f"\nFile {conn.fileName} shrank while sending, closing connection with", conn.addr)
+            self.unregClient(conn)
+            return 0
+        conn.transferred += read
+        conn.counter.done = conn.transferred
+        self.stats.add("bytes_out", read)
+        BYTES_OUT.inc(read)
+
+        try:
+            conn.outbuf.drain(conn.sock)
+            if conn.transferred >= conn.fileSize:
+                percent = (conn.transferred / conn.fileSize) * 100 if conn.fileSize else 100.0
+                console.print(f"[green]Completed sending {conn.fileName}: {conn.transferred}/{conn.fileSize} bytes ({percent:.1f}%)")
+                self.finishTransfer(conn, "File transferred successfully.")
+                self.processFrames(conn)
+                conn.outbuf.drain(conn.sock)
+            self.updateInterest(conn)
+        except (socket.error, ProtocolError, ValueError):
+            print('\nConnection error with', conn.addr)
+            self.unregClient(conn)
+
+        return read
+
+    def uploadStart(self, conn, requestId, fileName, fileSize):
+        mode = 'ab' if os.path.exists(fileName) else 'wb+'
+
+        try:
+            file = open(fileName, mode)
+        except OSError as e:
+            return OP_ERROR, f"Cannot open \"{fileName}\": {e.strerror}".encode()
+        offset = os.fstat(file.fileno()).st_size
+        file.seek(0, os.SEEK_END)
+
+        conn.startTransfer(UPLOADING, requestId, file, fileName, fileSize, offset)
+        TRANSFERS_STARTED.inc(direction="upload")
+        self.printStartFileLoading(conn, True)
+        return OP_OK, TRANSFER.pack(offset)
+
+    def uploadBuffered(self, conn):
+        data = conn.decoder.take(conn.fileSize - conn.transferred)
+        self.uploadChunk(conn, data)
+
+    def uploadFile(self, conn):
+        remaining = conn.fileSize - conn.transferred
+        try:
+            received = conn.sock.recv_into(self.recvBuffer, min(FRAME_SIZE, remaining))
+        except BlockingIOError:
+            return
+        if not received:
+            raise ConnectionResetError("Client closed connection during upload")
+
+        self.uploadChunk(conn, self.recvView[:received])
+
+    def uploadChunk(self, conn, data):
+        conn.file.write(data)
+        conn.transferred += len(data)
+        conn.counter.done = conn.transferred
+        self.stats.add("bytes_in", len(data))
+        BYTES_IN.inc(len(data))
+
+        if conn.transferred >= conn.fileSize:
+            console.print(f"[blue]Completed receiving {conn.fileName}: {conn.transferred}/{conn.fileSize} bytes (100.0%)")
+            self.finishTransfer(conn, "File uploaded successfully.")
+
+    def finishTransfer(self, conn, response):
+        command = f"{OP_NAMES[OP_UPLOAD if conn.phase == UPLOADING else OP_DOWNLOAD]} {conn.fileName}"
+        requestId = conn.requestId
+        TRANSFERS_COMPLETED.inc(direction="upload" if conn.phase == UPLOADING else "download")
+        self.scheduler.remove(conn)
+        conn.endTransfer()
+        self.reply(conn, requestId, OP_DONE, response.encode(), command, response)
+
+    def printStartFileLoading(self, conn, dir):
+        if dir:
+            print(f"\nStarted receiving file {conn.fileName}\n"
+                  f"Sender: {conn.addr[0]}\n")
+        else:
+            print(f"\nStarted sending file {conn.fileName}\n"
+                  f"Recipient: {conn.addr[0]}\n")
 
 #------------
 
-try:
-    connections = []
-    socketsToWrite = []
-    properties = {}
-    # properties[0] = адрес
-    # properties[1] = наличие загрузки файла
-    # properties[2] = файловый дескриптор
-    # properties[3] = байтов осталось
-    # properties[4] = смещение
-    # properties[5] = текст команды
-
-    serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    serverSocket = setOptions(serverSocket)
-    serverSocket.bind((BIND_ADDRESS, BIND_PORT))
-    serverSocket.listen()
-
-    serverSocket.setblocking(False)
-
-    connections.append(serverSocket)
-
-    print("Server started.\n")
-
-    while (True):
-        readReady, writeReady, socketsWithErrors = select.select(connections, socketsToWrite, connections)
-
-        for sock in readReady:
-            if sock == serverSocket:
-                clientConn, clientAddr = serverSocket.accept()
-                print("New connection detected\n" + "Address:", clientAddr[0])
-                regClient(clientConn, clientAddr)
-                continue
-
-            try:
-                if properties[sock.fileno()][1] == True:
-                    end = uploadFile(sock)
-                    if (end):
-                        command, response = uploadEnd(sock)
-                        sock.send(response.encode())
-                        printLog(command, response, properties[sock.fileno()][0])
-                    continue
-
-                clientInput = sock.recv(FRAME_SIZE).decode()
-                if not clientInput:
-                    print('Connection lost with', properties[sock.fileno()][0])
-                    if sock in socketsToWrite:
-                        socketsToWrite.remove(sock)
-                    unregClient(sock)
-                    continue
-
-                else:
-                    command, response = handleCommand(sock, clientInput)
-                    if ((command == 'upload' or command == 'download') and response[0] == True):
-                        continue
-                    
-                    sock.send((response[1] if type(response) is tuple else response).encode())
-                    printLog(clientInput, response[1] if type(response) is tuple else response, properties[sock.fileno()][0])
-
-                    if clientInput == 'exit':
-                        print('Client', properties[sock.fileno()][0], 'disconnected.')
-                        unregClient(sock)
-
-            except socket.error:
-                print('\nConnection error with', properties[sock.fileno()][0])
-                if sock in socketsToWrite:
-                    socketsToWrite.remove(sock)
-                unregClient(sock)
-        
-        for sock in writeReady:
-            try:
-                if properties[sock.fileno()][1] == True:
-                    end = downloadFile(sock)
-                    if (end):
-                        command, response = downloadEnd(sock)
-                        sock.send(response.encode())
-                        printLog(command, response, properties[sock.fileno()][0])
-
-            except socket.error:
-                print('\nConnection error with', properties[sock.fileno()][0])
-                if sock in socketsToWrite:
-                    socketsToWrite.remove(sock)
-                unregClient(sock)
-
-        for sock in socketsWithErrors:
-            print('\nConnection error with', properties[sock.fileno()][0])
-            if sock in socketsToWrite:
-                socketsToWrite.remove(sock)
-            unregClient(sock)
-
-except KeyboardInterrupt:
-    print("\nShutting down.\n")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lab 3 TCP file server")
+    parser.add_argument("--host", default=BIND_ADDRESS, help="Address to bind to")
+    parser.add_argument("--port", type=int, default=BIND_PORT, help="Port to listen on")
+    parser.add_argument("--rate", type=int, default=0, help="Aggregate download limit, bytes/s (0 = unlimited)")
+    parser.add_argument("--client-rate", type=int, default=0, help="Per-client download limit, bytes/s (0 = unlimited)")
+    parser.add_argument("--workers", type=int, default=1, help="Pre-fork this many worker processes sharing the port via SO_REUSEPORT")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Local Prometheus metrics port, 0 to disable (worker N uses this port + N)")
+    args = parser.parse_args()
+
+    def runWorker(index, stats):
+        # Rate limits apply per worker.
+        metricsPort = args.metrics_port and args.metrics_port + index
+        Server(args.host, args.port, args.rate, args.client_rate, stats=stats, metricsPort=metricsPort).start()
+
+    if args.workers > 1:
+        Supervisor(runWorker, args.workers).run()
+    else:
+        try:
+            server = Server(args.host, args.port, args.rate, args.client_rate, metricsPort=args.metrics_port)
+            server.start()
+        except KeyboardInterrupt:
+            print("\nShutting down.\n")
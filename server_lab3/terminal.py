@@ -0,0 +1,91 @@
+"""Console output that only loads rich when someone is watching.
+
+Importing rich costs tens of milliseconds, more than the rest of a client
+or server start-up together. A Terminal therefore decides once whether it
+is headless: forced with the NP_HEADLESS environment variable
+(``NP_HEADLESS=1`` / ``=0``), otherwise headless whenever stdout is not a
+terminal. A headless Terminal strips the rich markup and writes plain
+lines, and rich is never imported; an interactive one creates its
+``rich.console.Console`` on first use.
+"""
+
+import os
+import re
+import sys
+import time
+from typing import Any, Optional, Sequence
+
+# [bold red], [/bold red], [/] ... but not [1/3] or [42]
+MARKUP = re.compile(r"\[(?:/|/?[a-zA-Z#@][^\[\]]*)\]")
+
+
+def headless_default() -> bool:
+    flag = os.environ.get("NP_HEADLESS")
+    if flag is not None:
+        return flag not in ("", "0")
+    return not sys.stdout.isatty()
+
+
+def strip_markup(text: str) -> str:
+    return MARKUP.sub("", text)
+
+
+class Terminal:
+    """
+    The subset of rich.console.Console the programs use, loaded lazily.
+
+    Parameters
+    ----------
+    headless : bool, optional
+        Write plain text and never import rich, by default headless_default()
+    """
+
+    def __init__(self, headless: Optional[bool] = None):
+        self.headless = headless_default() if headless is None else headless
+        self._console = None
+
+    @property
+    def rich(self):
+        """The underlying rich Console, imported and created on first access."""
+        if self._console is None:
+            from rich.console import Console
+
+            self._console = Console()
+        return self._console
+
+    def print(self, *objects: Any, **kwargs) -> None:
+        if not self.headless:
+            self.rich.print(*objects, **kwargs)
+            return
+        end = kwargs.get("end", "\n")
+        print(" ".join(strip_markup(str(o)) for o in objects), end=end, flush=True)
+
+    def log(self, *objects: Any, **kwargs) -> None:
+        if not self.headless:
+            self.rich.log(*objects, _stack_offset=2, **kwargs)
+            return
+        text = " ".join(strip_markup(str(o)) for o in objects)
+        print(f"[{time.strftime('%X')}] {text}", flush=True)
+
+    def panel(self, body: str, title: str = "", subtitle: str = "", style: str = "", fit: bool = False) -> None:
+        """Draws ``body`` in a box; headless, one ``title: body`` line."""
+        if not self.headless:
+            from rich.panel import Panel
+
+            make = Panel.fit if fit else Panel
+            self.rich.print(make(body, title=title or None, subtitle=subtitle or None, border_style=style or "none"))
+            return
+        label = " / ".join(strip_markup(part) for part in (title, subtitle) if part)
+        print(f"{label}: {strip_markup(body)}" if label else strip_markup(body), flush=True)
+
+    def prompt(self, text: str, choices: Optional[Sequence[str]] = None) -> str:
+        """Asks for a line of input, repeating until it is one of ``choices``."""
+        if not self.headless:
+            from rich.prompt import Prompt
+
+            return Prompt.ask(text, choices=list(choices) if choices else None, console=self.rich)
+        hint = f" [{'/'.join(choices)}]" if choices else ""
+        while True:
+            answer = input(f"{strip_markup(text)}{hint} ")
+            if not choices or answer in choices:
+                return answer
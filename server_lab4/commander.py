@@ -1,9 +1,22 @@
 import time
 import os
 import datetime
-from config import BUFFER_SIZE, UPLOAD_PATH, SERVER_FILES_PATH, console, log
-from rich.panel import Panel
+from config import BUFFER_SIZE, UPLOAD_PATH, SERVER_FILES_PATH, DIGEST_INDEX_PATH, REQUEST, console, log
+from digest_index import DigestIndex
 from file_handler import File
+from metrics import COMMAND_LATENCY
+
+COMMANDS = ("QUIT", "TIME", "ECHO", "DOWNLOAD", "UPLOAD", "HAVE")
+
+_digest_index = None
+
+
+def digest_index():
+    """Digests of the uploaded files, shared by all client sessions."""
+    global _digest_index
+    if _digest_index is None:
+        _digest_index = DigestIndex(DIGEST_INDEX_PATH)
+    return _digest_index
 
 
 class ServerCommander:
@@ -63,12 +76,32 @@ class ServerCommander:
             if send_time > 0:
                 speed = (file_size - file_offset) / send_time / 1024
                 log.info(f"Download completed. Speed: {speed:.2f} KB/s")
-                console.print(
-                    Panel(
-                        f"[bold green]Download completed[/]\nSpeed: [yellow]{speed:.2f} KB/s[/]"
-                    )
+                console.panel(
+                    f"[bold green]Download completed[/]\nSpeed: [yellow]{speed:.2f} KB/s[/]"
                 )
 
+    def exec_have(self, args):
+        # HAVE <file name> <sha256 hex>: "1" if the content is now stored
+        # under that name, "0" if the client has to upload it.
+        parts = args.split()
+        try:
+            digest = bytes.fromhex(parts[-1])
+            file_name = " ".join(parts[:-1]).split("/")[-1]
+        except (IndexError, ValueError):
+            digest, file_name = b"", ""
+        if not file_name:
+            self.send_msg("0")
+            return
+
+        os.makedirs(UPLOAD_PATH, exist_ok=True)
+        if digest_index().copy_to(digest, os.path.join(UPLOAD_PATH, file_name)):
+            digest_index().save()
+            log.info(f"Have request: {file_name} is already stored")
+            self.send_msg("1")
+        else:
+            log.info(f"Have request: {file_name} is unknown")
+            self.send_msg("0")
+
     def exec_upload(self, args):
         path_parts = " ".join(args.split()[:-1]).split("/")
         full_file_name = os.path.join(UPLOAD_PATH, path_parts[-1])
@@ -93,34 +126,43 @@ class ServerCommander:
         file.recv_file(file_size, file_offset)
 
         end_time = time.time()
+        if os.path.getsize(full_file_name) == file_size:
+            digest_index().record(full_file_name)
+            digest_index().save()
 
         transfer_time = end_time - start_time
         if transfer_time > 0:
             speed = (file_size - file_offset) / transfer_time / 1024
             log.info(f"Upload completed. Speed: {speed:.2f} KB/s")
-            console.print(
-                Panel(
-                    f"[bold green]Upload completed[/]\nSpeed: [yellow]{speed:.2f} KB/s[/]"
-                )
+            console.panel(
+                f"[bold green]Upload completed[/]\nSpeed: [yellow]{speed:.2f} KB/s[/]"
             )
 
     def handle_command(self, msg):
         if len(msg) == 0:
             return
 
-        log.info(f"Request from {self.client_address}: {msg}")
+        log.info(f"Request from {self.client_address}: {msg}", extra=REQUEST)
 
         full_cmd = msg.split(maxsplit=1)
         command = full_cmd[0].strip().upper()
         arguments = "" if len(full_cmd) == 1 else full_cmd[1].strip()
 
-        console.print(
-            Panel(
-                f"[bold]Command:[/] [cyan]{command}[/]",
-                subtitle=f"From: {self.client_address[0]}:{self.client_address[1]}",
-            )
+        console.panel(
+            f"[bold]Command:[/] [cyan]{command}[/]",
+            subtitle=f"From: {self.client_address[0]}:{self.client_address[1]}",
         )
 
+        start_time = time.perf_counter()
+        try:
+            self.dispatch(msg, command, arguments)
+        finally:
+            COMMAND_LATENCY.observe(
+                time.perf_counter() - start_time,
+                command=command if command in COMMANDS else "UNKNOWN",
+            )
+
+    def dispatch(self, msg, command, arguments):
         if command == "QUIT":
             self.exec_quit()
         elif command == "TIME":
@@ -131,6 +173,8 @@ class ServerCommander:
             self.exec_download(arguments)
         elif command == "UPLOAD":
             self.exec_upload(arguments)
+        elif command == "HAVE":
+            self.exec_have(arguments)
         else:
             log.error(f"Unknown command: {command}")
             console.print("[bold red]Error:[/] Unknown command")
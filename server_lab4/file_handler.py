@@ -3,7 +3,35 @@ import time
 import select
 import socket
 import threading
-from config import BUFFER_SIZE, READ_BUFFER_SIZE, WRITE_BUFFER_SIZE, console, log
+from config import BUFFER_SIZE, READ_BUFFER_SIZE, WRITE_BUFFER_SIZE, PACKET, console, log
+from metrics import (
+    BYTES_IN,
+    BYTES_OUT,
+    NACKS,
+    RETRANSMITS,
+    TRANSFERS_ABORTED,
+    TRANSFERS_COMPLETED,
+    TRANSFERS_STARTED,
+)
+from packet_trace import (
+    ABORT,
+    ACK_RECV,
+    ACK_SENT,
+    FIN_ACK_RECV,
+    FIN_ACK_SENT,
+    FIN_RECV,
+    FIN_SENT,
+    NACK_RECV,
+    NACK_SENT,
+    NULL_TRACE,
+    RECEIVING,
+    RECV,
+    RETRANSMIT,
+    SEND,
+    SENDING,
+    TIMEOUT,
+    open_trace,
+)
 
 
 class File:
@@ -13,6 +41,7 @@ class File:
         self.socket = socket
         self.address = address
         self.file_map = None
+        self.trace = NULL_TRACE
         self.lock = threading.Lock()
 
     def wait(self, socket):
@@ -22,7 +51,10 @@ class File:
     def send_file(self, offset):
         sended_data_size = 0
         send_time = 0
-        with open(self.file_name, self.mode) as file:
+        with (
+            open(self.file_name, self.mode) as file,
+            open_trace(SENDING, self.file_name, os.path.getsize(self.file_name)) as self.trace,
+        ):
             file.seek(int(offset), 0)
             file_size = os.path.getsize(self.file_name)
             total_to_send = file_size - offset
@@ -32,6 +64,7 @@ class File:
             
             seq_num = int(offset / BUFFER_SIZE)
             start_time = time.time()
+            TRANSFERS_STARTED.inc(direction="download")
             
             while True:
                 data = file.read(WRITE_BUFFER_SIZE)
@@ -39,6 +72,7 @@ class File:
                     break
 
                 packet = f"{seq_num}:{data.decode('utf-8')}"
+                self.trace.event(SEND, seq_num, len(data))
                 seq_num += 1
 
                 packet_start_time = time.time()
@@ -48,35 +82,52 @@ class File:
 
                 send_time += packet_end_time - packet_start_time
                 sended_data_size += len(data)
+                BYTES_OUT.inc(len(data))
                 
             
 
             with self.lock:
                 self.socket.sendto(b"FIN", self.address)
+            self.trace.event(FIN_SENT, seq_num)
             log.info(f"FIN sent to {self.address}")
+            acknowledged = False
             
             while True:
                 try:
                     self.socket.settimeout(1)
-                    log.info(f"Waiting for missing packets from {self.address}")
+                    log.info(f"Waiting for missing packets from {self.address}", extra=PACKET)
                     ack, _ = self.socket.recvfrom(BUFFER_SIZE)
                     ack = ack.decode("utf-8")
                     if ack.startswith("RETRY"):
-                        log.info(f"Received RETRY: {ack} from {self.address}")
+                        log.info(f"Received RETRY: {ack} from {self.address}", extra=PACKET)
                         seq_num = int(ack.split(":")[1])
+                        self.trace.event(NACK_RECV, seq_num)
                         position = seq_num * BUFFER_SIZE
                         file.seek(position, 0)
                         data = file.read(BUFFER_SIZE)
                         packet = f"{seq_num}:{data.decode('utf-8')}"
                         with self.lock:
                             self.socket.sendto(packet.encode("utf-8"), self.address)
+                        NACKS.inc(direction="received")
+                        RETRANSMITS.inc()
+                        BYTES_OUT.inc(len(data))
+                        self.trace.event(RETRANSMIT, seq_num, len(data))
                         _ = self.socket.recvfrom(BUFFER_SIZE)
+                        self.trace.event(ACK_RECV, seq_num)
                     elif ack.startswith("FIN_ACK"):
+                        self.trace.event(FIN_ACK_RECV)
+                        acknowledged = True
                         break
                 except socket.timeout:
+                    self.trace.event(TIMEOUT)
                     log.info(f"Timeout waiting for missing packets from {self.address}")
                     break
 
+            if acknowledged:
+                TRANSFERS_COMPLETED.inc(direction="download")
+            else:
+                TRANSFERS_ABORTED.inc(direction="download")
+
             end_time = time.time()
             total_time = end_time - start_time
             if total_time > 0:
@@ -96,20 +147,25 @@ class File:
     def retry_missing_packets(self, missing_packets, received_packets):
         log.info(f"Retrying missing packets for {self.address}: {missing_packets}")
         for seq_num in missing_packets:
-            log.info(f"Sending RETRY: {seq_num} to {self.address}")
+            log.info(f"Sending RETRY: {seq_num} to {self.address}", extra=PACKET)
             retry_message = f"RETRY:{seq_num}"
             with self.lock:
                 self.socket.sendto(retry_message.encode("utf-8"), self.address)
+            NACKS.inc(direction="sent")
+            self.trace.event(NACK_SENT, seq_num)
 
             data, address = self.socket.recvfrom(READ_BUFFER_SIZE)
 
             seq_num, file_data = data.split(b":", 1)
             seq_num = int(seq_num.decode("utf-8"))
-            log.info(f"Received RETRY: {seq_num} from {self.address}")
+            log.info(f"Received RETRY: {seq_num} from {self.address}", extra=PACKET)
             received_packets[seq_num] = file_data
+            BYTES_IN.inc(len(file_data))
+            self.trace.event(RECV, seq_num, len(file_data))
             with self.lock:
                 self.socket.sendto(b"ACK", address)
-            log.info(f"Sent ACK: {seq_num} to {self.address}")
+            self.trace.event(ACK_SENT, seq_num)
+            log.info(f"Sent ACK: {seq_num} to {self.address}", extra=PACKET)
         
         new_missing_packets = self.check_missing_packets(received_packets)
         if new_missing_packets:
@@ -123,7 +179,10 @@ class File:
             return
 
         recv_data_size = 0
-        with open(self.file_name, self.mode) as file:
+        with (
+            open(self.file_name, self.mode) as file,
+            open_trace(RECEIVING, self.file_name, file_size) as self.trace,
+        ):
             file.seek(0, os.SEEK_END)
             offset = os.path.getsize(self.file_name)
             log.info(f"File {self.file_name} offset: {offset} for {self.address}")
@@ -133,12 +192,14 @@ class File:
 
             received_packets = {}
             start_time = time.time()
+            TRANSFERS_STARTED.inc(direction="upload")
             
             while True:
                 data, address = self.socket.recvfrom(READ_BUFFER_SIZE)
                 recv_data_size += len(data)
 
                 if data == b"FIN":
+                    self.trace.event(FIN_RECV)
                     log.info(f"Received FIN from {self.address}")
                     missing_packets = self.check_missing_packets(received_packets)
                     if missing_packets:
@@ -150,16 +211,20 @@ class File:
                     log.info(f"Sending FIN_ACK to {self.address}")
                     with self.lock:
                         self.socket.sendto(b"FIN_ACK", address)
+                    self.trace.event(FIN_ACK_SENT)
                     _ = self.socket.recvfrom(BUFFER_SIZE)
+                    TRANSFERS_COMPLETED.inc(direction="upload")
                     break
 
                 if data == b"CTRL_C":
+                    self.trace.event(ABORT)
                     log.info(f"CTRL_C received from {self.address}, stopping")
+                    TRANSFERS_ABORTED.inc(direction="upload")
 
                     curr_seq = -1
                     for seq_num in sorted(received_packets.keys()):
                         if seq_num - 1 != curr_seq:
-                            log.info(f"Missing packet from {self.address}: {seq_num}")
+                            log.info(f"Missing packet from {self.address}: {seq_num}", extra=PACKET)
                             break
                         curr_seq = seq_num
                         file.write(received_packets[seq_num])
@@ -167,17 +232,20 @@ class File:
 
                 if not data:
                     log.info(f"File {self.file_name} received from {self.address}, stopping")
+                    TRANSFERS_COMPLETED.inc(direction="upload")
                     break
 
                 seq_num, file_data = data.split(b":", 1)
                 seq_num = int(seq_num.decode("utf-8"))
 
                 received_packets[seq_num] = file_data
-                
+                BYTES_IN.inc(len(file_data))
+                self.trace.event(RECV, seq_num, len(file_data))
+
                 # Периодически выводим статус приема
                 if len(received_packets) % 100 == 0:
                     progress_percent = min(100, int((recv_data_size / total_to_receive) * 100))
-                    log.info(f"Receiving progress from {self.address}: {progress_percent}% ({recv_data_size}/{total_to_receive} bytes)")
+                    log.info(f"Receiving progress from {self.address}: {progress_percent}% ({recv_data_size}/{total_to_receive} bytes)", extra=PACKET)
 
             end_time = time.time()
             transfer_time = end_time - start_time
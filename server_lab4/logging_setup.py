@@ -1,31 +1,149 @@
 import os
+import queue
+import atexit
 import datetime
 import logging
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
 
+QUEUE_SIZE = 10000
 
-def setup_logging(log_dir="logs"):
+# Records logged with extra=PACKET (per datagram, RETRY, ACK) or
+# extra=REQUEST (per request / per worker thread) are rate limited.
+PACKET = {"category": "packet"}
+REQUEST = {"category": "request"}
+
+# {category: (records per second, burst)}
+RATE_LIMITS = {
+    "packet": (20, 100),
+    "request": (50, 200),
+}
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread without ever blocking the caller.
+
+    When the queue is full the record is dropped and counted; the count is
+    reported in a single record as soon as the queue has room again.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.reported = 0
+        self.drop_lock = threading.Lock()
+
+    def enqueue(self, record):
+        try:
+            if self.dropped != self.reported:
+                self.report_drops()
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+
+    def report_drops(self):
+        with self.drop_lock:
+            lost = self.dropped - self.reported
+            if not lost:
+                return
+            self.reported = self.dropped
+        notice = logging.makeLogRecord({
+            "name": "udp_server",
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": f"Log queue full, {lost} records dropped ({self.dropped} total)",
+        })
+        try:
+            self.queue.put_nowait(notice)
+        except queue.Full:
+            with self.drop_lock:
+                self.reported -= lost
+
+
+class CategoryRateLimiter(logging.Filter):
+    """
+    Token bucket per message category.
+
+    Records without a category always pass. Suppressed records are counted
+    and the count is appended to the next record of the same category that
+    gets through.
+    """
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits
+        self.buckets = {category: [burst, time.monotonic()] for category, (_, burst) in limits.items()}
+        self.suppressed = dict.fromkeys(limits, 0)
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        category = getattr(record, "category", None)
+        if category not in self.limits:
+            return True
+
+        rate, burst = self.limits[category]
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets[category]
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.suppressed[category] += 1
+                return False
+            bucket[0] -= 1
+            suppressed = self.suppressed[category]
+            self.suppressed[category] = 0
+
+        if suppressed:
+            record.msg = f"{record.getMessage()} [{suppressed} similar {category} messages suppressed]"
+            record.args = None
+        return True
+
+
+def setup_logging(log_dir="logs", queue_size=QUEUE_SIZE, rate_limits=RATE_LIMITS):
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    
+
     current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     log_file = os.path.join(log_dir, f"udp_server_{current_time}.log")
-    
+
     logger = logging.getLogger("udp_server")
     logger.setLevel(logging.DEBUG)
-    
+
     formatter = logging.Formatter('%(asctime)s - %(message)s')
-    
+
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(formatter)
-    
+
     file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.DEBUG) 
+    file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
-    
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
-    
+
+    # The terminal and the disk are only written by the listener thread;
+    # server threads just put records on a bounded queue.
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(CategoryRateLimiter(rate_limits))
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
     logger.info(f"Logging initialized. Log file: {log_file}")
     return logger
 
+
+def dropped_records(logger):
+    """Number of records the logger's queue handlers had to drop."""
+    return sum(getattr(handler, "dropped", 0) for handler in logger.handlers)
+
+
+def queued_records(logger):
+    """Number of records waiting for the listener thread."""
+    return sum(handler.queue.qsize() for handler in logger.handlers if isinstance(handler, QueueHandler))
@@ -1,12 +1,14 @@
+import argparse
 import os
 import select
 import socket
 import sys
 import threading
 
-from rich.panel import Panel
-
 from commander import ServerCommander
+from logging_setup import dropped_records, queued_records, setup_logging
+from profiling import Profiler
+from metrics import ACTIVE_SESSIONS, QUEUE_DEPTH, start_http_server
 from config import (
     BUFFER_SIZE,
     UPLOAD_PATH,
@@ -16,6 +18,8 @@ from config import (
     WRITE_BUFFER_SIZE,
     HOST,
     PORT,
+    METRICS_PORT,
+    REQUEST,
     console,
     log,
     ensure_directories,
@@ -23,9 +27,10 @@ from config import (
 
 
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, metrics_port=METRICS_PORT):
         self.host = host
         self.port = port
+        self.metrics_port = metrics_port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_running = True
         self.active_clients = {}  # Dictionary to track active clients and their state
@@ -43,15 +48,21 @@ class Server:
 
         try:
             self.server_socket.bind((self.host, self.port))
+            # kill -USR2 <pid> profiles the server for a while, see profiling.py.
+            Profiler("udp_server", ("handle_command", "send_file", "recv_file"), report=log.info).install()
+            if self.metrics_port:
+                start_http_server(self.metrics_port)
+                ACTIVE_SESSIONS.set_function(lambda: len(self.active_clients))
+                QUEUE_DEPTH.set_function(lambda: queued_records(log), queue="log")
+                QUEUE_DEPTH.set_function(lambda: threading.active_count() - 1, queue="threads")
             ensure_directories()
 
-            console.print(
-                Panel.fit(
-                    f"[bold green]UDP Server started[/]\n"
-                    f"Listening on: [cyan]{self.host}:{self.port}[/]\n"
-                    f"Upload directory: [yellow]{os.path.abspath(UPLOAD_PATH)}[/]\n"
-                    f"Server files: [yellow]{os.path.abspath(SERVER_FILES_PATH)}[/]"
-                )
+            console.panel(
+                f"[bold green]UDP Server started[/]\n"
+                f"Listening on: [cyan]{self.host}:{self.port}[/]\n"
+                f"Upload directory: [yellow]{os.path.abspath(UPLOAD_PATH)}[/]\n"
+                f"Server files: [yellow]{os.path.abspath(SERVER_FILES_PATH)}[/]",
+                fit=True,
             )
 
             self.request_listener()
@@ -62,13 +73,13 @@ class Server:
     def stop(self):
         self.server_running = False
         self.server_socket.close()
-        log.info(f"Server stopped. Total threads created: {self.thread_count}")
+        log.info(f"Server stopped. Total threads created: {self.thread_count}, log records dropped: {dropped_records(log)}")
         console.print(f"[bold yellow]Server is shutting down. Total threads created: {self.thread_count}. Goodbye![/]")
 
     def handle_client_request(self, msg, client_address):
         """Handle a client request in a separate thread"""
         thread_id = threading.get_ident()
-        log.info(f"Thread {thread_id} started for client {client_address}")
+        log.info(f"Thread {thread_id} started for client {client_address}", extra=REQUEST)
         
         try:
             # Create a new commander for this client if it doesn't exist
@@ -77,28 +88,28 @@ class Server:
                     commander = ServerCommander(self.server_socket)
                     commander.set_client_address(client_address)
                     self.active_clients[client_address] = commander
-                    log.info(f"New client {client_address} registered in thread {thread_id}")
+                    log.info(f"New client {client_address} registered in thread {thread_id}", extra=REQUEST)
                 else:
                     commander = self.active_clients[client_address]
-                    log.info(f"Using existing commander for client {client_address} in thread {thread_id}")
+                    log.info(f"Using existing commander for client {client_address} in thread {thread_id}", extra=REQUEST)
 
             # Process the command
-            log.info(f"Thread {thread_id} processing command from {client_address}: {msg.decode('utf-8')[:50]}...")
+            log.info(f"Thread {thread_id} processing command from {client_address}: {msg.decode('utf-8')[:50]}...", extra=REQUEST)
             commander.handle_command(msg.decode("utf-8"))
-            log.info(f"Thread {thread_id} completed command processing for {client_address}")
+            log.info(f"Thread {thread_id} completed command processing for {client_address}", extra=REQUEST)
 
             # Remove inactive clients
             with self.lock:
                 if not commander.client_is_active:
                     del self.active_clients[client_address]
-                    log.info(f"Client {client_address} removed from active clients in thread {thread_id}")
+                    log.info(f"Client {client_address} removed from active clients in thread {thread_id}", extra=REQUEST)
                 
                 active_count = len(self.active_clients)
-                log.info(f"Active clients count: {active_count}")
+                log.info(f"Active clients count: {active_count}", extra=REQUEST)
         except Exception as e:
             log.error(f"Error in thread {thread_id} handling request from {client_address}: {e}")
         finally:
-            log.info(f"Thread {thread_id} for client {client_address} finished")
+            log.info(f"Thread {thread_id} for client {client_address} finished", extra=REQUEST)
 
     def request_listener(self):
         """Listen for incoming requests and spawn threads to handle them"""
@@ -120,7 +131,7 @@ class Server:
                             current_thread_count = self.thread_count
                         
                         # Log the incoming request and thread creation
-                        log.info(f"Received request from {client_address}, spawning thread #{current_thread_count}")
+                        log.info(f"Received request from {client_address}, spawning thread #{current_thread_count}", extra=REQUEST)
                         console.print(f"[cyan]New request from {client_address} - creating thread #{current_thread_count}[/]")
                         
                         # Create and start a new thread to handle this request
@@ -134,7 +145,7 @@ class Server:
                         
                         # Log active threads
                         active_thread_count = threading.active_count()
-                        log.info(f"Active threads: {active_thread_count}, Total created: {current_thread_count}")
+                        log.info(f"Active threads: {active_thread_count}, Total created: {current_thread_count}", extra=REQUEST)
                         
                     except BlockingIOError:
                         # No data available, continue to next iteration
@@ -151,9 +162,21 @@ class Server:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP file server")
+    parser.add_argument("--host", default=HOST, help="Address to bind to")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="Serve Prometheus metrics on this local port, 0 to disable",
+    )
+    args = parser.parse_args()
+    setup_logging()
+
     try:
         console.print("[bold blue]===== UDP File Server =====")
-        server = Server(HOST, PORT)
+        server = Server(args.host, args.port, args.metrics_port)
         server.start()
     except KeyboardInterrupt:
         console.print("\n[yellow]Keyboard interrupt detected[/]")